@@ -1,12 +1,16 @@
 import logging
 
-from typing import List
+from typing import List, Optional
 from sqlalchemy import text, bindparam
 from sqlalchemy import asc, desc
 from event_stream.models.model import Publication, PublicationAuthor
 from sqlalchemy.engine import Connection
 from sqlalchemy.orm import Session
 
+from app.daos.pagination import keyset_page
+from app.daos.search import relevance_order
+from app.daos.snapshot import trending_snapshot, entity_columns
+
 
 def retrieve_author(session: Session, id, with_pubs=False):
     """
@@ -47,7 +51,7 @@ def get_authors(session: Session, offset: int = 0, limit: int = 10, sort: str =
     """
 
     qs = """
-        WHERE a.name ILIKE '%:search%'
+        WHERE a.name ILIKE :search
     """
 
     qb = '  GROUP BY a.id ORDER BY  '
@@ -83,11 +87,11 @@ def get_authors(session: Session, offset: int = 0, limit: int = 10, sort: str =
 
 
 def get_trending_authors(session: Session, offset: int = 0, limit: int = 10, sort: str = 'score', order: str = 'asc',
-                         search: str = '', duration: str = "currently"):
-    """ get trending authors from postgresql
+                         search: str = '', duration: str = "currently", cursor: Optional[str] = None,
+                         with_count: bool = False):
+    """ get trending authors from postgresql, uses keyset pagination if a cursor is given
     """
-    q = """
-    SELECT ROW_NUMBER () OVER (ORDER BY score DESC) as trending_ranking, *, count(*) OVER() AS total_count FROM (
+    aggregation = """
           SELECT a.id, a.name, count(t.publication_doi) as pub_count,
               SUM(t.score) as score, SUM(count) as count, AVG(mean_sentiment) as mean_sentiment,
               SUM(sum_followers) as sum_followers, AVG(abstract_difference) as abstract_difference,
@@ -101,6 +105,9 @@ def get_trending_authors(session: Session, offset: int = 0, limit: int = 10, sor
               JOIN author a on a.id = pa.author_id
           WHERE duration = :duration
       """
+    q = """
+    SELECT ROW_NUMBER () OVER (ORDER BY score DESC) as trending_ranking, *, count(*) OVER() AS total_count FROM (
+    """ + aggregation
 
     sortable = ['trending_ranking', 'score', 'count', 'mean_sentiment', 'sum_followers', 'abstract_difference',
                 'mean_age', 'mean_length', 'mean_questions', 'mean_exclamations', 'mean_bot_rating',
@@ -110,7 +117,50 @@ def get_trending_authors(session: Session, offset: int = 0, limit: int = 10, sor
     qs = """
             AND a.name ILIKE :search
         """
-    if sort in sortable:
+
+    if trending_snapshot.available:
+        # read the precomputed aggregation and ranking, no group by and no window over the trending table
+        total_count = 'count(*) OVER()'
+        if len(search) <= 3:
+            total_count = '(SELECT count(*) FROM trending_author_rank c WHERE c.duration = :duration)'
+        q = """
+            SELECT """ + entity_columns + """, """ + total_count + """ AS total_count
+            FROM trending_author_rank t
+            WHERE duration = :duration
+        """
+        qb = ' ORDER BY  '
+        qs = """
+            AND name ILIKE :search
+        """
+        if cursor is not None:
+            seek_q = "SELECT " + entity_columns + " FROM trending_author_rank t WHERE duration = :duration "
+            count_q = "SELECT count(*) FROM trending_author_rank t WHERE duration = :duration "
+            if sort not in sortable:
+                sort = 'score'
+            return keyset_page(session, seek_q, qs, {'duration': duration}, sort, sort, 'id', 'id', order, limit,
+                               cursor, search, count_q, with_count, key_type=int)
+
+    if cursor is not None:
+        # without the snapshot the aggregation and its ranking window are computed once per page, shared by the
+        # seeks of keyset_page, there is no total count window and no offset scan
+        params = {'duration': duration}
+        if len(search) > 3:
+            aggregation += qs
+            params['search'] = '%' + search + '%'
+        aggregation += '  GROUP BY a.id '
+        ranked = """
+            WITH ranked AS (SELECT ROW_NUMBER () OVER (ORDER BY score DESC) as trending_ranking, * FROM (
+            """ + aggregation + """) g)
+        """
+        if sort not in sortable:
+            sort = 'score'
+        return keyset_page(session, 'SELECT * FROM ranked WHERE TRUE ', '', params, sort, sort, 'id', 'id', order,
+                           limit, cursor, '', 'SELECT count(*) FROM ranked', with_count, ranked, int)
+
+    relevance = sort == 'relevance' and len(search) > 3
+    if relevance:
+        qb = qb[:qb.rindex('ORDER BY')] + relevance_order('name')
+    elif sort in sortable:
         qb += sort + ' '
     else:
         qb += 'score '
@@ -131,6 +181,9 @@ def get_trending_authors(session: Session, offset: int = 0, limit: int = 10, sor
         q += qb
         # print(q)
         s = text(q).bindparams(bindparam('duration'), bindparam('limit'), bindparam('offset'), bindparam('search'))
+        if relevance:
+            params['term'] = search
+            s = s.bindparams(bindparam('term'))
     else:
         q += qb
         # print(q)
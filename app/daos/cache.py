@@ -0,0 +1,190 @@
+"""Response Cache
+ in memory lru cache of serialized json responses, entries expire after the refresh window of their duration
+ (trending_time_definition) since the underlying trending data does not change before that, or as soon as the data
+ version of their duration (freshness) changed. Responses carry a weak ETag (normalized query and data version, the
+ "time" field of the body differs per request) and a Cache-Control max-age until the next window boundary, a
+ matching If-None-Match is answered with 304.
+ The bodies are stored without their "time" field, a hit reports the time of its own request.
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from starlette.responses import Response
+
+from app.daos.encoder import dumps
+from app.daos.flux_cache import FluxCache
+from app.daos.freshness import data_freshness
+from app.daos.stats import trending_time_definition
+
+# read in cache config
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+RESPONSE_CACHE_MAX_TTL = float(os.environ.get('RESPONSE_CACHE_MAX_TTL', 3600))
+RESPONSE_CACHE_ENABLED = os.environ.get('RESPONSE_CACHE_ENABLED', '1') not in ('0', 'false', 'False')
+
+
+class ResponseCache(object):
+    """
+    lru cache holding pre-serialized json bodies, bounded by the summed body size
+
+    - **max_bytes**: memory bound of all cached bodies
+    - **max_ttl**: upper bound in seconds for the per duration ttl
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_ttl=3600.0, enabled=True):
+        self.max_bytes = max_bytes
+        self.max_ttl = max_ttl
+        self.enabled = enabled
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def ttl(self, duration):
+        """ seconds an entry for the given duration stays valid, None if the duration is unknown """
+        if duration not in trending_time_definition:
+            return None
+        window = trending_time_definition[duration]['window_size'].total_seconds()
+        return min(window, self.max_ttl)
+
+    @staticmethod
+    def key(route, **params):
+        """ normalized cache key for a route and its query parameters """
+        if 'order' in params:
+            params['order'] = 'desc' if params['order'] == 'desc' else 'asc'
+        if 'search' in params:
+            # the daos ignore short search terms and search case insensitive
+            search = params['search'] or ''
+            params['search'] = search.lower() if len(search) > 3 else ''
+        return route + '?' + '&'.join(k + '=' + str(params[k]) for k in sorted(params))
+
+    @staticmethod
+    def etag(key, duration):
+        """ weak validator of a response, changes with the data version (or the window if versions are unknown), with
+            the snapshot the version changes once a refresh committed (see app.daos.freshness) """
+        version = data_freshness.version_key(duration, trending_time_definition[duration]['window_size'])
+        return 'W/"%s"' % hashlib.sha1((key + '#' + version).encode()).hexdigest()[:24]
+
+    def headers(self, key, duration):
+        """ ETag and Cache-Control of a response, shared caches keep it until the next window boundary """
+        if duration not in trending_time_definition:
+            return {}
+        window_end = FluxCache.window(trending_time_definition[duration]['window_size'])[1]
+        max_age = max(0, min(int(window_end - time.time()), int(self.max_ttl)))
+        return {'ETag': self.etag(key, duration), 'Cache-Control': 'public, max-age=%d' % max_age}
+
+    def get(self, key):
+        """ cached body for key or None """
+        if not self.enabled:
+            return None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, duration, version, body = entry
+            if expires <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            if version != data_freshness.version(duration):
+                self._remove(key)
+                self.invalidations += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return body
+
+    def set(self, key, body, duration):
+        """ store a serialized body, skipped for unknown durations or bodies larger than the memory bound """
+        ttl = self.ttl(duration)
+        if not self.enabled or not ttl or len(body) > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (time.monotonic() + ttl, duration, data_freshness.version(duration), body)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def clear(self):
+        """ drop all entries """
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """ counters of the cache """
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+            }
+
+    def cached_response(self, key, duration=None, request=None, start=None):
+        """ 304 if the client has the current version, response for a cache hit or None
+
+        - **start**: time.time() at the start of the request, the time of a hit is measured from it
+        """
+        headers = self.headers(key, duration)
+        if request is not None and 'ETag' in headers and etag_matches(request.headers.get('if-none-match'),
+                                                                        headers['ETag']):
+            return Response(status_code=304, headers=headers)
+        body = self.get(key)
+        if body is None:
+            return None
+        elapsed = round((time.time() - start) * 1000) if start is not None else None
+        return Response(content=with_time(body, elapsed), media_type='application/json',
+                        headers={'X-Cache': 'HIT', **headers})
+
+    def respond(self, key, duration, content):
+        """ serialize content once, store the body without the query time and return it as response """
+        content = dict(content)
+        elapsed = content.pop('time', None)
+        body = dumps(content)
+        self.set(key, body, duration)
+        return Response(content=with_time(body, elapsed), media_type='application/json',
+                        headers={'X-Cache': 'MISS', **self.headers(key, duration)})
+
+    def _remove(self, key):
+        body = self.entries.pop(key)[-1]
+        self.size -= len(body)
+
+
+def with_time(body, elapsed):
+    """ serialized response object with the query time in milliseconds as first field, the body if None """
+    if elapsed is None:
+        return body
+    return b'{"time":' + str(elapsed).encode() + (b',' + body[1:] if body != b'{}' else b'}')
+
+
+def etag_matches(if_none_match, etag):
+    """ True if the If-None-Match header contains the etag (weak comparison as required for If-None-Match) """
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or opaque_tag(etag) in (opaque_tag(tag) for tag in tags)
+
+
+def opaque_tag(etag):
+    """ etag without the weak indicator """
+    return etag[2:] if etag.startswith('W/') else etag
+
+
+response_cache = ResponseCache(RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_MAX_TTL, RESPONSE_CACHE_ENABLED)
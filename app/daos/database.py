@@ -2,16 +2,24 @@
  get configs from enviroment and initialize the connections to
     - postgresql
     - influxdb
+
+ both are available blocking and async, async routes run the (sync) daos with AsyncSession.run_sync or
+ run_with_async_influx, queries are awaited inside a greenlet so the event loop is never blocked
 """
 import os
 import urllib
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.util import await_only, greenlet_spawn
 from sqlalchemy.ext.declarative import declarative_base  # only for doc?
 from event_stream.models.model import *
 from influxdb_client import InfluxDBClient
+from influxdb_client.client.influxdb_client_async import InfluxDBClientAsync
 from influxdb_client.client.write_api import SYNCHRONOUS
 
+from app.daos.instrumentation import instrument_engines, timed
+
 # read in db config
 host_server = os.environ.get('POSTGRES_HOST', 'postgres')
 db_server_port = urllib.parse.quote_plus(str(os.environ.get('POSTGRES_PORT', '5432')))
@@ -21,16 +29,68 @@ db_password = urllib.parse.quote_plus(str(os.environ.get('POSTGRES_PASSWORD', 'R
 
 DATABASE_URL = 'postgresql+psycopg2://{}:{}@{}:{}/{}'.format(db_username, db_password, host_server,
                                                              db_server_port, database_name)
+# asyncpg prepares every statement server side, the cache keeps them per connection for reused statements
+statement_cache_size = int(os.environ.get('POSTGRES_STATEMENT_CACHE_SIZE', 500))
+ASYNC_DATABASE_URL = 'postgresql+asyncpg://{}:{}@{}:{}/{}?prepared_statement_cache_size={}'.format(
+    db_username, db_password, host_server, db_server_port, database_name, statement_cache_size)
 print(DATABASE_URL)
 
-# setup postgreql
+# setup postgreql, every statement is timed (app.daos.instrumentation)
+instrument_engines()
 engine = create_engine(DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
+# setup async postgresql
+async_engine = create_async_engine(ASYNC_DATABASE_URL)
+AsyncSessionLocal = sessionmaker(bind=async_engine, class_=AsyncSession, autocommit=False, autoflush=False,
+                                 expire_on_commit=False)
+
 # setup inlux db
 org = os.environ.get('INFLUXDB_V2_ORG', 'ambalytics')
 
 client = InfluxDBClient.from_env_properties()
 write_api = client.write_api(write_options=SYNCHRONOUS)
 query_api = client.query_api()
+
+
+# async influx client, needs a running event loop and is created on startup
+async_client = None
+async_client_query_api = None
+
+
+async def open_async_influx():
+    """ create the async influx client """
+    global async_client, async_client_query_api
+    if async_client is None:
+        async_client = InfluxDBClientAsync.from_env_properties()
+        async_client_query_api = async_client.query_api()
+
+
+async def close_async_influx():
+    """ close the async influx client """
+    global async_client, async_client_query_api
+    if async_client is not None:
+        await async_client.close()
+        async_client = None
+        async_client_query_api = None
+
+
+class GreenletQueryApi(object):
+    """
+    query api with the blocking signature of query_api, it awaits the async client and therefore can only be used
+    by daos running inside AsyncSession.run_sync or run_with_async_influx
+    """
+
+    def query(self, query, org=None, params=None):
+        """ run a flux query on the async influx client """
+        with timed('flux', query, params):
+            return await_only(async_client_query_api.query(query, org=org, params=params))
+
+
+async_query_api = GreenletQueryApi()
+
+
+async def run_with_async_influx(fn, *args, **kwargs):
+    """ run a dao that only needs influx (pass async_query_api) without blocking the event loop """
+    return await greenlet_spawn(fn, *args, **kwargs)
@@ -0,0 +1,374 @@
+"""Discussion Counts
+ all time discussion counts per author/field of study and discussion value (discussion_entity_count, the top values
+ of /stats/top), so a word cloud of a large field of study does not sum its discussion data points, and time bucketed
+ discussion counts per publication (discussion_count_bucket), the pipeline only keeps all time totals.
+
+ Statement level triggers on discussion_data_point and the membership tables record the changed totals and
+ memberships (one extra insert per write statement of the pipeline), one worker at a time (advisory lock) applies
+ them every DISCUSSION_COUNT_INTERVAL seconds: changed memberships with the totals of their publication as of the
+ last apply, then the changed totals with the current memberships. The counts are filled once when the table is
+ created and rebuilt after a truncate of one of the tables.
+
+ The increase of the totals is added to the bucket of the current hour by the same apply, hour buckets older than a
+ day are merged into day buckets, day buckets are kept for a year. A top list of a duration (trending_time_definition)
+ sums the buckets since its start instead of scanning the discussion data points, durations longer than two days are
+ exact to the day.
+
+ With DISCUSSION_COUNTS_ENABLED=0 the triggers and tables are dropped again.
+
+    python -m app.daos.discussion_counts
+"""
+import os
+import threading
+
+from sqlalchemy import text
+
+from app.daos.database import engine
+
+# read in discussion count config
+DISCUSSION_COUNTS_ENABLED = os.environ.get('DISCUSSION_COUNTS_ENABLED', '1') not in ('0', 'false', 'False')
+DISCUSSION_COUNT_INTERVAL = float(os.environ.get('DISCUSSION_COUNT_INTERVAL', 300))
+
+# (membership table, entity column, mode)
+discussion_memberships = [
+    ('publication_author', 'author', 'author'),
+    ('publication_field_of_study', 'field_of_study', 'fieldOfStudy'),
+]
+
+discussion_count_tables = [
+    # changes of the totals not applied yet, appended by the triggers (no updates, so writes never wait on a row),
+    # a row without doi asks for a rebuild (truncate)
+    """
+    CREATE TABLE IF NOT EXISTS discussion_count_change (
+        publication_doi varchar,
+        discussion_data_id bigint,
+        increase bigint
+    )
+    """,
+    # memberships written since the last apply
+    """
+    CREATE TABLE IF NOT EXISTS discussion_membership_change (
+        sign smallint NOT NULL,
+        entity varchar NOT NULL,
+        id bigint NOT NULL,
+        publication_doi varchar NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS discussion_entity_count (
+        entity varchar NOT NULL,
+        id bigint NOT NULL,
+        discussion_data_id bigint NOT NULL,
+        type varchar,
+        value varchar,
+        count bigint NOT NULL,
+        PRIMARY KEY (entity, id, discussion_data_id)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS discussion_entity_count_top_idx "
+    "ON discussion_entity_count (entity, id, type, count DESC)",
+    """
+    CREATE TABLE IF NOT EXISTS discussion_count_bucket (
+        bucket_size varchar NOT NULL,
+        bucket_start timestamptz NOT NULL,
+        publication_doi varchar NOT NULL,
+        discussion_data_id bigint NOT NULL,
+        count bigint NOT NULL,
+        PRIMARY KEY (bucket_size, bucket_start, publication_doi, discussion_data_id)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS discussion_count_bucket_start_idx ON discussion_count_bucket (bucket_start)",
+    "CREATE INDEX IF NOT EXISTS discussion_count_bucket_doi_idx "
+    "ON discussion_count_bucket (publication_doi, bucket_start)",
+]
+
+discussion_capture_functions = [
+    # the difference of the old and new totals per publication and discussion value of a statement
+    """
+    CREATE OR REPLACE FUNCTION discussion_count_capture() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'TRUNCATE' THEN
+            INSERT INTO discussion_count_change (publication_doi) VALUES (NULL);
+        ELSIF TG_OP = 'INSERT' THEN
+            INSERT INTO discussion_count_change (publication_doi, discussion_data_id, increase)
+                SELECT publication_doi, discussion_data_point_id, SUM(count)
+                FROM new_rows
+                GROUP BY publication_doi, discussion_data_point_id
+                HAVING SUM(count) <> 0;
+        ELSIF TG_OP = 'DELETE' THEN
+            INSERT INTO discussion_count_change (publication_doi, discussion_data_id, increase)
+                SELECT publication_doi, discussion_data_point_id, -SUM(count)
+                FROM old_rows
+                GROUP BY publication_doi, discussion_data_point_id
+                HAVING SUM(count) <> 0;
+        ELSE
+            INSERT INTO discussion_count_change (publication_doi, discussion_data_id, increase)
+                SELECT publication_doi, discussion_data_point_id, SUM(count)
+                FROM (SELECT publication_doi, discussion_data_point_id, count FROM new_rows
+                      UNION ALL
+                      SELECT publication_doi, discussion_data_point_id, -count FROM old_rows) c
+                GROUP BY publication_doi, discussion_data_point_id
+                HAVING SUM(count) <> 0;
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+] + [
+    """
+    CREATE OR REPLACE FUNCTION discussion_count_{entity}_capture() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'TRUNCATE' THEN
+            INSERT INTO discussion_count_change (publication_doi) VALUES (NULL);
+            RETURN NULL;
+        END IF;
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            INSERT INTO discussion_membership_change (sign, entity, id, publication_doi)
+                SELECT -1, '{mode}', {entity}_id, publication_doi FROM old_rows;
+        END IF;
+        IF TG_OP IN ('UPDATE', 'INSERT') THEN
+            INSERT INTO discussion_membership_change (sign, entity, id, publication_doi)
+                SELECT 1, '{mode}', {entity}_id, publication_doi FROM new_rows;
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    """.format(entity=entity, mode=mode) for membership, entity, mode in discussion_memberships
+]
+
+# (trigger, table, function)
+discussion_triggers = [('discussion_count_' + event, 'discussion_data_point', 'discussion_count_capture()')
+                       for event in ('insert', 'update', 'delete', 'truncate')] + [
+    ('discussion_count_' + entity + '_' + event, membership, 'discussion_count_' + entity + '_capture()')
+    for membership, entity, mode in discussion_memberships for event in ('insert', 'update', 'delete', 'truncate')]
+
+discussion_trigger_events = {
+    'insert': 'AFTER INSERT ON {table} REFERENCING NEW TABLE AS new_rows',
+    'update': 'AFTER UPDATE ON {table} REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows',
+    'delete': 'AFTER DELETE ON {table} REFERENCING OLD TABLE AS old_rows',
+    'truncate': 'AFTER TRUNCATE ON {table}',
+}
+
+entity_count_upsert = """
+    ON CONFLICT (entity, id, discussion_data_id) DO UPDATE SET count = discussion_entity_count.count + EXCLUDED.count
+"""
+
+# all time totals of every author/field of study
+entity_count_totals = """
+    SELECT '{mode}', m.{entity}_id, dd.id, dd.type, dd.value, SUM(ddp.count)
+    FROM discussion_data_point ddp
+        JOIN discussion_data dd on ddp.discussion_data_point_id = dd.id
+        JOIN {membership} m on ddp.publication_doi = m.publication_doi
+    WHERE dd.value != 'und' AND dd.value != 'unknown' AND ddp.count IS NOT NULL
+    GROUP BY m.{entity}_id, dd.id
+"""
+
+# the counts of the current totals, when the table is created or after a truncate
+rebuild_entity_counts = [
+    'DELETE FROM discussion_count_change',
+    'DELETE FROM discussion_membership_change',
+    'DELETE FROM discussion_entity_count',
+    'INSERT INTO discussion_entity_count (entity, id, discussion_data_id, type, value, count) ' + ' UNION ALL '.join(
+        entity_count_totals.format(mode=mode, entity=entity, membership=membership)
+        for membership, entity, mode in discussion_memberships),
+]
+
+# changed memberships against the totals of their publications as of the last apply (current totals without the
+# pending changes)
+apply_membership_changes = """
+    WITH members AS (
+        SELECT entity, id, publication_doi, SUM(sign) as sign
+        FROM discussion_membership_change
+        GROUP BY entity, id, publication_doi
+        HAVING SUM(sign) <> 0
+    ), previous AS (
+        SELECT publication_doi, discussion_data_point_id as discussion_data_id, count FROM discussion_data_point
+        WHERE publication_doi IN (SELECT publication_doi FROM members) AND count IS NOT NULL
+        UNION ALL
+        SELECT publication_doi, discussion_data_id, -increase FROM discussion_count_change
+        WHERE publication_doi IN (SELECT publication_doi FROM members)
+    )
+    INSERT INTO discussion_entity_count (entity, id, discussion_data_id, type, value, count)
+        SELECT m.entity, m.id, dd.id, dd.type, dd.value, SUM(m.sign * p.count)
+        FROM members m
+            JOIN previous p on p.publication_doi = m.publication_doi
+            JOIN discussion_data dd on dd.id = p.discussion_data_id
+        WHERE dd.value != 'und' AND dd.value != 'unknown'
+        GROUP BY m.entity, m.id, dd.id
+""" + entity_count_upsert
+
+# change of the discussion counts of every author/field of study of the changed publications (changed)
+entity_count_change = """
+    SELECT '{mode}', m.{entity}_id, dd.id, dd.type, dd.value, SUM(c.increase)
+    FROM changed c
+        JOIN discussion_data dd on dd.id = c.discussion_data_id
+        JOIN {membership} m on m.publication_doi = c.publication_doi
+    WHERE dd.value != 'und' AND dd.value != 'unknown'
+    GROUP BY m.{entity}_id, dd.id
+"""
+
+# drain the changed totals, add the increase to the bucket of the current hour and the change to the counts of the
+# current memberships
+apply_count_changes = """
+    WITH drained AS (
+        DELETE FROM discussion_count_change RETURNING publication_doi, discussion_data_id, increase
+    ), changed AS (
+        SELECT publication_doi, discussion_data_id, SUM(increase) as increase
+        FROM drained
+        GROUP BY publication_doi, discussion_data_id
+    ), buckets AS (
+        INSERT INTO discussion_count_bucket (bucket_size, bucket_start, publication_doi, discussion_data_id, count)
+            SELECT 'hour', date_trunc('hour', now()), publication_doi, discussion_data_id, increase
+            FROM changed
+            WHERE increase > 0
+        ON CONFLICT (bucket_size, bucket_start, publication_doi, discussion_data_id)
+            DO UPDATE SET count = discussion_count_bucket.count + EXCLUDED.count
+    )
+    INSERT INTO discussion_entity_count (entity, id, discussion_data_id, type, value, count)
+""" + ' UNION ALL '.join(entity_count_change.format(mode=mode, entity=entity, membership=membership)
+                         for membership, entity, mode in discussion_memberships) + entity_count_upsert
+
+apply_entity_counts = [
+    apply_membership_changes,
+    apply_count_changes,
+    'DELETE FROM discussion_membership_change',
+]
+
+compact_buckets = [
+    """
+    INSERT INTO discussion_count_bucket (bucket_size, bucket_start, publication_doi, discussion_data_id, count)
+        SELECT 'day', date_trunc('day', bucket_start), publication_doi, discussion_data_id, SUM(count)
+        FROM discussion_count_bucket
+        WHERE bucket_size = 'hour' AND bucket_start < date_trunc('day', now()) - interval '1 day'
+        GROUP BY 2, 3, 4
+    ON CONFLICT (bucket_size, bucket_start, publication_doi, discussion_data_id)
+        DO UPDATE SET count = discussion_count_bucket.count + EXCLUDED.count
+    """,
+    """
+    DELETE FROM discussion_count_bucket
+    WHERE bucket_size = 'hour' AND bucket_start < date_trunc('day', now()) - interval '1 day'
+    """,
+    "DELETE FROM discussion_count_bucket WHERE bucket_size = 'day' AND bucket_start < now() - interval '366 days'",
+]
+
+pending_changes = """
+    SELECT EXISTS (SELECT 1 FROM discussion_count_change) OR EXISTS (SELECT 1 FROM discussion_membership_change)
+"""
+rebuild_requested = 'SELECT EXISTS (SELECT 1 FROM discussion_count_change WHERE publication_doi IS NULL)'
+
+
+def create_discussion_counts(bind=engine, enabled=DISCUSSION_COUNTS_ENABLED):
+    """ create the entity counts, the buckets, the change tables and the capture triggers, fill the counts if they are
+        new, without the discussion counts the triggers and tables are dropped so the pipeline writes no changes
+        nobody applies """
+    with bind.begin() as connection:
+        if not enabled:
+            drop_discussion_counts(connection)
+            return
+
+        fill = connection.execute(text("SELECT to_regclass('discussion_entity_count')")).scalar() is None
+        for statement in discussion_count_tables + discussion_capture_functions:
+            connection.execute(text(statement))
+        for trigger, table, function in discussion_triggers:
+            print('create trigger %s on %s' % (trigger, table))
+            connection.execute(text('DROP TRIGGER IF EXISTS %s ON %s' % (trigger, table)))
+            connection.execute(text('CREATE TRIGGER %s %s FOR EACH STATEMENT EXECUTE PROCEDURE %s' % (
+                trigger, discussion_trigger_events[trigger.rsplit('_', 1)[1]].format(table=table), function)))
+        if fill:
+            # creating the triggers blocks writes to the tables until commit, the totals are complete
+            print('fill discussion_entity_count')
+            for statement in rebuild_entity_counts:
+                connection.execute(text(statement))
+
+
+def drop_discussion_counts(connection):
+    """ drop the capture triggers, the change tables, the entity counts and the buckets """
+    for trigger, table, function in discussion_triggers:
+        print('drop trigger %s on %s' % (trigger, table))
+        connection.execute(text('DROP TRIGGER IF EXISTS %s ON %s' % (trigger, table)))
+    connection.execute(text('DROP TABLE IF EXISTS discussion_count_change, discussion_membership_change, '
+                            'discussion_entity_count, discussion_count_bucket'))
+    for function in sorted(set(function for trigger, table, function in discussion_triggers)):
+        connection.execute(text('DROP FUNCTION IF EXISTS ' + function))
+
+
+class DiscussionCounts(object):
+    """
+    applies the captured discussion and membership changes to the entity counts and the hour buckets, only one worker
+    applies at a time, all statements of an apply see the same snapshot
+
+    - **available**: the entity counts and windowed discussion queries are only used if the tables exist
+    """
+    lock_key = 'discussion_counts'
+
+    def __init__(self, bind, interval=300.0, enabled=True):
+        self.bind = bind
+        self.interval = interval
+        self.enabled = enabled
+        self.available = False
+        self.collections = 0
+
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """ check that the tables exist and start the collect thread """
+        if not self.enabled:
+            return
+        try:
+            with self.bind.connect() as connection:
+                exists = connection.execute(text("SELECT to_regclass('discussion_entity_count')")).scalar()
+        except Exception as e:
+            print('discussion counts check failed: %s' % e)
+            return
+
+        if exists is None:
+            print('discussion counts missing, run python -m app.daos.discussion_counts')
+            return
+
+        self.available = True
+        if self.thread and self.thread.is_alive():
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, name='discussion-counts', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """ stop the collect thread """
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join(self.interval)
+            self.thread = None
+
+    def collect(self):
+        """ apply the changes since the last collect and compact old hours, returns True if this worker collected,
+            a rebuild after a truncate adds nothing to the buckets """
+        with self.bind.begin() as connection:
+            connection.execute(text('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ'))
+            locked = connection.execute(text('SELECT pg_try_advisory_xact_lock(hashtext(:key))'),
+                                        {'key': self.lock_key}).scalar()
+            if not locked:
+                return False
+
+            statements = []
+            if connection.execute(text(pending_changes)).scalar():
+                rebuild = connection.execute(text(rebuild_requested)).scalar()
+                statements = rebuild_entity_counts if rebuild else apply_entity_counts
+            for statement in statements + compact_buckets:
+                connection.execute(text(statement))
+        self.collections += 1
+        return True
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.collect()
+            except Exception as e:
+                print('discussion counts collect failed: %s' % e)
+
+
+discussion_counts = DiscussionCounts(engine, DISCUSSION_COUNT_INTERVAL, DISCUSSION_COUNTS_ENABLED)
+
+
+if __name__ == '__main__':
+    create_discussion_counts()
@@ -0,0 +1,45 @@
+"""Encoder
+ json serialization of dao results in one pass with orjson, rows, datetimes and decimals are written directly instead of
+ converting them with jsonable_encoder first and serializing the converted copy again with json
+"""
+from decimal import Decimal
+from typing import Any, Mapping
+
+import orjson
+from fastapi.encoders import jsonable_encoder
+from starlette.responses import JSONResponse
+
+
+def default(obj):
+    """ orjson fallback for the types it does not serialize itself, same output as jsonable_encoder """
+    if isinstance(obj, Decimal):
+        # integral decimals (counts, sums) stay ints, like pydantic's decimal encoder used by jsonable_encoder
+        if obj.is_finite() and obj.as_tuple().exponent >= 0:
+            return int(obj)
+        return float(obj)
+    if isinstance(obj, tuple):
+        # named tuples are lists for jsonable_encoder as well
+        return list(obj)
+    if hasattr(obj, '_asdict'):
+        # sqlalchemy Row
+        return obj._asdict()
+    if isinstance(obj, Mapping):
+        # sqlalchemy RowMapping
+        return dict(obj)
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    return jsonable_encoder(obj)
+
+
+def dumps(content: Any) -> bytes:
+    """ serialize content to json bytes """
+    return orjson.dumps(content, default=default, option=orjson.OPT_NON_STR_KEYS)
+
+
+class OrjsonResponse(JSONResponse):
+    """
+    json response serialized with orjson, the content can contain dao results (rows, datetimes, decimals) as they are
+    """
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
@@ -0,0 +1,121 @@
+"""Export
+ stream complete result sets as ndjson or csv, rows are read from a server side cursor in batches of
+ EXPORT_FETCH_SIZE and written as soon as they arrive, so the memory of a worker does not grow with the result size
+"""
+import csv
+import io
+import os
+import re
+
+from sqlalchemy import text, bindparam
+from starlette.responses import StreamingResponse
+
+from app.daos.database import AsyncSessionLocal
+from app.daos.encoder import dumps
+from app.daos.snapshot import trending_snapshot
+
+# read in export config
+EXPORT_FETCH_SIZE = int(os.environ.get('EXPORT_FETCH_SIZE', 1000))
+
+# media type of each export format
+export_formats = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+trending_publication_export = """
+    SELECT ROW_NUMBER () OVER (ORDER BY score DESC) as trending_ranking, p.*, t.score, count, mean_sentiment,
+        sum_followers, abstract_difference, mean_age, mean_length, mean_questions, mean_exclamations, mean_bot_rating,
+        projected_change, trending, ema, kama, ker, mean_score, stddev
+    FROM trending t
+        JOIN publication p on p.doi = t.publication_doi
+    WHERE duration = :duration
+    ORDER BY score DESC
+"""
+
+# the snapshot is read in ranking order with its (duration, trending_ranking) index, no sort needed
+trending_publication_snapshot_export = """
+    SELECT t.trending_ranking, p.*, t.score, count, mean_sentiment, sum_followers, abstract_difference, mean_age,
+        mean_length, mean_questions, mean_exclamations, mean_bot_rating, projected_change, trending, ema, kama, ker,
+        mean_score, stddev
+    FROM trending_publication_rank t
+        JOIN publication p on p.doi = t.publication_doi
+    WHERE duration = :duration
+    ORDER BY t.trending_ranking
+"""
+
+export_queries = {
+    'author_publications': text("""
+        SELECT p.* FROM publication_author pa
+            JOIN publication p on p.doi = pa.publication_doi
+        WHERE pa.author_id = :id
+    """).bindparams(bindparam('id')),
+    'field_of_study_publications': text("""
+        SELECT p.* FROM publication_field_of_study pf
+            JOIN publication p on p.doi = pf.publication_doi
+        WHERE pf.field_of_study_id = :id
+    """).bindparams(bindparam('id')),
+    'trending_publications': text(trending_publication_export).bindparams(bindparam('duration')),
+    'trending_publications_snapshot': text(trending_publication_snapshot_export).bindparams(bindparam('duration')),
+}
+
+
+def export_statement(name):
+    """ statement of an export, trending publications are read from the snapshot if available """
+    if name == 'trending_publications' and trending_snapshot.available:
+        name = 'trending_publications_snapshot'
+    return export_queries[name]
+
+
+async def stream_rows(name, params, fetch_size=EXPORT_FETCH_SIZE):
+    """ yield the column names and then the rows of an export in batches of fetch_size from a server side cursor """
+    async with AsyncSessionLocal() as session:
+        result = await session.stream(export_statement(name), params)
+        yield list(result.keys())
+        async for rows in result.partitions(fetch_size):
+            yield rows
+
+
+async def ndjson_lines(batches):
+    """ one json object per row, a chunk per batch """
+    await batches.__anext__()
+    async for rows in batches:
+        yield b''.join(dumps(row) + b'\n' for row in rows)
+
+
+async def csv_lines(batches):
+    """ csv with a header line, a chunk per batch, nested values (e.g. arrays) are written as json """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    writer.writerow(await batches.__anext__())
+    async for rows in batches:
+        for row in rows:
+            writer.writerow([csv_value(value) for value in row])
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+def csv_value(value):
+    """ csv cell of a value """
+    if value is None:
+        return ''
+    if isinstance(value, (list, dict)):
+        return dumps(value).decode()
+    return value
+
+
+def export_response(name, params, export_format='ndjson', filename='export'):
+    """ streaming response of an export in the given format ('ndjson' or 'csv') """
+    filename = re.sub(r'[^\w.-]', '_', filename)
+    batches = stream_rows(name, params)
+    if export_format == 'csv':
+        body = csv_lines(batches)
+    else:
+        body = ndjson_lines(batches)
+    return StreamingResponse(body, media_type=export_formats[export_format],
+                             headers={'Content-Disposition': 'attachment; filename="%s.%s"' % (filename,
+                                                                                              export_format)})
@@ -1,6 +1,12 @@
+from typing import Optional
+
 from sqlalchemy import text, bindparam
 from sqlalchemy.orm import Session
 
+from app.daos.pagination import keyset_page
+from app.daos.search import relevance_order
+from app.daos.snapshot import trending_snapshot, entity_columns
+
 
 def retrieve_field_of_study(session: Session, id, with_pubs=False):
     """ retrieve field of study from postgres """
@@ -34,7 +40,7 @@ def get_fields_of_study(session: Session, offset: int = 0, limit: int = 10, sort
     """
 
     qs = """
-        WHERE fos.name ILIKE '%:search%'
+        WHERE fos.name ILIKE :search
     """
 
     qb = '  GROUP BY fos.id ORDER BY  '
@@ -70,10 +76,10 @@ def get_fields_of_study(session: Session, offset: int = 0, limit: int = 10, sort
 
 
 def get_trending_fields_of_study(session: Session, offset: int = 0, limit: int = 10, sort: str = 'score',
-                                 order: str = 'desc', search: str = '', duration: str = 'currently'):
-    """ retrieve field of study from postgres """
-    q = """
-        SELECT ROW_NUMBER () OVER (ORDER BY score DESC) as trending_ranking, *, count(*) OVER() AS total_count FROM (
+                                 order: str = 'desc', search: str = '', duration: str = 'currently',
+                                 cursor: Optional[str] = None, with_count: bool = False):
+    """ retrieve field of study from postgres, uses keyset pagination if a cursor is given """
+    aggregation = """
             SELECT fos.id, fos.name, count(t.publication_doi) as pub_count,
                 SUM(t.score) as score, SUM(count) as count, AVG(mean_sentiment) as mean_sentiment,
                 SUM(sum_followers) as sum_followers, AVG(abstract_difference) as abstract_difference,
@@ -87,6 +93,9 @@ def get_trending_fields_of_study(session: Session, offset: int = 0, limit: int =
                 JOIN field_of_study fos on fos.id = pfos.field_of_study_id
                 WHERE duration = :duration 
         """
+    q = """
+        SELECT ROW_NUMBER () OVER (ORDER BY score DESC) as trending_ranking, *, count(*) OVER() AS total_count FROM (
+    """ + aggregation
 
     sortable = ['trending_ranking', 'score', 'count', 'mean_sentiment', 'sum_followers', 'abstract_difference',
                 'mean_age', 'mean_length', 'mean_questions', 'mean_exclamations', 'mean_bot_rating',
@@ -96,7 +105,50 @@ def get_trending_fields_of_study(session: Session, offset: int = 0, limit: int =
     qs = """
             AND fos.name ILIKE :search
         """
-    if sort in sortable:
+
+    if trending_snapshot.available:
+        # read the precomputed aggregation and ranking, no group by and no window over the trending table
+        total_count = 'count(*) OVER()'
+        if len(search) <= 3:
+            total_count = '(SELECT count(*) FROM trending_field_of_study_rank c WHERE c.duration = :duration)'
+        q = """
+            SELECT """ + entity_columns + """, """ + total_count + """ AS total_count
+            FROM trending_field_of_study_rank t
+            WHERE duration = :duration
+        """
+        qb = ' ORDER BY  '
+        qs = """
+            AND name ILIKE :search
+        """
+        if cursor is not None:
+            seek_q = "SELECT " + entity_columns + " FROM trending_field_of_study_rank t WHERE duration = :duration "
+            count_q = "SELECT count(*) FROM trending_field_of_study_rank t WHERE duration = :duration "
+            if sort not in sortable:
+                sort = 'score'
+            return keyset_page(session, seek_q, qs, {'duration': duration}, sort, sort, 'id', 'id', order, limit,
+                               cursor, search, count_q, with_count, key_type=int)
+
+    if cursor is not None:
+        # without the snapshot the aggregation and its ranking window are computed once per page, shared by the
+        # seeks of keyset_page, there is no total count window and no offset scan
+        params = {'duration': duration}
+        if len(search) > 3:
+            aggregation += qs
+            params['search'] = '%' + search + '%'
+        aggregation += '  GROUP BY fos.id '
+        ranked = """
+            WITH ranked AS (SELECT ROW_NUMBER () OVER (ORDER BY score DESC) as trending_ranking, * FROM (
+            """ + aggregation + """) g)
+        """
+        if sort not in sortable:
+            sort = 'score'
+        return keyset_page(session, 'SELECT * FROM ranked WHERE TRUE ', '', params, sort, sort, 'id', 'id', order,
+                           limit, cursor, '', 'SELECT count(*) FROM ranked', with_count, ranked, int)
+
+    relevance = sort == 'relevance' and len(search) > 3
+    if relevance:
+        qb = qb[:qb.rindex('ORDER BY')] + relevance_order('name')
+    elif sort in sortable:
         qb += sort + ' '
     else:
         qb += 'score '
@@ -117,6 +169,9 @@ def get_trending_fields_of_study(session: Session, offset: int = 0, limit: int =
         q += qb
         # print(q)
         s = text(q).bindparams(bindparam('duration'), bindparam('limit'), bindparam('offset'), bindparam('search'))
+        if relevance:
+            params['term'] = search
+            s = s.bindparams(bindparam('term'))
     else:
         q += qb
         # print(q)
@@ -0,0 +1,113 @@
+"""Flux Cache
+ cache for flux queries truncating their range to date.truncate(t: now(), unit: _window_time), their result can not
+ change before the next window boundary so an entry expires exactly there. Identical concurrent queries are
+ coalesced into one influx query (single-flight).
+"""
+import asyncio
+import os
+import time
+from collections import OrderedDict
+
+from sqlalchemy.util import await_only
+
+# read in flux cache config
+FLUX_CACHE_ENABLED = os.environ.get('FLUX_CACHE_ENABLED', '1') not in ('0', 'false', 'False')
+FLUX_CACHE_MAX_ENTRIES = int(os.environ.get('FLUX_CACHE_MAX_ENTRIES', 1024))
+
+
+class FluxCache(object):
+    """
+    window aligned cache of flux results, the window start is part of the key and the entry expires at the window end
+
+    the daos run as greenlets on the event loop (see app.daos.database.GreenletQueryApi), so waiting for a running
+    query awaits its future instead of blocking the worker
+
+    - **max_entries**: number of cached results, the least recently used one is dropped first
+    """
+
+    def __init__(self, max_entries=1024, enabled=True):
+        self.max_entries = max_entries
+        self.enabled = enabled
+        self.entries = OrderedDict()
+        self.inflight = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def window(window_size, now=None):
+        """ start and end (unix seconds) of the window containing now, aligned like flux date.truncate """
+        size = window_size.total_seconds()
+        if now is None:
+            now = time.time()
+        start = now - now % size
+        return start, start + size
+
+    def get_or_query(self, key, window_size, fn):
+        """ cached result of fn for key in the current window, runs fn at most once per window and key """
+        if not self.enabled:
+            return fn()
+
+        start, stop = self.window(window_size)
+        key = key + (start,)
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] > time.time():
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+        future = self.inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return await_only(asyncio.shield(future))
+
+        self.misses += 1
+        try:
+            future = asyncio.get_running_loop().create_future()
+        except RuntimeError:
+            # no event loop (e.g. a script using the blocking client), nothing to coalesce with
+            future = None
+        if future is not None:
+            self.inflight[key] = future
+
+        try:
+            result = fn()
+        except Exception as e:
+            if future is not None:
+                future.set_exception(e)
+                # waiters get the exception, do not warn about an unretrieved one if there were none
+                future.exception()
+            raise
+        finally:
+            self.inflight.pop(key, None)
+
+        self._store(key, stop, result)
+        if future is not None:
+            future.set_result(result)
+        return result
+
+    def clear(self):
+        """ drop all entries """
+        self.entries.clear()
+
+    def stats(self):
+        """ counters of the cache """
+        return {
+            'entries': len(self.entries),
+            'inflight': len(self.inflight),
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+        }
+
+    def _store(self, key, expires, result):
+        now = time.time()
+        for k in [k for k, entry in self.entries.items() if entry[0] <= now]:
+            del self.entries[k]
+        self.entries[key] = (expires, result)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+flux_cache = FluxCache(FLUX_CACHE_MAX_ENTRIES, FLUX_CACHE_ENABLED)
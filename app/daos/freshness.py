@@ -0,0 +1,192 @@
+"""Data Freshness
+ monotonically increasing data version per duration, bumped whenever the data served for the duration changed.
+ The versions are kept in the data_version table so every worker (and every cache, etag or push channel keyed on
+ them) sees the same version. One worker at a time compares a fingerprint per duration every
+ FRESHNESS_CHECK_INTERVAL seconds: with the trending snapshot the fingerprints its views were refreshed with (the
+ version changes once a refresh committed, a refresh of this worker triggers the check immediately), without it the
+ fingerprint (count, max id, score sum) of the trending rows.
+
+    python -m app.daos.freshness
+"""
+import os
+import threading
+
+from sqlalchemy import text
+
+from app.daos.database import engine
+from app.daos.flux_cache import FluxCache
+from app.daos.snapshot import trending_snapshot
+
+# read in freshness config
+FRESHNESS_ENABLED = os.environ.get('FRESHNESS_ENABLED', '1') not in ('0', 'false', 'False')
+FRESHNESS_CHECK_INTERVAL = float(os.environ.get('FRESHNESS_CHECK_INTERVAL', 10))
+
+data_version_table = """
+    CREATE TABLE IF NOT EXISTS data_version (
+        duration varchar PRIMARY KEY,
+        version bigint NOT NULL,
+        fingerprint text,
+        updated_at timestamptz NOT NULL DEFAULT now()
+    )
+"""
+
+# bump the version of every duration whose fingerprint changed, a single statement
+bump_versions = text("""
+    INSERT INTO data_version (duration, version, fingerprint, updated_at)
+        SELECT duration, 1, concat_ws(':', count(*), max(id), sum(score)), now()
+        FROM trending
+        GROUP BY duration
+    ON CONFLICT (duration) DO UPDATE
+        SET version = data_version.version + 1, fingerprint = EXCLUDED.fingerprint, updated_at = EXCLUDED.updated_at
+        WHERE data_version.fingerprint IS DISTINCT FROM EXCLUDED.fingerprint
+""")
+
+
+# the same from the trending fingerprints of the last refresh of every snapshot view (snapshot_state)
+bump_snapshot_versions = text("""
+    INSERT INTO data_version (duration, version, fingerprint, updated_at)
+        SELECT f.key, 1, string_agg(s.name || '=' || f.value, ',' ORDER BY s.name), now()
+        FROM snapshot_state s
+            CROSS JOIN LATERAL jsonb_each_text(CAST(s.fingerprint AS jsonb)) f
+        WHERE s.fingerprint LIKE '{%'
+        GROUP BY f.key
+    ON CONFLICT (duration) DO UPDATE
+        SET version = data_version.version + 1, fingerprint = EXCLUDED.fingerprint, updated_at = EXCLUDED.updated_at
+        WHERE data_version.fingerprint IS DISTINCT FROM EXCLUDED.fingerprint
+""")
+
+
+def create_data_version(bind=engine):
+    """ create the data version table if missing """
+    with bind.begin() as connection:
+        print('create data_version')
+        connection.execute(text(data_version_table))
+
+
+class DataFreshness(object):
+    """
+    data version and last change per duration, read by the caches to drop entries of older data
+
+    - **available**: versions are only tracked if the data_version table exists, version() returns 0 otherwise
+    """
+    lock_key = 'data_freshness'
+
+    def __init__(self, bind, check_interval=10.0, enabled=True):
+        self.bind = bind
+        self.check_interval = check_interval
+        self.enabled = enabled
+        self.available = False
+        # duration -> (version, updated_at), replaced as a whole on every check
+        self.versions = {}
+        self.checks = 0
+        self.changes = 0
+        # functions called with the set of changed durations after a check
+        self.listeners = []
+
+        self.wake = threading.Event()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def version(self, duration):
+        """ current data version of a duration, 0 if unknown """
+        return self.versions.get(duration, (0, None))[0]
+
+    def version_key(self, duration, window_size):
+        """ key of the current data of a duration, the window start while versions are not tracked """
+        if self.available:
+            return 'v%d' % self.version(duration)
+        return 'w%d' % FluxCache.window(window_size)[0]
+
+    def updated(self, duration):
+        """ time of the last change of a duration, None if unknown """
+        return self.versions.get(duration, (0, None))[1]
+
+    def listen(self, listener):
+        """ call listener(durations) whenever the versions of durations changed """
+        if listener not in self.listeners:
+            self.listeners.append(listener)
+
+    def notify(self, duration=None):
+        """ the pipeline announced new data, check now instead of at the next interval """
+        self.wake.set()
+
+    def snapshot_refreshed(self, names):
+        """ snapshot views were refreshed, check now """
+        self.notify()
+
+    def check(self):
+        """ bump the versions of changed durations (one worker at a time) and read all versions """
+        with self.bind.begin() as connection:
+            locked = connection.execute(text('SELECT pg_try_advisory_xact_lock(hashtext(:key))'),
+                                        {'key': self.lock_key}).scalar()
+            if locked:
+                # the snapshot is read instead of trending, its data changes once a refresh committed
+                connection.execute(bump_snapshot_versions if trending_snapshot.available else bump_versions)
+            rows = connection.execute(text('SELECT duration, version, updated_at FROM data_version')).fetchall()
+        versions = {row.duration: (row.version, row.updated_at) for row in rows}
+        changed = {duration for duration, (version, _) in versions.items() if version != self.version(duration)}
+        self.changes += len(changed & set(self.versions))
+        self.versions = versions
+        self.checks += 1
+        if changed:
+            for listener in self.listeners:
+                try:
+                    listener(changed)
+                except Exception as e:
+                    print('data freshness listener failed: %s' % e)
+        return versions
+
+    def stats(self):
+        """ counters of the tracker """
+        return {'durations': len(self.versions), 'checks': self.checks, 'changes': self.changes}
+
+    def start(self):
+        """ check that the table exists, read the versions and start the check thread """
+        if not self.enabled:
+            return
+        try:
+            with self.bind.connect() as connection:
+                exists = connection.execute(text("SELECT to_regclass('data_version')")).scalar() is not None
+            if exists:
+                self.check()
+        except Exception as e:
+            print('data freshness check failed: %s' % e)
+            return
+
+        if not exists:
+            print('data freshness missing data_version, run python -m app.daos.freshness')
+            return
+
+        self.available = True
+        trending_snapshot.listen(self.snapshot_refreshed)
+        if self.thread and self.thread.is_alive():
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, name='data-freshness', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """ stop the check thread """
+        self.stop_event.set()
+        self.wake.set()
+        if self.thread:
+            self.thread.join(self.check_interval)
+            self.thread = None
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            self.wake.wait(self.check_interval)
+            self.wake.clear()
+            if self.stop_event.is_set():
+                return
+            try:
+                self.check()
+            except Exception as e:
+                print('data freshness check failed: %s' % e)
+
+
+data_freshness = DataFreshness(engine, FRESHNESS_CHECK_INTERVAL, FRESHNESS_ENABLED)
+
+
+if __name__ == '__main__':
+    create_data_version()
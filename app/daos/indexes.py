@@ -0,0 +1,55 @@
+"""Indexes
+ indexes the api queries rely on, the tables are owned by the streaming pipeline so they are created idempotent
+ on start (see prestart.sh) instead of in the models. Indexes are built concurrently so the pipeline keeps writing
+ while they are created, a build that failed half way leaves an invalid index that is dropped and built again.
+
+    python -m app.daos.indexes
+"""
+import re
+
+from sqlalchemy import text
+
+from app.daos.database import engine
+
+indexes = [
+    # rank lookups count the publications with a higher score for a duration, keyset pages seek (score, doi)
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS trending_duration_score_doi_idx "
+    "ON trending (duration, score, publication_doi)",
+    # discussion values of a publication (top lists and percentages per doi)
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS discussion_data_point_doi_idx "
+    "ON discussion_data_point (publication_doi)",
+    # title/name search with ILIKE '%term%' and similarity()
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS publication_title_trgm_idx "
+    "ON publication USING gin (title gin_trgm_ops)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS author_name_trgm_idx ON author USING gin (name gin_trgm_ops)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS field_of_study_name_trgm_idx "
+    "ON field_of_study USING gin (name gin_trgm_ops)",
+]
+
+
+invalid_index = """
+    SELECT 1 FROM pg_index i JOIN pg_class c on c.oid = i.indexrelid
+    WHERE c.relname = :name AND NOT i.indisvalid
+"""
+
+
+def create_indexes(bind=engine):
+    """ create all missing indexes, one statement per transaction (autocommit, a concurrent build can not run in a
+        transaction block) so one failure (e.g. no pg_trgm) keeps the others """
+    autocommit = bind.execution_options(isolation_level='AUTOCOMMIT')
+    for statement in indexes:
+        print(statement)
+        try:
+            with autocommit.connect() as connection:
+                index = re.match(r'CREATE INDEX CONCURRENTLY IF NOT EXISTS (\w+)', statement)
+                if index and connection.execute(text(invalid_index), {'name': index.group(1)}).scalar():
+                    print('drop invalid index ' + index.group(1))
+                    connection.execute(text('DROP INDEX CONCURRENTLY IF EXISTS ' + index.group(1)))
+                connection.execute(text(statement))
+        except Exception as e:
+            print('failed: %s' % e)
+
+
+if __name__ == '__main__':
+    create_indexes()
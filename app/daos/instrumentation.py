@@ -0,0 +1,136 @@
+"""Instrumentation
+ timing of every postgresql statement (sqlalchemy engine events) and flux query, tagged with the dao function and
+ the route template of the request. Queries slower than SLOW_QUERY_MS are logged with their normalized query and the
+ shape of their parameters, the timings of a request can be returned as Server-Timing header (QUERY_TIMING_HEADER).
+"""
+import logging
+import os
+import re
+import sys
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app.daos.metrics import metrics
+
+# read in instrumentation config
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 500))
+QUERY_TIMING_HEADER = os.environ.get('QUERY_TIMING_HEADER', '0') not in ('0', 'false', 'False')
+
+logger = logging.getLogger('app.slow_query')
+
+# timings (kind, dao, ms) and route of the current request, set by the middleware in main
+request_timings = ContextVar('request_timings', default=None)
+request_route = ContextVar('request_route', default='')
+
+# modules that run queries for a dao but are not the dao itself
+skipped_modules = ('app.daos.instrumentation', 'app.daos.database', 'app.daos.pagination', 'app.daos.flux_cache')
+
+
+def start_request(route):
+    """ collect the query timings of the current request, route is the template of the matching route (bounded) """
+    timings = []
+    request_timings.set(timings)
+    request_route.set(route)
+    return timings
+
+
+def dao_name():
+    """ name of the innermost app.daos function on the stack """
+    frame = sys._getframe(2)
+    while frame is not None:
+        module = frame.f_globals.get('__name__', '')
+        if module.startswith('app.daos.') and module not in skipped_modules:
+            return module[len('app.daos.'):] + '.' + frame.f_code.co_name
+        frame = frame.f_back
+    return 'unknown'
+
+
+def normalize(query):
+    """ query on one line with inlined literals (dois, names, numbers) replaced, columns like r["doi"] and imports stay """
+    query = re.sub(r"'(?:[^']|'')*'", "'?'", query)
+    query = re.sub(r'(\["[^"]*"\]|import "[^"]*")|"(?:[^"\\]|\\.)*"', lambda m: m.group(1) or '"?"', query)
+    query = re.sub(r'\b\d+(\.\d+)?\b', '?', query)
+    query = ' '.join(query.split())
+    # doi sets of doi_filter_list
+    return re.sub(r'(\{key: "\?", value: true\}(, )?)+', '{key: "?", value: true}, ...', query)
+
+
+def param_shape(params):
+    """ parameter names with their type (and length of lists), never the values """
+    if isinstance(params, (list, tuple)) and params and isinstance(params[0], (dict, list, tuple)):
+        # executemany, the first parameter set
+        params = params[0]
+    if isinstance(params, dict):
+        return {key: value_shape(value) for key, value in params.items()}
+    if isinstance(params, (list, tuple)):
+        # positional parameters (e.g. asyncpg)
+        return [value_shape(value) for value in params]
+    return type(params).__name__
+
+
+def value_shape(value):
+    shape = type(value).__name__
+    if isinstance(value, (list, tuple, set)):
+        shape += '[%d]' % len(value)
+    return shape
+
+
+def record(kind, query, params, duration_ms, dao=None):
+    """ store the timing for the current request and log slow queries """
+    if dao is None:
+        dao = dao_name()
+    timings = request_timings.get()
+    if timings is not None:
+        timings.append((kind, dao, duration_ms))
+    metrics.observe('query_duration_seconds', duration_ms / 1000, kind=kind)
+    if duration_ms >= SLOW_QUERY_MS:
+        logger.warning('slow %s query %.0fms route=%s dao=%s query=%s params=%s', kind, duration_ms,
+                       request_route.get(), dao, normalize(query), param_shape(params))
+
+
+@contextmanager
+def timed(kind, query, params=None):
+    """ time a query running in the with block """
+    dao = dao_name()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(kind, query, params, (time.perf_counter() - start) * 1000, dao)
+
+
+def server_timing(timings):
+    """ Server-Timing header value, one entry per query in order """
+    return ', '.join('%s-%d;desc="%s";dur=%.1f' % (kind, i, dao, duration_ms)
+                     for i, (kind, dao, duration_ms) in enumerate(timings))
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info['query_start_time'].pop()
+    record('sql', statement, parameters, (time.perf_counter() - start) * 1000)
+
+
+def handle_error(context):
+    """ a failed statement gets no after_cursor_execute, its start time is removed (and the time until the error
+        recorded) so the list of the pooled connection does not grow """
+    if context.connection is None:
+        return
+    starts = context.connection.info.get('query_start_time')
+    if starts:
+        record('sql', context.statement, context.parameters, (time.perf_counter() - starts.pop()) * 1000)
+
+
+def instrument_engines():
+    """ time the statements of all engines, async engines run their statements on a sync engine as well """
+    if not event.contains(Engine, 'before_cursor_execute', before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+        event.listen(Engine, 'handle_error', handle_error)
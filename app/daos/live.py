@@ -0,0 +1,219 @@
+"""Live Trending
+ pushes compact diffs of the trending tables to the subscribed clients (sse or websocket) whenever the data version
+ of a duration changed (app.daos.freshness), i.e. once the data read by the api changed (with the snapshot after its
+ refresh committed). One kafka consumer per worker listens to the trending updates of the pipeline and only wakes the
+ snapshot and version checks. Subscribers are grouped by (duration, entity), a change runs one query per group with
+ subscribers, no matter how many clients are connected.
+"""
+import asyncio
+import json
+import os
+
+from app.daos.author import get_trending_authors
+from app.daos.database import AsyncSessionLocal
+from app.daos.field_of_study import get_trending_fields_of_study
+from app.daos.freshness import data_freshness
+from app.daos.publication import get_trending_publications
+from app.daos.snapshot import trending_snapshot
+from app.daos.stats import trending_time_definition
+
+# read in live config
+LIVE_ENABLED = os.environ.get('LIVE_ENABLED', '1') not in ('0', 'false', 'False')
+LIVE_TOPIC = os.environ.get('LIVE_TOPIC', 'trending')
+LIVE_LIMIT = int(os.environ.get('LIVE_LIMIT', 10))
+LIVE_QUEUE_SIZE = int(os.environ.get('LIVE_QUEUE_SIZE', 16))
+kafka_server = os.environ.get('KAFKA_BOOTRSTRAP_SERVER', 'kafka:9092')
+
+# trending query and row key of each entity
+live_entities = {
+    'publication': (lambda s, duration, limit: get_trending_publications(
+        s, offset=0, limit=limit, sort='score', order='desc', duration=duration), 'doi'),
+    'author': (lambda s, duration, limit: get_trending_authors(
+        s, offset=0, limit=limit, sort='score', order='desc', duration=duration), 'id'),
+    'fieldOfStudy': (lambda s, duration, limit: get_trending_fields_of_study(
+        s, offset=0, limit=limit, sort='score', order='desc', duration=duration), 'id'),
+}
+
+
+def diff_rows(old, new, key):
+    """
+    compact diff between two trending tables: changed or new rows, removed keys and the new order of the keys
+    """
+    old_rows = {row[key]: row for row in old}
+    return {
+        'changed': [row for row in new if old_rows.get(row[key]) != row],
+        'removed': [k for k in old_rows if k not in {row[key] for row in new}],
+        'order': [row[key] for row in new],
+    }
+
+
+class TrendingHub(object):
+    """
+    fan out of trending updates to the subscribers of each (duration, entity) group, changes of the data versions of
+    a burst are collected while a refresh runs, so every group is queried at most once at a time
+
+    - **limit**: number of trending rows pushed per group
+    """
+
+    def __init__(self, topic, bootstrap_servers, limit=10, queue_size=16, enabled=True):
+        self.topic = topic
+        self.bootstrap_servers = bootstrap_servers
+        self.limit = limit
+        self.queue_size = queue_size
+        self.enabled = enabled
+
+        # (duration, entity) -> set of subscriber queues
+        self.groups = {}
+        # (duration, entity) -> last rows sent to the group
+        self.state = {}
+        # durations to refresh, None for all
+        self.pending = set()
+        self.changed = None
+        self.loop = None
+        self.task = None
+        self.refresher = None
+        self.refreshes = 0
+
+    async def start(self):
+        """ start the refresh task following the data versions and the kafka consumer task """
+        if not self.enabled or self.task:
+            return
+        self.loop = asyncio.get_running_loop()
+        self.changed = asyncio.Event()
+        data_freshness.listen(self.versions_changed)
+        self.refresher = self.loop.create_task(self._refresh_changed())
+        self.task = self.loop.create_task(self._consume())
+
+    async def stop(self):
+        """ stop the consumer and refresh tasks """
+        for task in (self.task, self.refresher):
+            if task:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self.task = None
+        self.refresher = None
+
+    def versions_changed(self, durations):
+        """ data freshness listener (called on its thread), the groups of the durations are refreshed on the loop """
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.schedule, durations)
+
+    def schedule(self, durations):
+        """ refresh the groups of the durations (None refreshes all) with the next run of the refresh task """
+        self.pending.update(durations)
+        self.changed.set()
+
+    async def subscribe(self, duration, entity):
+        """ queue receiving the messages of a group, the first message is the current table """
+        if duration not in trending_time_definition or entity not in live_entities:
+            raise ValueError('unknown duration or entity')
+        group = (duration, entity)
+        if group not in self.state:
+            self.state[group] = await self._query(group)
+        queue = asyncio.Queue(self.queue_size)
+        queue.put_nowait(self._snapshot(group))
+        self.groups.setdefault(group, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, duration, entity, queue):
+        """ remove a subscriber, the state of a group without subscribers is dropped """
+        group = (duration, entity)
+        subscribers = self.groups.get(group, set())
+        subscribers.discard(queue)
+        if not subscribers:
+            self.groups.pop(group, None)
+            self.state.pop(group, None)
+
+    def stats(self):
+        """ counters of the hub """
+        return {
+            'groups': len(self.groups),
+            'subscribers': sum(len(queues) for queues in self.groups.values()),
+            'refreshes': self.refreshes,
+        }
+
+    async def refresh(self, durations=None):
+        """ query every group with subscribers (of the given durations) once and push the diff """
+        for group in list(self.groups):
+            if durations is not None and group[0] not in durations:
+                continue
+            rows = await self._query(group)
+            old = self.state.get(group, [])
+            self.state[group] = rows
+            if rows == old:
+                continue
+            message = {'type': 'diff', 'duration': group[0], 'entity': group[1]}
+            message.update(diff_rows(old, rows, live_entities[group[1]][1]))
+            for queue in list(self.groups.get(group, ())):
+                if queue.full():
+                    # slow client, replace its backlog with the complete table
+                    while not queue.empty():
+                        queue.get_nowait()
+                    queue.put_nowait(self._snapshot(group))
+                else:
+                    queue.put_nowait(message)
+        self.refreshes += 1
+
+    def _snapshot(self, group):
+        return {'type': 'snapshot', 'duration': group[0], 'entity': group[1], 'results': self.state.get(group, [])}
+
+    async def _query(self, group):
+        duration, entity = group
+        query = live_entities[entity][0]
+        async with AsyncSessionLocal() as session:
+            rows = await session.run_sync(lambda s: query(s, duration, self.limit))
+        # the replica returns dicts already
+        return [row if isinstance(row, dict) else row._asdict() for row in rows]
+
+    async def _refresh_changed(self):
+        while True:
+            await self.changed.wait()
+            self.changed.clear()
+            pending, self.pending = self.pending, set()
+            try:
+                await self.refresh(None if None in pending else pending)
+            except Exception as e:
+                print('live trending refresh failed: %s' % e)
+
+    async def _consume(self):
+        from aiokafka import AIOKafkaConsumer
+
+        while True:
+            consumer = AIOKafkaConsumer(self.topic, bootstrap_servers=self.bootstrap_servers, group_id=None,
+                                        auto_offset_reset='latest')
+            try:
+                await consumer.start()
+                while True:
+                    batch = await consumer.getmany(timeout_ms=1000)
+                    durations = {message_duration(message.value)
+                                 for messages in batch.values() for message in messages}
+                    if not durations:
+                        continue
+                    # the groups are refreshed once the data version changed, not before the snapshot is refreshed
+                    trending_snapshot.notify()
+                    data_freshness.notify()
+                    if not data_freshness.available:
+                        # no versions to follow, query right away
+                        self.schedule(durations)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print('live trending consumer failed: %s' % e)
+                await asyncio.sleep(5)
+            finally:
+                await consumer.stop()
+
+
+def message_duration(value):
+    """ duration of an update message, None if the message does not name one (refresh all durations) """
+    try:
+        duration = json.loads(value).get('duration')
+    except (TypeError, ValueError, AttributeError):
+        return None
+    return duration if duration in trending_time_definition else None
+
+
+live_hub = TrendingHub(LIVE_TOPIC, kafka_server, LIVE_LIMIT, LIVE_QUEUE_SIZE, LIVE_ENABLED)
@@ -0,0 +1,270 @@
+"""Metrics
+ in process latency histograms per route template and status, query counts and durations per kind (sql, flux),
+ database pool, cache and telemetry stats, rendered in the prometheus text format.
+
+ Every gunicorn worker writes its metrics to METRICS_DIR (a json file per pid) every METRICS_FLUSH_INTERVAL
+ seconds, a scrape of any worker sums the files of all workers. Counters and histograms of exited workers are folded
+ into one exited.json (under a file lock) on every scrape and worker start, so the number of files stays bounded by
+ the running workers, gauges are only read from running workers. Histograms have fixed buckets, so the memory per
+ route is constant.
+"""
+import fcntl
+import json
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+
+# read in metrics config
+METRICS_DIR = os.environ.get('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'amba_metrics'))
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 10))
+
+# upper bounds in seconds, roughly logarithmic from 1ms to 30s
+latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# help text and type of each metric
+metric_types = {
+    'http_request_duration_seconds': ('histogram', 'request latency per route template, method and status'),
+    'query_duration_seconds': ('histogram', 'query latency per kind (sql, flux)'),
+}
+
+# file holding the summed counters and histograms of all exited workers
+EXITED_FILE = 'exited.json'
+
+
+class Metrics(object):
+    """
+    counters, histograms and gauge collectors of one worker
+
+    - **buckets**: upper bounds of the histogram buckets
+    """
+
+    def __init__(self, directory, buckets=latency_buckets, flush_interval=10.0):
+        self.directory = directory
+        self.buckets = buckets
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        # name -> labels (json) -> bucket counts, sum, count
+        self.histograms = {}
+        # name -> labels (json) -> value
+        self.counters = {}
+        # name -> function returning {labels (json): value}
+        self.collectors = {}
+
+        self.pid = os.getpid()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    @staticmethod
+    def labels(**labels):
+        """ key of a label set """
+        return json.dumps(labels, sort_keys=True)
+
+    def observe(self, name, seconds, **labels):
+        """ add a value to a histogram """
+        key = self.labels(**labels)
+        with self.lock:
+            series = self.histograms.setdefault(name, {}).get(key)
+            if series is None:
+                series = self.histograms[name][key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += seconds
+            series[-1] += 1
+
+    def inc(self, name, value=1, **labels):
+        """ increase a counter """
+        key = self.labels(**labels)
+        with self.lock:
+            counters = self.counters.setdefault(name, {})
+            counters[key] = counters.get(key, 0) + value
+
+    def register(self, name, collector):
+        """ gauge evaluated on every flush, collector returns {labels key: value} """
+        self.collectors[name] = collector
+
+    def snapshot(self):
+        """ json serializable state of this worker """
+        gauges = {}
+        for name, collector in self.collectors.items():
+            try:
+                gauges[name] = collector()
+            except Exception as e:
+                print('metrics collector %s failed: %s' % (name, e))
+        with self.lock:
+            return {
+                'pid': self.pid,
+                'histograms': {name: {k: list(v) for k, v in series.items()}
+                               for name, series in self.histograms.items()},
+                'counters': {name: dict(series) for name, series in self.counters.items()},
+                'gauges': gauges,
+            }
+
+    def flush(self):
+        """ write the state of this worker, replaced atomically so a scrape never reads a partial file """
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, '%d.json' % self.pid)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp, path)
+
+    def start(self):
+        """ keep the counters of a previous worker with the same pid and start flushing """
+        self.pid = os.getpid()
+        with self.directory_lock():
+            self.compact(previous=self.pid)
+        if self.thread and self.thread.is_alive():
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, name='metrics-flush', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """ stop flushing, the last state stays on disk for the counters """
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join(self.flush_interval)
+            self.thread = None
+        self.flush()
+
+    @contextmanager
+    def directory_lock(self):
+        """ exclusive lock of the metrics directory between the workers, held while compacting or reading all files """
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def compact(self, previous=None):
+        """
+        fold the files of exited workers into EXITED_FILE and remove them, call with the directory lock held
+
+        - **previous**: pid of this worker, its file was left by an exited worker with the same pid
+        """
+        exited = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.json') and name[:-5].isdigit():
+                pid = int(name[:-5])
+                if pid == previous or (pid != self.pid and not pid_running(pid)):
+                    exited.append(name)
+        if not exited:
+            return
+
+        state = read_state(os.path.join(self.directory, EXITED_FILE)) or {'histograms': {}, 'counters': {}}
+        for name in exited:
+            worker = read_state(os.path.join(self.directory, name))
+            if worker:
+                merge_state(state['histograms'], state['counters'], worker)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'histograms': state['histograms'], 'counters': state['counters']}, f)
+        os.replace(tmp, os.path.join(self.directory, EXITED_FILE))
+        for name in exited:
+            os.remove(os.path.join(self.directory, name))
+
+    def merged(self):
+        """ sum of the state of all workers """
+        self.flush()
+        with self.directory_lock():
+            self.compact()
+            states = [(name, read_state(os.path.join(self.directory, name)))
+                      for name in os.listdir(self.directory) if name.endswith('.json')]
+        histograms, counters, gauges = {}, {}, {}
+        for name, state in states:
+            if state is None:
+                continue
+            merge_state(histograms, counters, state)
+            if name != EXITED_FILE and pid_running(state['pid']):
+                for metric, series in state['gauges'].items():
+                    merged = gauges.setdefault(metric, {})
+                    for key, value in series.items():
+                        merged[key] = merged.get(key, 0) + value
+        return histograms, counters, gauges
+
+    def render(self):
+        """ metrics of all workers in the prometheus text format """
+        histograms, counters, gauges = self.merged()
+        lines = []
+        for name in sorted(histograms):
+            metric_type, description = metric_types.get(name, ('histogram', name))
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s histogram' % name)
+            for key in sorted(histograms[name]):
+                labels = json.loads(key)
+                values = histograms[name][key]
+                cumulative = 0
+                for bound, count in zip(self.buckets, values):
+                    cumulative += count
+                    lines.append('%s_bucket%s %d' % (name, format_labels(labels, le=repr(bound)), cumulative))
+                lines.append('%s_bucket%s %d' % (name, format_labels(labels, le='+Inf'), values[-1]))
+                lines.append('%s_sum%s %s' % (name, format_labels(labels), repr(values[-2])))
+                lines.append('%s_count%s %d' % (name, format_labels(labels), values[-1]))
+        for metric_type, metrics in (('counter', counters), ('gauge', gauges)):
+            for name in sorted(metrics):
+                lines.append('# TYPE %s %s' % (name, metric_type))
+                for key in sorted(metrics[name]):
+                    lines.append('%s%s %s' % (name, format_labels(json.loads(key)), repr(metrics[name][key])))
+        return '\n'.join(lines) + '\n'
+
+    def _run(self):
+        while not self.stop_event.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print('metrics flush failed: %s' % e)
+
+
+def format_labels(labels, **extra):
+    """ prometheus label set, e.g. {route="/trending",status="200"} """
+    labels = dict(labels, **extra)
+    if not labels:
+        return ''
+    escaped = ('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for k, v in sorted(labels.items()))
+    return '{' + ','.join(escaped) + '}'
+
+
+def read_state(path):
+    """ state written by flush or compact, None if missing or unreadable """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def merge_state(histograms, counters, state):
+    """ add the histograms and counters of a state """
+    for metric, series in state['histograms'].items():
+        merged = histograms.setdefault(metric, {})
+        for key, values in series.items():
+            if key in merged:
+                merged[key] = [a + b for a, b in zip(merged[key], values)]
+            else:
+                merged[key] = values
+    for metric, series in state['counters'].items():
+        merged = counters.setdefault(metric, {})
+        for key, value in series.items():
+            merged[key] = merged.get(key, 0) + value
+
+
+def pid_running(pid):
+    """ True if a process with this pid exists """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def stats_gauges(stats, **labels):
+    """ collector result of a stats() dict, one label set per stat """
+    return {Metrics.labels(stat=stat, **labels): value for stat, value in stats.items()}
+
+
+metrics = Metrics(METRICS_DIR, latency_buckets, METRICS_FLUSH_INTERVAL)
@@ -0,0 +1,122 @@
+"""Keyset Pagination
+ seek based paging for the trending tables, a page is requested with an opaque cursor holding the sort value and the
+ doi/id tie-breaker of the last row of the previous page, so page n costs the same as page 1
+"""
+import base64
+import json
+import math
+from decimal import Decimal
+
+from sqlalchemy import text, bindparam
+from sqlalchemy.orm import Session
+
+
+def encode_cursor(value, key):
+    """ encode sort value and tie-breaker into an url safe cursor """
+    if isinstance(value, Decimal):
+        # the cursor value is bound as double precision, see keyset_page
+        value = float(value)
+    raw = json.dumps([value, key], separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+class InvalidCursor(ValueError):
+    """ a cursor that was not issued by keyset_page for this table """
+
+
+def decode_cursor(cursor, key_type=str):
+    """
+    decode a cursor, an empty cursor starts at the first page (returns None), raises InvalidCursor if invalid
+
+    - **key_type**: type of the tie-breaker, str for dois and int for author/field of study ids, a key of another
+        type is converted if possible
+    """
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        value, key = json.loads(raw.decode('utf-8'))
+    except Exception:
+        raise InvalidCursor('invalid cursor')
+    # the sort value is a finite number (None for rows without one)
+    if isinstance(value, bool) or not (value is None or isinstance(value, (int, float))):
+        raise InvalidCursor('invalid cursor value')
+    if value is not None and not math.isfinite(value):
+        raise InvalidCursor('invalid cursor value')
+    if isinstance(key, bool) or not isinstance(key, (int, str)):
+        raise InvalidCursor('invalid cursor key')
+    try:
+        key = key_type(key)
+    except ValueError:
+        raise InvalidCursor('invalid cursor key')
+    return value, key
+
+
+def keyset_page(session: Session, q, qs, params, sort_expr, sort_name, key_expr, key_name, order='desc', limit=10,
+                cursor='', search='', count_q=None, with_count=False, cte='', key_type=str):
+    """
+    run a trending query in keyset mode (postgresql only), rows without a sort value come last in both orders
+
+    The rows with a sort value and the rows without one are read by two seeks, each a range of a (duration, sort,
+    key) index if the sort column has one, only the two pages of at most limit rows are merged.
+
+    - **q**: select including the base where clause, must not contain window functions over the whole set
+    - **qs**: search clause appended if the search term is long enough (uses :search)
+    - **sort_expr**, **key_expr**: sql expressions used to sort and seek, the raw (indexed) columns
+    - **sort_name**, **key_name**: names of these values in the result rows (used to build the next cursor)
+    - **count_q**: optional count query on the same filter, only executed if **with_count** is set
+    - **cte**: optional with clause the queries read from, computed once per statement
+    - **key_type**: type of the tie-breaker (str or int), see decode_cursor
+    """
+    direction = ' DESC ' if order == 'desc' else ' ASC '
+    comparison = ' < ' if order == 'desc' else ' > '
+
+    params = dict(params)
+    params['limit'] = limit
+    binds = [bindparam(p) for p in params]
+
+    if len(search) > 3:
+        params['search'] = '%' + search + '%'
+        binds.append(bindparam('search'))
+        q += qs
+        if count_q:
+            count_q += qs
+
+    count_params = dict(params)
+    count_params.pop('limit')
+
+    value_q = q + ' AND ' + sort_expr + ' IS NOT NULL '
+    null_q = q + ' AND ' + sort_expr + ' IS NULL '
+    position = decode_cursor(cursor, key_type)
+    if position:
+        value, params['cursor_key'] = position
+        binds.append(bindparam('cursor_key'))
+        if value is None:
+            # the previous page already ended in the rows without a sort value
+            value_q = None
+            null_q += ' AND ' + key_expr + comparison + ':cursor_key '
+        else:
+            # an explicit type, the value of a numeric column arrives as float
+            value_q += (' AND (' + sort_expr + ', ' + key_expr + ')' + comparison
+                        + '(CAST(:cursor_value AS double precision), :cursor_key) ')
+            params['cursor_value'] = value
+            binds.append(bindparam('cursor_value'))
+
+    seeks = ['SELECT * FROM (' + null_q + ' ORDER BY ' + key_expr + direction + ' LIMIT :limit) without_value']
+    if value_q:
+        seeks.insert(0, 'SELECT * FROM (' + value_q + ' ORDER BY ' + sort_expr + direction + ', ' + key_expr
+                     + direction + ' LIMIT :limit) with_value')
+    page_q = (cte + ' SELECT * FROM (' + ' UNION ALL '.join(seeks) + ') page ORDER BY ' + sort_name + ' IS NULL, '
+              + sort_name + direction + ', ' + key_name + direction + ' LIMIT :limit ')
+    rows = session.execute(text(page_q).bindparams(*binds), params).fetchall()
+
+    next_cursor = None
+    if len(rows) == limit and limit > 0:
+        last = rows[-1]
+        next_cursor = encode_cursor(last[sort_name], last[key_name])
+
+    total_count = None
+    if with_count and count_q:
+        total_count = session.execute(text(cte + ' ' + count_q), count_params).scalar()
+
+    return {'results': rows, 'next_cursor': next_cursor, 'total_count': total_count}
@@ -1,7 +1,148 @@
-from sqlalchemy import text, bindparam
+from functools import lru_cache
+from typing import List, Optional
+
+from sqlalchemy import text, bindparam, Integer
+from sqlalchemy.dialects.postgresql import JSON
 from event_stream.models.model import Publication, PublicationAuthor
 from sqlalchemy.orm import Session
 
+from app.daos.pagination import keyset_page
+from app.daos.replica import trending_replica
+from app.daos.search import relevance_order
+from app.daos.snapshot import trending_snapshot
+
+# sortable columns of the trending publication queries
+publication_sortable = ['trending_ranking', 'score', 'count', 'mean_sentiment', 'sum_followers', 'abstract_difference',
+                        'mean_age', 'mean_length', 'mean_questions', 'mean_exclamations', 'mean_bot_rating',
+                        'projected_change', 'trending', 'ema', 'kama', 'ker', 'mean_score', 'stddev', 'year',
+                        'citation_count']
+
+# trending columns of a publication, t is the trending table (or its snapshot) and p the publication
+trending_columns = """p.*, t.score, count, mean_sentiment, sum_followers, abstract_difference, mean_age, mean_length,
+            mean_questions, mean_exclamations, mean_bot_rating, projected_change, trending, ema, kama, ker, mean_score,
+            stddev"""
+
+# filters restricting the trending publications: membership table, its id column and the bind parameter of the id
+publication_filters = {
+    'all': None,
+    'field_of_study': ('publication_field_of_study', 'field_of_study_id', 'fos_id'),
+    'author': ('publication_author', 'author_id', 'author_id'),
+}
+
+
+def publication_filter(filter_name, doi_column='t.publication_doi'):
+    """
+    join, where condition and bind parameter restricting the publications of doi_column to the members of a filter,
+    the membership table is joined as m
+    """
+    if publication_filters[filter_name] is None:
+        return '', '', None
+    table, column, param = publication_filters[filter_name]
+    return (' JOIN ' + table + ' m on m.publication_doi = ' + doi_column + ' ',
+            ' AND m.' + column + ' = :' + param + ' ', param)
+
+
+@lru_cache(maxsize=None)
+def cached_text(query, *binds):
+    """ text statement with its bind parameters, built once per query string and reused between requests """
+    return text(query).bindparams(*[bindparam(b) for b in binds])
+
+
+@lru_cache(maxsize=None)
+def trending_publication_statement(filter_name='all', sort='score', order='desc', search=False, relevance=False,
+                                   snapshot=False):
+    """
+    statement of a trending publication query variant (filter x sort x order x search), built once per variant, the
+    variants are bounded since sort and order are checked by trending_publication_variant
+
+    - **snapshot**: read the global ranking from the snapshot, only used without a filter
+    """
+    join, where, param = publication_filter(filter_name)
+    if snapshot and filter_name == 'all':
+        # without search the total count is an index only count
+        total_count = 'count(*) OVER()'
+        if not search:
+            total_count = '(SELECT count(*) FROM trending_publication_rank c WHERE c.duration = :duration)'
+        q = """
+            SELECT t.trending_ranking, """ + trending_columns + """, """ + total_count + """ AS total_count
+            FROM trending_publication_rank t
+            JOIN publication p on p.doi = t.publication_doi
+            WHERE duration = :duration
+            """
+    else:
+        q = """
+            SELECT ROW_NUMBER () OVER (ORDER BY score DESC) as trending_ranking, """ + trending_columns + """,
+            count(*) OVER() AS total_count
+            FROM trending t
+            JOIN publication p on p.doi = t.publication_doi
+            """ + join + """
+            WHERE duration = :duration """ + where
+
+    binds = ['duration', 'limit', 'offset']
+    if param:
+        binds.append(param)
+    if search:
+        q += """
+            AND p.title ILIKE :search
+        """
+        binds.append('search')
+    if relevance:
+        q += relevance_order('p.title')
+        binds.append('term')
+    else:
+        q += ' ORDER BY ' + sort + ' '
+    q += ' DESC ' if order == 'desc' else ' ASC '
+    q += """
+            LIMIT :limit OFFSET :offset
+        """
+    return cached_text(q, *binds)
+
+
+@lru_cache(maxsize=None)
+def covid_publication_statement(sort='score', order='desc', search=False):
+    """ statement of a trending covid publication query variant, the view already contains the ranking """
+    q = """
+        SELECT *, count(*) OVER() AS total_count FROM trending_covid_papers
+        WHERE duration = :duration
+        """
+    binds = ['duration', 'limit', 'offset']
+    if search:
+        q += """
+            AND title ILIKE :search
+        """
+        binds.append('search')
+    q += ' ORDER BY ' + sort + (' DESC ' if order == 'desc' else ' ASC ')
+    q += """
+            LIMIT :limit OFFSET :offset
+        """
+    return cached_text(q, *binds)
+
+
+def trending_publication_variant(sort, order, search):
+    """ normalized sort, order and search flags of a request, the key of the statement variants """
+    searching = len(search) > 3
+    relevance = sort == 'relevance' and searching
+    if sort not in publication_sortable:
+        sort = 'score'
+    order = 'desc' if order == 'desc' else 'asc'
+    return sort, order, searching, relevance
+
+
+def query_trending_publications(session: Session, filter_name, params, sort, order, limit, offset, search):
+    """ run the (cached) trending publication statement of a filter for a request, or read the page from the replica """
+    sort, order, searching, relevance = trending_publication_variant(sort, order, search)
+    rows = trending_replica.query(filter_name, params, sort, order, limit, offset, search, searching, relevance)
+    if rows is not None:
+        return rows
+    s = trending_publication_statement(filter_name, sort, order, searching, relevance, trending_snapshot.available)
+
+    params = dict(params, limit=limit, offset=offset)
+    if searching:
+        params['search'] = '%' + search + '%'
+    if relevance:
+        params['term'] = search
+    return session.execute(s, params).fetchall()
+
 
 def query_bottom(session, q, qs, qb, order, limit, offset, search):
     """ query helper adding limit, sorting and search (postgresql only) """
@@ -17,17 +158,66 @@ def query_bottom(session, q, qs, qb, order, limit, offset, search):
     params = {'limit': limit, 'offset': offset}
     if len(search) > 3:
         params['search'] = '%' + search + '%'
-        q += qs
-        q += qb
-        print(q)
-        s = text(q).bindparams(bindparam('limit'), bindparam('offset'), bindparam('search'))
+        s = cached_text(q + qs + qb, 'limit', 'offset', 'search')
     else:
-        q += qb
-        print(q)
-        s = text(q).bindparams(bindparam('limit'), bindparam('offset'))
+        s = cached_text(q + qb, 'limit', 'offset')
     return session.execute(s, params).fetchall()
 
 
+def seek_trending_publications(session: Session, filter_name, params, sort, order, limit, cursor, search,
+                               with_count):
+    """
+    keyset variant of the trending publication queries, the global ranking is read from the snapshot, a filtered set
+    (or the trending table without a snapshot) is ranked by a single window over the set, computed once per page
+
+    - **filter_name**: key of publication_filters restricting the publications (e.g. to a field of study), the
+        filter is also used for the rank
+    """
+    join, where, param = publication_filter(filter_name)
+
+    if sort == 'trending_ranking':
+        # ranking ascending is score descending
+        sort = 'score'
+        order = 'asc' if order == 'desc' else 'desc'
+    if sort not in publication_sortable:
+        sort = 'score'
+
+    if filter_name == 'all' and trending_snapshot.available:
+        # the page is a range of the (duration, score, publication_doi) index of the snapshot
+        q = """
+            SELECT t.trending_ranking, """ + trending_columns + """
+            FROM trending_publication_rank t
+                JOIN publication p on p.doi = t.publication_doi
+                WHERE duration = :duration """
+        count_q = """
+            SELECT count(*) FROM trending_publication_rank t
+                JOIN publication p on p.doi = t.publication_doi
+                WHERE duration = :duration """
+        qs = """
+            AND p.title ILIKE :search
+        """
+        sort_expr = ('p.' if sort in ['year', 'citation_count'] else 't.') + sort
+        return keyset_page(session, q, qs, params, sort_expr, sort, 't.publication_doi', 'doi', order, limit, cursor,
+                           search, count_q, with_count)
+
+    params = dict(params)
+    ranked = """
+        SELECT ROW_NUMBER () OVER (ORDER BY t.score DESC) as trending_ranking, """ + trending_columns + """
+        FROM trending t
+            JOIN publication p on p.doi = t.publication_doi
+            """ + join + """
+            WHERE duration = :duration """ + where
+    if len(search) > 3:
+        # the ranking is a window over the searched set, like in the offset queries
+        ranked += """
+            AND p.title ILIKE :search
+        """
+        params['search'] = '%' + search + '%'
+    return keyset_page(session, 'SELECT * FROM ranked WHERE TRUE ', '', params, sort, sort, 'doi', 'doi', order,
+                       limit, cursor, '', 'SELECT count(*) FROM ranked', with_count,
+                       'WITH ranked AS (' + ranked + ')')
+
+
 def get_publications(session: Session, offset: int = 0, limit: int = 10, sort: str = 'id', order: str = 'asc',
                      search: str = ''):
     """ get publications from postgresql """
@@ -56,244 +246,190 @@ def get_publications(session: Session, offset: int = 0, limit: int = 10, sort: s
 
 
 def get_trending_publications(session: Session, offset: int = 0, limit: int = 10, sort: str = 'score',
-                              order: str = 'desc', duration: str = "currently", search: str = ''):
-    """ get trending publications from postgresql """
-    q = """
-        SELECT ROW_NUMBER () OVER (ORDER BY score DESC) as trending_ranking, p.*, t.score, count, mean_sentiment, sum_followers, abstract_difference, mean_age, mean_length, 
-        mean_questions, mean_exclamations, mean_bot_rating, projected_change, trending, ema, kama, ker, mean_score, 
-        stddev, count(*) OVER() AS total_count  FROM trending t
-        JOIN publication p on p.doi = t.publication_doi
-        WHERE duration = :duration
-        """
-
-    qs = """
-        AND p.title ILIKE :search
-    """
-
-    sortable = ['trending_ranking', 'score', 'count', 'mean_sentiment', 'sum_followers', 'abstract_difference',
-                'mean_age', 'mean_length', 'mean_questions', 'mean_exclamations', 'mean_bot_rating',
-                'projected_change', 'trending', 'ema', 'kama', 'ker', 'mean_score', 'stddev', 'year', 'citation_count']
-
-    qb = ' ORDER BY  '
-    if sort in sortable:
-        qb += sort + ' '
-    else:
-        qb += 'score '
-
-    order_sql = ' ASC '
-    if order == 'desc':
-        order_sql = ' DESC '
-    qb += order_sql
-
-    qb += """
-            LIMIT :limit OFFSET :offset
-        """
+                              order: str = 'desc', duration: str = "currently", search: str = '',
+                              cursor: Optional[str] = None, with_count: bool = False):
+    """ get trending publications from postgresql, uses keyset pagination if a cursor is given """
+    if cursor is not None:
+        return seek_trending_publications(session, 'all', {'duration': duration}, sort, order, limit, cursor,
+                                          search, with_count)
 
-    params = {'duration': duration, 'limit': limit, 'offset': offset}
-    if len(search) > 3:
-        params['search'] = '%' + search + '%'
-        q += qs
-        q += qb
-        # print(q)
-        s = text(q).bindparams(bindparam('duration'), bindparam('limit'), bindparam('offset'), bindparam('search'))
-    else:
-        q += qb
-        # print(q)
-        s = text(q).bindparams(bindparam('duration'), bindparam('limit'), bindparam('offset'))
-    return session.execute(s, params).fetchall()
+    return query_trending_publications(session, 'all', {'duration': duration}, sort, order, limit, offset, search)
 
 
 def get_trending_covid_publications(session: Session, offset: int = 0, limit: int = 10, sort: str = 'score',
-                              order: str = 'desc', duration: str = "currently", search: str = ''):
-    """ get trending covid publications from postgresql """
-    q = """
-        SELECT *, count(*) OVER() AS total_count FROM trending_covid_papers
-        WHERE duration = :duration
-        """
-
-    qs = """
-        AND title ILIKE :search
-    """
-
-    sortable = ['trending_ranking', 'score', 'count', 'mean_sentiment', 'sum_followers', 'abstract_difference',
-                'mean_age', 'mean_length', 'mean_questions', 'mean_exclamations', 'mean_bot_rating',
-                'projected_change', 'trending', 'ema', 'kama', 'ker', 'mean_score', 'stddev', 'year', 'citation_count']
-
-    qb = ' ORDER BY  '
-    if sort in sortable:
-        qb += sort + ' '
-    else:
-        qb += 'score '
-
-    order_sql = ' ASC '
-    if order == 'desc':
-        order_sql = ' DESC '
-    qb += order_sql
-
-    qb += """
-            LIMIT :limit OFFSET :offset
+                              order: str = 'desc', duration: str = "currently", search: str = '',
+                              cursor: Optional[str] = None, with_count: bool = False):
+    """ get trending covid publications from postgresql, uses keyset pagination if a cursor is given """
+    if sort not in publication_sortable:
+        sort = 'score'
+
+    if cursor is not None:
+        # the view already contains the ranking, only the total count window has to go
+        q = """
+            SELECT * FROM trending_covid_papers
+            WHERE duration = :duration
+            """
+        count_q = """
+            SELECT count(*) FROM trending_covid_papers
+            WHERE duration = :duration
+            """
+        qs = """
+            AND title ILIKE :search
         """
+        return keyset_page(session, q, qs, {'duration': duration}, sort, sort, 'doi', 'doi', order, limit, cursor,
+                           search, count_q, with_count)
 
+    searching = len(search) > 3
+    s = covid_publication_statement(sort, 'desc' if order == 'desc' else 'asc', searching)
     params = {'duration': duration, 'limit': limit, 'offset': offset}
-    if len(search) > 3:
+    if searching:
         params['search'] = '%' + search + '%'
-        q += qs
-        q += qb
-        # print(q)
-        s = text(q).bindparams(bindparam('duration'), bindparam('limit'), bindparam('offset'), bindparam('search'))
-    else:
-        q += qb
-        # print(q)
-        s = text(q).bindparams(bindparam('duration'), bindparam('limit'), bindparam('offset'))
     return session.execute(s, params).fetchall()
 
 
 def get_trending_publications_for_field_of_study(fos_id: int, session: Session, offset: int = 0, limit: int = 10,
                                                  sort: str = 'score',
-                                                 order: str = 'desc', duration: str = "currently", search: str = ''):
-    """ get trending publications for a given field of study from postgresql """
-    q = """
-        SELECT ROW_NUMBER () OVER (ORDER BY score DESC) as trending_ranking, p.*, t.score, count, mean_sentiment, sum_followers, abstract_difference, mean_age, mean_length,
-            mean_questions, mean_exclamations, mean_bot_rating, projected_change, trending, ema, kama, ker, mean_score,
-            stddev, count(*) OVER() AS total_count 
-        FROM trending t
-            JOIN publication p on p.doi = t.publication_doi
-            JOIN publication_field_of_study pfos on p.doi = pfos.publication_doi
-            WHERE duration = :duration AND field_of_study_id = :fos_id 
-        """
-
-    qs = """
-        AND p.title ILIKE :search
-    """
-
-    sortable = ['trending_ranking', 'score', 'count', 'mean_sentiment', 'sum_followers', 'abstract_difference',
-                'mean_age', 'mean_length', 'mean_questions', 'mean_exclamations', 'mean_bot_rating',
-                'projected_change', 'trending', 'ema', 'kama', 'ker', 'mean_score', 'stddev', 'year', 'citation_count']
-
-    qb = ' ORDER BY  '
-    if sort in sortable:
-        qb += sort + ' '
-    else:
-        qb += 'score '
+                                                 order: str = 'desc', duration: str = "currently", search: str = '',
+                                                 cursor: Optional[str] = None, with_count: bool = False):
+    """ get trending publications for a given field of study from postgresql, uses keyset pagination if a cursor is
+        given """
+    params = {'duration': duration, 'fos_id': fos_id}
+    if cursor is not None:
+        return seek_trending_publications(session, 'field_of_study', params, sort, order, limit, cursor, search,
+                                          with_count)
 
-    order_sql = ' ASC '
-    if order == 'desc':
-        order_sql = ' DESC '
-    qb += order_sql
-
-    qb += """
-            LIMIT :limit OFFSET :offset
-        """
-
-    params = {'duration': duration, 'limit': limit, 'offset': offset, 'fos_id': fos_id}
-    if len(search) > 3:
-        params['search'] = '%' + search + '%'
-        q += qs
-        q += qb
-        # print(q)
-        s = text(q).bindparams(bindparam('duration'), bindparam('limit'), bindparam('offset'), bindparam('fos_id'),
-                               bindparam('search'))
-    else:
-        q += qb
-        # print(q)
-        s = text(q).bindparams(bindparam('duration'), bindparam('limit'), bindparam('offset'), bindparam('fos_id'))
-    return session.execute(s, params).fetchall()
+    return query_trending_publications(session, 'field_of_study', params, sort, order, limit, offset, search)
 
 
 def get_trending_publications_for_author(author_id: int, session: Session, offset: int = 0, limit: int = 10,
                                          sort: str = 'score',
-                                         order: str = 'desc', duration: str = "currently", search: str = ''):
-    """ get trending publications for a given author from postgresql """
-    q = """
-        SELECT ROW_NUMBER () OVER (ORDER BY score DESC) as trending_ranking, p.*, t.score, count, mean_sentiment, sum_followers, abstract_difference, mean_age, mean_length,
-            mean_questions, mean_exclamations, mean_bot_rating, projected_change, trending, ema, kama, ker, mean_score,
-            stddev, count(*) OVER() AS total_count
-        FROM trending t
-            JOIN publication p on p.doi = t.publication_doi
-            JOIN publication_author pa on p.doi = pa.publication_doi
-            WHERE duration = :duration AND author_id = :author_id 
-        """
+                                         order: str = 'desc', duration: str = "currently", search: str = '',
+                                         cursor: Optional[str] = None, with_count: bool = False):
+    """ get trending publications for a given author from postgresql, uses keyset pagination if a cursor is given """
+    params = {'duration': duration, 'author_id': author_id}
+    if cursor is not None:
+        return seek_trending_publications(session, 'author', params, sort, order, limit, cursor, search, with_count)
 
-    qs = """
-        AND p.title ILIKE :search
-    """
+    return query_trending_publications(session, 'author', params, sort, order, limit, offset, search)
 
-    sortable = ['trending_ranking', 'score', 'count', 'mean_sentiment', 'sum_followers', 'abstract_difference',
-                'mean_age', 'mean_length', 'mean_questions', 'mean_exclamations', 'mean_bot_rating',
-                'projected_change', 'trending', 'ema', 'kama', 'ker', 'mean_score', 'stddev', 'year', 'citation_count']
 
-    qb = ' ORDER BY  '
-    if sort in sortable:
-        qb += sort + ' '
-    else:
-        qb += 'score '
-
-    order_sql = ' ASC '
-    if order == 'desc':
-        order_sql = ' DESC '
-    qb += order_sql
-
-    qb += """
-            LIMIT :limit OFFSET :offset
-        """
-
-    params = {'duration': duration, 'limit': limit, 'offset': offset, 'author_id': author_id}
-    if len(search) > 3:
-        params['search'] = '%' + search + '%'
-        q += qs
-        q += qb
-        # print(q)
-        s = text(q).bindparams(bindparam('duration'), bindparam('limit'), bindparam('offset'), bindparam('author_id'),
-                               bindparam('search'))
-    else:
-        q += qb
-        # print(q)
-        s = text(q).bindparams(bindparam('duration'), bindparam('limit'), bindparam('offset'), bindparam('author_id'))
-    return session.execute(s, params).fetchall()
+def publication_ranking():
+    """ ranking expression and the trending table it reads from (aliased t), the snapshot if available """
+    if trending_snapshot.available:
+        return 't.trending_ranking', 'trending_publication_rank'
+    ranking = """CASE WHEN t.publication_doi IS NULL THEN NULL ELSE
+                (SELECT count(*) + 1 FROM trending r WHERE r.duration = :duration AND r.score > t.score)
+            END"""
+    return ranking, 'trending'
 
 
 def retrieve_publication(session: Session, doi, duration: str = "currently"):
-    """ get publication data including rank, fos, sources, authors from postgresql """
-    pub = session.query(Publication).filter_by(doi=doi).all()
-    a = text("""SELECT id, name FROM publication_author as p
-                JOIN author as a on (a.id = p.author_id)
-                WHERE p.publication_doi=:doi""")
-
-    params = {'doi': doi, }
-    a = a.bindparams(bindparam('doi'))
-    authors = session.execute(a, params).fetchall()
-
-    f = text("""SELECT id, name FROM publication_field_of_study as p
-                JOIN field_of_study as a on (a.id = p.field_of_study_id)
-                WHERE p.publication_doi=:doi""")
-    f = f.bindparams(bindparam('doi'))
-    fos = session.execute(f, params).fetchall()
-
-    s = text("""SELECT id, title, url, license FROM publication_source as p
-                JOIN source as a on (a.id = p.source_id)
-                WHERE p.publication_doi=:doi""")
-    s = s.bindparams(bindparam('doi'))
-    sources = session.execute(s, params).fetchall()
+    """
+    get publication data including rank, fos, sources, authors from postgresql in a single round trip, the rank is
+    read from the snapshot or else the number of publications with a higher score (uses the trending score index)
+    """
+    ranking, trending_table = publication_ranking()
 
     query = """
-        SELECT trending_ranking
-            FROM (SELECT ROW_NUMBER() OVER (ORDER BY score DESC) as trending_ranking, publication_doi FROM trending t
-        WHERE duration = :duration) t
-            WHERE publication_doi = :doi
+        SELECT to_json(p) as publication,
+            (SELECT COALESCE(json_agg(json_build_object('id', a.id, 'name', a.name)), '[]')
+                FROM publication_author as pa
+                JOIN author as a on (a.id = pa.author_id)
+                WHERE pa.publication_doi = p.doi) as authors,
+            (SELECT COALESCE(json_agg(json_build_object('id', f.id, 'name', f.name)), '[]')
+                FROM publication_field_of_study as pf
+                JOIN field_of_study as f on (f.id = pf.field_of_study_id)
+                WHERE pf.publication_doi = p.doi) as fields_of_study,
+            (SELECT COALESCE(json_agg(json_build_object('id', s.id, 'title', s.title, 'url', s.url,
+                                                        'license', s.license)), '[]')
+                FROM publication_source as ps
+                JOIN source as s on (s.id = ps.source_id)
+                WHERE ps.publication_doi = p.doi) as sources,
+            """ + ranking + """ as trending_ranking
+        FROM publication p
+            LEFT JOIN """ + trending_table + """ t on (t.publication_doi = p.doi AND t.duration = :duration)
+        WHERE p.doi = :doi
     """
     params = {'duration': duration, 'doi': doi}
     s = text(query).bindparams(bindparam('duration'), bindparam('doi'))
-    rank = session.execute(s, params).fetchone()
-
-    if rank:
-        r = rank[0]
-    else:
-        r = None
+    s = s.columns(publication=JSON, authors=JSON, fields_of_study=JSON, sources=JSON, trending_ranking=Integer)
+    row = session.execute(s, params).fetchone()
+
+    if not row:
+        return {
+            'publication': [],
+            'authors': [],
+            'fields_of_study': [],
+            'sources': [],
+            'trending_ranking': None
+        }
 
     return {
-        'publication': pub,
-        'authors': authors,
-        'fields_of_study': fos,
-        'sources': sources,
-        'trending_ranking': r
+        'publication': [row['publication']],
+        'authors': row['authors'],
+        'fields_of_study': row['fields_of_study'],
+        'sources': row['sources'],
+        'trending_ranking': row['trending_ranking']
+    }
+
+
+def retrieve_publications(session: Session, dois: List[str], duration: str = "currently"):
+    """
+    get publication data for multiple dois like retrieve_publication, but with one set based query per relation
+    (publication with rank, authors, fos, sources) grouped by doi, returns one entry per doi in the given order
+    """
+    dois = list(dict.fromkeys(dois))
+    if not dois:
+        return []
+
+    ranking, trending_table = publication_ranking()
+    query = """
+        SELECT p.doi, to_json(p) as publication, """ + ranking + """ as trending_ranking
+        FROM publication p
+            LEFT JOIN """ + trending_table + """ t on (t.publication_doi = p.doi AND t.duration = :duration)
+        WHERE p.doi = ANY(:dois)
+    """
+    s = text(query).bindparams(bindparam('duration'), bindparam('dois'))
+    s = s.columns(publication=JSON, trending_ranking=Integer)
+    publications = {row['doi']: row for row in session.execute(s, {'duration': duration, 'dois': dois})}
+
+    relations = {
+        'authors': """
+            SELECT pa.publication_doi, a.id, a.name
+            FROM publication_author as pa
+                JOIN author as a on (a.id = pa.author_id)
+            WHERE pa.publication_doi = ANY(:dois)
+        """,
+        'fields_of_study': """
+            SELECT pf.publication_doi, f.id, f.name
+            FROM publication_field_of_study as pf
+                JOIN field_of_study as f on (f.id = pf.field_of_study_id)
+            WHERE pf.publication_doi = ANY(:dois)
+        """,
+        'sources': """
+            SELECT ps.publication_doi, s.id, s.title, s.url, s.license
+            FROM publication_source as ps
+                JOIN source as s on (s.id = ps.source_id)
+            WHERE ps.publication_doi = ANY(:dois)
+        """,
     }
+    grouped = {}
+    for name, query in relations.items():
+        grouped[name] = {}
+        s = text(query).bindparams(bindparam('dois'))
+        for row in session.execute(s, {'dois': dois}):
+            data = row._asdict()
+            grouped[name].setdefault(data.pop('publication_doi'), []).append(data)
+
+    results = []
+    for doi in dois:
+        row = publications.get(doi)
+        results.append({
+            'doi': doi,
+            'publication': [row['publication']] if row else [],
+            'authors': grouped['authors'].get(doi, []) if row else [],
+            'fields_of_study': grouped['fields_of_study'].get(doi, []) if row else [],
+            'sources': grouped['sources'].get(doi, []) if row else [],
+            'trending_ranking': row['trending_ranking'] if row else None
+        })
+    return results
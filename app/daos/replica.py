@@ -0,0 +1,182 @@
+"""Trending Replica
+ optional in process copy of the trending publications of every duration, held as numpy columns with a precomputed
+ argsort per sortable column. Sort, order, offset/limit, the author/field of study filter and the title search of the
+ trending publication tables are answered with vectorized operations instead of a postgresql round trip.
+
+ A duration is reloaded and swapped atomically as soon as its data version (freshness) changed, queries fall back to
+ postgresql while a duration is not loaded (or outdated), for keyset pagination and for relevance sorting.
+"""
+import os
+
+import numpy as np
+from sqlalchemy import text
+
+from app.daos.database import engine
+from app.daos.freshness import data_freshness
+
+# read in replica config
+REPLICA_ENABLED = os.environ.get('REPLICA_ENABLED', '0') not in ('0', 'false', 'False')
+
+# filter name (see publication_filters) -> membership of the trending publications
+membership_queries = {
+    'field_of_study': """
+        SELECT DISTINCT m.publication_doi, m.field_of_study_id FROM publication_field_of_study m
+            JOIN trending t on t.publication_doi = m.publication_doi
+    """,
+    'author': """
+        SELECT DISTINCT m.publication_doi, m.author_id FROM publication_author m
+            JOIN trending t on t.publication_doi = m.publication_doi
+    """,
+}
+
+
+class TrendingTable(object):
+    """
+    columns of the trending publications of one duration
+
+    - **keys**: column names of the rows (as returned by the trending publication statement)
+    - **members**: filter name -> {id: dois}
+    """
+
+    def __init__(self, version, keys, rows, sortable, members):
+        self.version = version
+        self.keys = ['trending_ranking'] + list(keys) + ['total_count']
+        self.rows = rows
+        size = len(rows)
+
+        # ascending order of each column, nulls last like postgresql (and therefore first if reversed for desc)
+        self.columns = {}
+        self.orders = {}
+        for name in sortable:
+            if name not in keys:
+                continue
+            i = keys.index(name)
+            column = np.array([np.nan if row[i] is None else float(row[i]) for row in rows], dtype=float)
+            self.columns[name] = column
+            self.orders[name] = np.argsort(column, kind='stable')
+
+        # the ranking is the position in score descending order
+        self.orders['trending_ranking'] = self.orders['score'][::-1].copy()
+        self.score_position = np.empty(size, dtype=np.int64)
+        self.score_position[self.orders['trending_ranking']] = np.arange(size)
+
+        title = keys.index('title')
+        self.titles = np.array([(row[title] or '').lower() for row in rows], dtype=str)
+
+        doi = keys.index('doi')
+        index = {row[doi]: i for i, row in enumerate(rows)}
+        self.members = {
+            filter_name: {key: np.array(sorted(index[d] for d in dois if d in index), dtype=np.int64)
+                          for key, dois in ids.items()}
+            for filter_name, ids in members.items()
+        }
+
+    def query(self, filter_name, member_id, sort, order, limit, offset, search):
+        """ rows of a page as dicts, ranked like the trending publication statement """
+        selection = None
+        if filter_name != 'all':
+            selection = np.zeros(len(self.rows), dtype=bool)
+            selection[self.members[filter_name].get(member_id, [])] = True
+        if search:
+            found = np.char.find(self.titles, search.lower()) >= 0
+            selection = found if selection is None else selection & found
+
+        ordered = self.orders[sort]
+        if order == 'desc':
+            ordered = ordered[::-1]
+        if selection is not None:
+            ordered = ordered[selection[ordered]]
+        page = ordered[offset:offset + limit]
+
+        if filter_name == 'all':
+            # global ranking, as in the snapshot
+            ranking = self.score_position[page] + 1
+        else:
+            ranking = np.searchsorted(np.sort(self.score_position[selection]), self.score_position[page]) + 1
+
+        total_count = len(ordered)
+        return [dict(zip(self.keys, (int(rank),) + tuple(self.rows[i]) + (total_count,)))
+                for rank, i in zip(ranking, page)]
+
+
+class TrendingReplica(object):
+    """
+    trending tables of all durations, reloaded by the data freshness tracker whenever a version changed
+
+    - **enabled**: the replica is optional, without it every query runs on postgresql
+    """
+
+    def __init__(self, bind, enabled=False):
+        self.bind = bind
+        self.enabled = enabled
+        # duration -> TrendingTable, replaced as a whole on reload
+        self.tables = {}
+        self.loads = 0
+        self.hits = 0
+        self.fallbacks = 0
+
+    def start(self):
+        """ load the tables and reload them on every data version change """
+        if not self.enabled:
+            return
+        data_freshness.listen(self.load)
+        if data_freshness.available:
+            try:
+                self.load(set(data_freshness.versions))
+            except Exception as e:
+                print('trending replica load failed: %s' % e)
+
+    def load(self, durations):
+        """ read the trending publications (and their memberships) of the given durations and swap them in """
+        from app.daos.publication import trending_columns, publication_sortable
+
+        versions = {duration: data_freshness.version(duration) for duration in durations}
+        with self.bind.connect() as connection:
+            result = connection.execute(text("""
+                SELECT t.duration, """ + trending_columns + """
+                FROM trending t
+                    JOIN publication p on p.doi = t.publication_doi
+                WHERE t.duration = ANY(:durations)
+            """), {'durations': list(durations)})
+            keys = list(result.keys())[1:]
+            rows = {duration: [] for duration in durations}
+            for row in result:
+                rows[row[0]].append(tuple(row[1:]))
+
+            members = {}
+            for filter_name, query in membership_queries.items():
+                ids = members[filter_name] = {}
+                for doi, key in connection.execute(text(query)):
+                    ids.setdefault(key, []).append(doi)
+
+        tables = dict(self.tables)
+        for duration in durations:
+            tables[duration] = TrendingTable(versions[duration], keys, rows[duration], publication_sortable, members)
+        self.tables = tables
+        self.loads += 1
+
+    def query(self, filter_name, params, sort, order, limit, offset, search, searching, relevance):
+        """ page of trending publications from memory, None if postgresql has to answer """
+        table = self.tables.get(params['duration'])
+        if (table is None or relevance or table.version != data_freshness.version(params['duration'])
+                or (searching and any(c in search for c in '%_\\'))):
+            # not loaded, outdated, relevance ranking or a like pattern, only postgresql can answer
+            if self.enabled:
+                self.fallbacks += 1
+            return None
+        self.hits += 1
+        member_id = params.get('fos_id', params.get('author_id'))
+        return table.query(filter_name, member_id, sort, order, limit, offset, search if searching else '')
+
+    def stats(self):
+        """ counters of the replica """
+        return {
+            'durations': len(self.tables),
+            'rows': sum(len(table.rows) for table in self.tables.values()),
+            'loads': self.loads,
+            'hits': self.hits,
+            'fallbacks': self.fallbacks,
+        }
+
+
+trending_replica = TrendingReplica(engine, REPLICA_ENABLED)
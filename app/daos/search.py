@@ -0,0 +1,65 @@
+"""Search
+ title/name search backed by the pg_trgm gin indexes from app.daos.indexes, ILIKE '%term%' and similarity() both use
+ these indexes instead of scanning publication, author or field_of_study
+"""
+import os
+
+from sqlalchemy import text, bindparam
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import Session
+
+# read in search config
+AUTOCOMPLETE_TIMEOUT_MS = int(os.environ.get('AUTOCOMPLETE_TIMEOUT_MS', 150))
+AUTOCOMPLETE_MAX_LIMIT = 50
+
+# searchable entity: table, key column, text column
+search_entities = {
+    'publication': ('publication', 'doi', 'title'),
+    'author': ('author', 'id', 'name'),
+    'fieldOfStudy': ('field_of_study', 'id', 'name'),
+}
+
+
+def relevance_order(column):
+    """ order by clause sorting by trigram similarity to the search term (uses :term), direction is added by the dao """
+    return ' ORDER BY similarity(' + column + ', :term) '
+
+
+def autocomplete(session: Session, entity='publication', term='', limit=10, timeout_ms=AUTOCOMPLETE_TIMEOUT_MS):
+    """
+    top k titles/names containing term from postgresql, names starting with the term come first followed by the
+    most similar ones. If the query does not finish within timeout_ms an empty list is returned.
+    """
+    # trigram indexes need at least 3 characters
+    term = (term or '').strip()
+    if len(term) < 3 or entity not in search_entities:
+        return []
+
+    table, key, column = search_entities[entity]
+    limit = max(1, min(int(limit), AUTOCOMPLETE_MAX_LIMIT))
+    query = """
+        SELECT """ + key + """, """ + column + """
+        FROM """ + table + """
+        WHERE """ + column + """ ILIKE :search
+        ORDER BY """ + column + """ ILIKE :prefix DESC, similarity(""" + column + """, :term) DESC
+        LIMIT :limit
+    """
+    params = {'search': '%' + escape_like(term) + '%', 'prefix': escape_like(term) + '%', 'term': term,
+              'limit': limit}
+    s = text(query).bindparams(bindparam('search'), bindparam('prefix'), bindparam('term'), bindparam('limit'))
+
+    try:
+        # SET does not take bind parameters, timeout_ms is an int
+        session.execute(text('SET LOCAL statement_timeout = %d' % int(timeout_ms)))
+        rows = session.execute(s, params).fetchall()
+    except DBAPIError as e:
+        print('autocomplete %s %s failed: %s' % (entity, term, e))
+        session.rollback()
+        return []
+    session.rollback()
+    return rows
+
+
+def escape_like(term):
+    """ escape LIKE wildcards in user input """
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
@@ -0,0 +1,463 @@
+"""Trending Snapshot
+ materialized views holding the trending ranking and the author/field of study aggregates per duration, so the
+ trending tables are read with an index instead of a group by plus window over the trending table.
+ A background thread refreshes each view on its own once the trending table changed since its last refresh, the
+ trending fingerprint of every refresh is kept in snapshot_state. The profile averages of every author and field of
+ study are kept as sums that triggers and the same thread maintain incrementally (primary key lookup per profile).
+
+    python -m app.daos.snapshot
+"""
+import os
+import threading
+
+from sqlalchemy import text
+
+from app.daos.database import engine
+
+# read in snapshot config
+SNAPSHOT_ENABLED = os.environ.get('SNAPSHOT_ENABLED', '1') not in ('0', 'false', 'False')
+SNAPSHOT_CHECK_INTERVAL = float(os.environ.get('SNAPSHOT_CHECK_INTERVAL', 30))
+
+# aggregated columns of the author and field of study snapshot (without duration)
+entity_columns = """trending_ranking, id, name, pub_count, score, count, mean_sentiment, sum_followers,
+    abstract_difference, mean_age, mean_length, mean_questions, mean_exclamations, mean_bot_rating, projected_change,
+    trending, ema, kama, ker, mean_score, stddev"""
+
+entity_aggregation = """
+    SELECT ROW_NUMBER () OVER (PARTITION BY duration ORDER BY score DESC) as trending_ranking, * FROM (
+        SELECT t.duration, e.id, e.name, count(t.publication_doi) as pub_count,
+            SUM(t.score) as score, SUM(count) as count, AVG(mean_sentiment) as mean_sentiment,
+            SUM(sum_followers) as sum_followers, AVG(abstract_difference) as abstract_difference,
+            AVG(mean_age) as mean_age, AVG(mean_length) as mean_length, AVG(mean_questions) as mean_questions,
+            AVG(mean_exclamations) as mean_exclamations, AVG(mean_bot_rating) as mean_bot_rating,
+            AVG(projected_change) as projected_change, AVG(trending) as trending, AVG(ema) as ema, AVG(kama) as kama,
+            AVG(ker) as ker, AVG(mean_score) as mean_score, AVG(stddev) as stddev
+        FROM trending t
+            JOIN {membership} m on t.publication_doi = m.publication_doi
+            JOIN {entity} e on e.id = m.{entity}_id
+        GROUP BY t.duration, e.id) g
+"""
+
+snapshots = {
+    'trending_publication_rank': """
+        SELECT ROW_NUMBER () OVER (PARTITION BY duration ORDER BY score DESC) as trending_ranking, t.*
+        FROM trending t
+    """,
+    'trending_author_rank': entity_aggregation.format(membership='publication_author', entity='author'),
+    'trending_field_of_study_rank': entity_aggregation.format(membership='publication_field_of_study',
+                                                              entity='field_of_study'),
+}
+
+# a view is outdated if this fingerprint differs from the one of its last refresh, one entry per duration so the data
+# version of a duration changes only with its own rows (see app.daos.freshness)
+trending_fingerprint = """
+    SELECT COALESCE(CAST(jsonb_object_agg(duration, fingerprint) AS text), '{}') FROM (
+        SELECT duration, concat_ws(':', count(*), max(id), sum(score)) as fingerprint
+        FROM trending
+        GROUP BY duration
+    ) d
+"""
+
+snapshot_state_table = """
+    CREATE TABLE IF NOT EXISTS snapshot_state (
+        name varchar PRIMARY KEY,
+        fingerprint text,
+        refreshed_at timestamptz NOT NULL DEFAULT now()
+    )
+"""
+
+update_state = text("""
+    INSERT INTO snapshot_state (name, fingerprint, refreshed_at) VALUES (:name, :fingerprint, now())
+    ON CONFLICT (name) DO UPDATE SET fingerprint = EXCLUDED.fingerprint, refreshed_at = EXCLUDED.refreshed_at
+""")
+
+snapshot_indexes = [
+    # unique indexes are needed to refresh concurrently
+    "CREATE UNIQUE INDEX IF NOT EXISTS trending_publication_rank_doi_idx "
+    "ON trending_publication_rank (duration, publication_doi)",
+    # keyset pages seek (score, key) within a duration
+    "CREATE INDEX IF NOT EXISTS trending_publication_rank_score_doi_idx "
+    "ON trending_publication_rank (duration, score, publication_doi)",
+    "CREATE INDEX IF NOT EXISTS trending_publication_rank_ranking_idx "
+    "ON trending_publication_rank (duration, trending_ranking)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS trending_author_rank_id_idx ON trending_author_rank (duration, id)",
+    "CREATE INDEX IF NOT EXISTS trending_author_rank_score_id_idx ON trending_author_rank (duration, score, id)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS trending_field_of_study_rank_id_idx "
+    "ON trending_field_of_study_rank (duration, id)",
+    "CREATE INDEX IF NOT EXISTS trending_field_of_study_rank_score_id_idx "
+    "ON trending_field_of_study_rank (duration, score, id)",
+]
+
+# averages of get_profile_information_for_doi, kept per author/field of study and duration in trending_entity_profile
+profile_columns = ['mean_score', 'abstract_difference', 'mean_sentiment', 'sum_followers', 'mean_length',
+                   'mean_questions', 'mean_exclamations', 'mean_bot_rating']
+
+# (membership table, entity column, profile mode)
+profile_memberships = [
+    ('publication_author', 'author', 'author'),
+    ('publication_field_of_study', 'field_of_study', 'fieldOfStudy'),
+]
+
+profile_row_columns = 'duration, publication_doi, ' + ', '.join(profile_columns)
+profile_sum_columns = 'publications, ' + ', '.join('{c}_sum, {c}_count'.format(c=c) for c in profile_columns)
+
+
+def profile_sums(sign, alias):
+    """ aggregates of the signed rows of alias in the order of profile_sum_columns """
+    return 'SUM({sign}), '.format(sign=sign) + ', '.join(
+        'COALESCE(SUM({sign} * CAST({alias}.{c} AS numeric)), 0), '
+        'COALESCE(SUM(CASE WHEN {alias}.{c} IS NULL THEN 0 ELSE {sign} END), 0)'.format(sign=sign, alias=alias, c=c)
+        for c in profile_columns)
+
+
+# sums and counts of the non null values per author/field of study and duration, one row per publication (no fan out
+# over the other membership table), a changed trending row or membership is applied by adding its difference
+profile_tables = [
+    """
+    CREATE TABLE IF NOT EXISTS trending_profile_sum (
+        entity varchar NOT NULL,
+        id bigint NOT NULL,
+        duration varchar NOT NULL,
+        publications bigint NOT NULL,
+        """ + ''.join('{c}_sum numeric NOT NULL, {c}_count bigint NOT NULL, '.format(c=c)
+                      for c in profile_columns) + """
+        PRIMARY KEY (entity, id, duration)
+    )
+    """,
+    # trending rows written since the last apply (-1 old, 1 new version), sign 0 asks for a rebuild (truncate)
+    """
+    CREATE TABLE IF NOT EXISTS trending_profile_change (
+        sign smallint NOT NULL,
+        duration varchar,
+        publication_doi varchar,
+        """ + ', '.join('{c} numeric'.format(c=c) for c in profile_columns) + """
+    )
+    """,
+    # memberships written since the last apply
+    """
+    CREATE TABLE IF NOT EXISTS trending_profile_membership_change (
+        sign smallint NOT NULL,
+        entity varchar NOT NULL,
+        id bigint NOT NULL,
+        publication_doi varchar NOT NULL
+    )
+    """,
+    """
+    CREATE OR REPLACE VIEW trending_entity_profile AS
+        SELECT entity, id, duration, """ + ', '.join(
+        'CAST({c}_sum / NULLIF({c}_count, 0) AS double precision) as {c}'.format(c=c) for c in profile_columns) + """
+        FROM trending_profile_sum
+        WHERE publications > 0
+    """,
+]
+
+# statement level triggers write one insert per pipeline statement, updates only record the rows whose profile
+# columns changed
+profile_capture_functions = [
+    """
+    CREATE OR REPLACE FUNCTION trending_profile_capture() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'TRUNCATE' THEN
+            INSERT INTO trending_profile_change (sign) VALUES (0);
+        ELSIF TG_OP = 'INSERT' THEN
+            INSERT INTO trending_profile_change (sign, {columns}) SELECT 1, {columns} FROM new_rows;
+        ELSIF TG_OP = 'DELETE' THEN
+            INSERT INTO trending_profile_change (sign, {columns}) SELECT -1, {columns} FROM old_rows;
+        ELSE
+            INSERT INTO trending_profile_change (sign, {columns})
+                SELECT -1, * FROM (SELECT {columns} FROM old_rows EXCEPT ALL SELECT {columns} FROM new_rows) o
+                UNION ALL
+                SELECT 1, * FROM (SELECT {columns} FROM new_rows EXCEPT ALL SELECT {columns} FROM old_rows) n;
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    """.format(columns=profile_row_columns),
+] + [
+    """
+    CREATE OR REPLACE FUNCTION trending_profile_{entity}_capture() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'TRUNCATE' THEN
+            INSERT INTO trending_profile_change (sign) VALUES (0);
+            RETURN NULL;
+        END IF;
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            INSERT INTO trending_profile_membership_change (sign, entity, id, publication_doi)
+                SELECT -1, '{mode}', {entity}_id, publication_doi FROM old_rows;
+        END IF;
+        IF TG_OP IN ('UPDATE', 'INSERT') THEN
+            INSERT INTO trending_profile_membership_change (sign, entity, id, publication_doi)
+                SELECT 1, '{mode}', {entity}_id, publication_doi FROM new_rows;
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    """.format(entity=entity, mode=mode) for membership, entity, mode in profile_memberships
+]
+
+# (trigger, table, function)
+profile_triggers = [('trending_profile_' + event, 'trending', 'trending_profile_capture()')
+                    for event in ('insert', 'update', 'delete', 'truncate')] + [
+    ('trending_profile_' + entity + '_' + event, membership, 'trending_profile_' + entity + '_capture()')
+    for membership, entity, mode in profile_memberships for event in ('insert', 'update', 'delete', 'truncate')]
+
+profile_trigger_events = {
+    'insert': 'AFTER INSERT ON {table} REFERENCING NEW TABLE AS new_rows',
+    'update': 'AFTER UPDATE ON {table} REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows',
+    'delete': 'AFTER DELETE ON {table} REFERENCING OLD TABLE AS old_rows',
+    'truncate': 'AFTER TRUNCATE ON {table}',
+}
+
+profile_upsert = """
+    ON CONFLICT (entity, id, duration) DO UPDATE SET """ + ', '.join(
+    '{c} = trending_profile_sum.{c} + EXCLUDED.{c}'.format(c=c.strip()) for c in profile_sum_columns.split(','))
+
+# the sums of the current trending table, after a truncate or when the sums are created
+rebuild_profile = [
+    'DELETE FROM trending_profile_change',
+    'DELETE FROM trending_profile_membership_change',
+    'DELETE FROM trending_profile_sum',
+    'INSERT INTO trending_profile_sum (entity, id, duration, ' + profile_sum_columns + ') ' + ' UNION ALL '.join(
+        """
+        SELECT '{mode}', m.{entity}_id, t.duration, {sums}
+        FROM trending t
+            JOIN {membership} m on t.publication_doi = m.publication_doi
+        GROUP BY t.duration, m.{entity}_id
+        """.format(mode=mode, entity=entity, membership=membership, sums=profile_sums('1', 't'))
+        for membership, entity, mode in profile_memberships),
+]
+
+# changed memberships first, against the trending rows of their publications as of the last apply (current rows
+# without the pending changes), then the pending trending changes against the current memberships
+apply_profile = [
+    """
+    WITH members AS (
+        SELECT entity, id, publication_doi, SUM(sign) as sign
+        FROM trending_profile_membership_change
+        GROUP BY entity, id, publication_doi
+        HAVING SUM(sign) <> 0
+    ), previous AS (
+        SELECT 1 as sign, {columns} FROM trending
+        WHERE publication_doi IN (SELECT publication_doi FROM members)
+        UNION ALL
+        SELECT -sign, {columns} FROM trending_profile_change
+        WHERE publication_doi IN (SELECT publication_doi FROM members)
+    )
+    INSERT INTO trending_profile_sum (entity, id, duration, {sum_columns})
+        SELECT m.entity, m.id, p.duration, {sums}
+        FROM members m
+            JOIN previous p on p.publication_doi = m.publication_doi
+        GROUP BY m.entity, m.id, p.duration
+    """.format(columns=profile_row_columns, sum_columns=profile_sum_columns, sums=profile_sums('m.sign * p.sign', 'p'))
+    + profile_upsert,
+    """
+    WITH drained AS (
+        DELETE FROM trending_profile_change RETURNING sign, {columns}
+    )
+    INSERT INTO trending_profile_sum (entity, id, duration, {sum_columns})
+    """.format(columns=profile_row_columns, sum_columns=profile_sum_columns) + ' UNION ALL '.join(
+        """
+        SELECT '{mode}', m.{entity}_id, d.duration, {sums}
+        FROM drained d
+            JOIN {membership} m on d.publication_doi = m.publication_doi
+        GROUP BY d.duration, m.{entity}_id
+        """.format(mode=mode, entity=entity, membership=membership, sums=profile_sums('d.sign', 'd'))
+        for membership, entity, mode in profile_memberships) + profile_upsert,
+    'DELETE FROM trending_profile_membership_change',
+]
+
+pending_profile_changes = """
+    SELECT EXISTS (SELECT 1 FROM trending_profile_change) OR EXISTS (SELECT 1 FROM trending_profile_membership_change)
+"""
+profile_rebuild_requested = 'SELECT EXISTS (SELECT 1 FROM trending_profile_change WHERE sign = 0)'
+
+
+def create_profile(connection):
+    """ create the profile sums, their capture triggers and fill the sums if they are new """
+    filled = connection.execute(text("SELECT to_regclass('trending_profile_sum')")).scalar() is not None
+    for statement in profile_tables + profile_capture_functions:
+        connection.execute(text(statement))
+    for trigger, table, function in profile_triggers:
+        print('create trigger %s on %s' % (trigger, table))
+        connection.execute(text('DROP TRIGGER IF EXISTS %s ON %s' % (trigger, table)))
+        connection.execute(text('CREATE TRIGGER %s %s FOR EACH STATEMENT EXECUTE PROCEDURE %s' % (
+            trigger, profile_trigger_events[trigger.rsplit('_', 1)[1]].format(table=table), function)))
+    if not filled:
+        print('fill trending_profile_sum')
+        for statement in rebuild_profile:
+            connection.execute(text(statement))
+
+
+def drop_profile(connection):
+    """ drop the capture triggers and the profile sums, the pipeline writes no changes nobody applies """
+    for trigger, table, function in profile_triggers:
+        print('drop trigger %s on %s' % (trigger, table))
+        connection.execute(text('DROP TRIGGER IF EXISTS %s ON %s' % (trigger, table)))
+    connection.execute(text('DROP VIEW IF EXISTS trending_entity_profile'))
+    connection.execute(text('DROP TABLE IF EXISTS trending_profile_sum, trending_profile_change, '
+                            'trending_profile_membership_change'))
+    for function in sorted(set(function for trigger, table, function in profile_triggers)):
+        connection.execute(text('DROP FUNCTION IF EXISTS ' + function))
+
+
+def create_snapshots(bind=engine, enabled=SNAPSHOT_ENABLED):
+    """ create the materialized views, their indexes, the profile sums and the refresh state if missing, without the
+        snapshot only the capture triggers of the profile sums are dropped """
+    with bind.begin() as connection:
+        if not enabled:
+            drop_profile(connection)
+            return
+
+        print('create snapshot_state')
+        connection.execute(text(snapshot_state_table))
+        for name, query in snapshots.items():
+            print('create snapshot ' + name)
+            connection.execute(text('CREATE MATERIALIZED VIEW IF NOT EXISTS ' + name + ' AS ' + query))
+        for statement in snapshot_indexes:
+            print(statement)
+            connection.execute(text(statement))
+        create_profile(connection)
+
+
+class TrendingSnapshot(object):
+    """
+    keeps the snapshot views in sync with the trending table, every view is refreshed in its own transaction by one
+    worker at a time (advisory lock per view) and only if the trending fingerprint (count, max id, score sum) differs
+    from the one of its last refresh, so a slow view does not hold back the others
+
+    - **available**: daos read from the snapshot only if the views exist
+    """
+    lock_key = 'trending_snapshot'
+
+    def __init__(self, bind, check_interval=30.0, enabled=True):
+        self.bind = bind
+        self.check_interval = check_interval
+        self.enabled = enabled
+        self.available = False
+        self.refreshes = 0
+        # functions called with the names of the refreshed views after a check
+        self.listeners = []
+
+        self.wake = threading.Event()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def listen(self, listener):
+        """ call listener(names) whenever this worker refreshed views, after their refresh committed """
+        if listener not in self.listeners:
+            self.listeners.append(listener)
+
+    def notify(self):
+        """ the pipeline announced new data, check now instead of at the next interval """
+        self.wake.set()
+
+    def start(self):
+        """ check that the views exist and start the refresh thread """
+        if not self.enabled:
+            return
+        try:
+            with self.bind.connect() as connection:
+                missing = [name for name in list(snapshots) + ['snapshot_state', 'trending_entity_profile']
+                           if connection.execute(text('SELECT to_regclass(:name)'), {'name': name}).scalar() is None]
+        except Exception as e:
+            print('trending snapshot check failed: %s' % e)
+            return
+
+        if missing:
+            print('trending snapshot missing %s, run python -m app.daos.snapshot' % ', '.join(missing))
+            return
+
+        self.available = True
+        if self.thread and self.thread.is_alive():
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, name='trending-snapshot', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """ stop the refresh thread """
+        self.stop_event.set()
+        self.wake.set()
+        if self.thread:
+            self.thread.join(self.check_interval)
+            self.thread = None
+
+    def refresh_if_changed(self):
+        """ refresh every outdated snapshot view on its own, returns the names of the views this worker refreshed """
+        # table -> fingerprint, computed at most once per check
+        fingerprints = {}
+        refreshed = []
+        for name in snapshots:
+            try:
+                if self.refresh_view(name, fingerprints):
+                    refreshed.append(name)
+            except Exception as e:
+                print('trending snapshot refresh of %s failed: %s' % (name, e))
+        try:
+            if self.apply_profile_changes():
+                refreshed.append('trending_entity_profile')
+        except Exception as e:
+            print('trending snapshot update of trending_entity_profile failed: %s' % e)
+        if refreshed:
+            for listener in self.listeners:
+                try:
+                    listener(refreshed)
+                except Exception as e:
+                    print('trending snapshot listener failed: %s' % e)
+        return refreshed
+
+    def refresh_view(self, name, fingerprints):
+        """ refresh a view if trending changed since its last refresh, returns True if this worker refreshed """
+        with self.bind.begin() as connection:
+            locked = connection.execute(text('SELECT pg_try_advisory_xact_lock(hashtext(:key))'),
+                                        {'key': self.lock_key + ':' + name}).scalar()
+            if not locked:
+                return False
+
+            if 'trending' not in fingerprints:
+                fingerprints['trending'] = connection.execute(text(trending_fingerprint)).scalar()
+            last = connection.execute(text('SELECT fingerprint FROM snapshot_state WHERE name = :name'),
+                                      {'name': name}).scalar()
+            if last == fingerprints['trending']:
+                return False
+
+            connection.execute(text('REFRESH MATERIALIZED VIEW CONCURRENTLY ' + name))
+            connection.execute(update_state, {'name': name, 'fingerprint': fingerprints['trending']})
+        self.refreshes += 1
+        return True
+
+    def apply_profile_changes(self):
+        """ add the trending and membership changes recorded since the last apply to the profile sums, one worker at a
+            time and all statements on the same snapshot, returns True if this worker applied changes """
+        with self.bind.begin() as connection:
+            connection.execute(text('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ'))
+            locked = connection.execute(text('SELECT pg_try_advisory_xact_lock(hashtext(:key))'),
+                                        {'key': self.lock_key + ':trending_entity_profile'}).scalar()
+            if not locked or not connection.execute(text(pending_profile_changes)).scalar():
+                return False
+
+            rebuild = connection.execute(text(profile_rebuild_requested)).scalar()
+            for statement in rebuild_profile if rebuild else apply_profile:
+                connection.execute(text(statement))
+            connection.execute(update_state, {'name': 'trending_entity_profile',
+                                              'fingerprint': connection.execute(text(trending_fingerprint)).scalar()})
+        self.refreshes += 1
+        return True
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            self.wake.wait(self.check_interval)
+            self.wake.clear()
+            if self.stop_event.is_set():
+                return
+            try:
+                self.refresh_if_changed()
+            except Exception as e:
+                print('trending snapshot refresh failed: %s' % e)
+
+
+trending_snapshot = TrendingSnapshot(engine, SNAPSHOT_CHECK_INTERVAL, SNAPSHOT_ENABLED)
+
+
+if __name__ == '__main__':
+    create_snapshots()
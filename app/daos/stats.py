@@ -1,8 +1,73 @@
+import os
 import time
-from datetime import timedelta
+from datetime import datetime, timedelta, timezone
 from sqlalchemy import text, bindparam
 from sqlalchemy.orm import Session  # type: ignore
 
+from app.daos.discussion_counts import discussion_counts
+from app.daos.flux_cache import FluxCache, flux_cache
+from app.daos.freshness import data_freshness
+from app.daos.snapshot import profile_columns, trending_snapshot
+
+# aggregator of each number field of /stats/numbers
+number_aggregation_field = {
+    'bot_rating': 'mean',
+    'contains_abstract_raw': 'mean',
+    'exclamations': 'mean',
+    'followers': 'sum',
+    'length': 'mean',
+    'questions': 'mean',
+    'score': 'sum',
+    'sentiment_raw': 'mean',
+    "pub_count": "count",
+    "count": "count"
+}
+
+# doi lists up to this length are filtered with an or chain, longer ones with a set lookup (see doi_filter_list)
+DOI_FILTER_OR_MAX = int(os.environ.get('DOI_FILTER_OR_MAX', 50))
+
+# metrics of the profile distribution (all columns of trending)
+profile_metrics = ['mean_score', 'mean_bot_rating', 'mean_sentiment', 'sum_followers', 'abstract_difference',
+                   'mean_questions', 'mean_exclamations', 'mean_length']
+profile_percentiles = (0.1, 0.25, 0.5, 0.75, 0.9)
+PROFILE_HISTOGRAM_BINS = int(os.environ.get('PROFILE_HISTOGRAM_BINS', 10))
+
+# one scan of the trending rows of a duration, unpivoted to (type, value), postgresql materializes the cte since it
+# is read twice: once for min, max, avg and percentiles and once for the fixed width histogram between min and max
+profile_distribution_query = """
+    WITH v AS (
+        SELECT m.type, m.value
+        FROM trending t
+            CROSS JOIN LATERAL (VALUES
+                """ + ', '.join("('" + m + "', t." + m + "::float8)" for m in profile_metrics) + """
+            ) m(type, value)
+        WHERE t.duration = :duration
+    ), s AS (
+        SELECT type, MIN(value) as min, MAX(value) as max, AVG(value) as avg,
+            percentile_cont(ARRAY[""" + ', '.join(str(p) for p in profile_percentiles) + """])
+                WITHIN GROUP (ORDER BY value) as percentiles
+        FROM v
+        GROUP BY type
+    ), h AS (
+        SELECT v.type, CASE WHEN s.max > s.min THEN LEAST(width_bucket(v.value, s.min, s.max, :bins), :bins)
+            ELSE 1 END as bucket, count(*) as bin_count
+        FROM v
+            JOIN s on s.type = v.type
+        WHERE v.value IS NOT NULL
+        GROUP BY 1, 2
+    )
+    SELECT s.*, h.bucket, h.bin_count
+    FROM s
+        LEFT JOIN h on h.type = s.type
+"""
+
+# discussion percentages per doi, the all time counts grow slowly so a short ttl hides repeated scans
+DISCUSSION_CACHE_TTL = float(os.environ.get('DISCUSSION_CACHE_TTL', 60))
+discussion_cache = FluxCache(int(os.environ.get('DISCUSSION_CACHE_MAX_ENTRIES', 1024)), DISCUSSION_CACHE_TTL > 0)
+
+# duration -> (data version key, result) of get_profile_information_avg
+profile_distribution_cache = {}
+
 # time definitions shared with influxdb
 trending_time_definition = {
     'currently': {
@@ -223,198 +288,249 @@ def get_titles_for_dois(session: Session, dois_list):
 
 
 def get_profile_information_avg(session: Session, duration="currently"):
-    """ get profile information avg, min, max from postgresql """
-    query = """
-        SELECT 'mean_score' as type, MIN(mean_score), MAX(mean_score), AVG(mean_score)
-        FROM trending
-        WHERE duration = :duration
-        UNION
-        SELECT 'mean_bot_rating' as type, MIN(mean_bot_rating), MAX(mean_bot_rating), AVG(mean_bot_rating)
-        FROM trending
-        WHERE duration = :duration
-        UNION
-        SELECT 'mean_sentiment' as type, MIN(mean_sentiment), MAX(mean_sentiment), AVG(mean_sentiment)
-        FROM trending
-        WHERE duration = :duration
-        UNION
-        SELECT 'sum_followers' as type, MIN(sum_followers), MAX(sum_followers), AVG(sum_followers)
-        FROM trending
-        WHERE duration = :duration
-        UNION
-        SELECT 'abstract_difference' as type, MIN(abstract_difference), MAX(abstract_difference), AVG(abstract_difference)
-        FROM trending
-        WHERE duration = :duration
-        UNION
-        SELECT 'mean_questions' as type, MIN(mean_questions), MAX(mean_questions), AVG(mean_questions)
-        FROM trending
-        WHERE duration = :duration
-        UNION
-        SELECT 'mean_exclamations' as type, MIN(mean_exclamations), MAX(mean_exclamations), AVG(mean_exclamations)
-        FROM trending
-        WHERE duration = :duration
-        UNION
-        SELECT 'mean_length' as type, MIN(mean_length), MAX(mean_length), AVG(mean_length)
-        FROM trending
-        WHERE duration = :duration;
     """
-
-    params = {'duration': duration, }
-    s = text(query)
-    s = s.bindparams(bindparam('duration'))
-    rows = session.execute(s, params).fetchall()
-    result = {'min': {}, 'max': {}, 'avg': {}}
+    get profile information avg, min, max, percentiles and a histogram per metric from postgresql, all metrics are
+    computed in one scan of the trending rows and the result is reused until the data version of the duration changed
+    """
+    key = None
+    if duration in trending_time_definition:
+        key = data_freshness.version_key(duration, trending_time_definition[duration]['window_size'])
+        cached = profile_distribution_cache.get(duration)
+        if cached and cached[0] == key:
+            return cached[1]
+
+    s = text(profile_distribution_query).bindparams(bindparam('duration'), bindparam('bins'))
+    rows = session.execute(s, {'duration': duration, 'bins': PROFILE_HISTOGRAM_BINS}).fetchall()
+    result = {'min': {}, 'max': {}, 'avg': {}, 'percentiles': {}, 'histogram': {}}
     for r in rows:
-        result['min'][r[0]] = r[1]
-        result['max'][r[0]] = r[2]
-        result['avg'][r[0]] = r[3]
-
+        if r.type not in result['min']:
+            result['min'][r.type] = r.min
+            result['max'][r.type] = r.max
+            result['avg'][r.type] = r.avg
+            result['percentiles'][r.type] = dict(zip(('p%d' % round(p * 100) for p in profile_percentiles),
+                                                     r.percentiles or []))
+            width = ((r.max - r.min) / PROFILE_HISTOGRAM_BINS) if r.min is not None else 0
+            result['histogram'][r.type] = {
+                'bins': [r.min + width * i for i in range(PROFILE_HISTOGRAM_BINS + 1)] if r.min is not None else [],
+                'counts': [0] * PROFILE_HISTOGRAM_BINS,
+            }
+        if r.bucket is not None:
+            result['histogram'][r.type]['counts'][r.bucket - 1] = r.bin_count
+
+    if key:
+        profile_distribution_cache[duration] = (key, result)
     return result
 
 
 def get_discussion_data_list_with_percentage(session: Session, doi, limit: int = 20, min_percentage: float = 1,
                                              dd_type="lang"):
     """ get discussion types with count an percentage from postgresql """
-    query = """
-                WITH result AS
-             (
-                 (
-                     SELECT "value",
-                            count                                                            as c,
-                            ROUND(count / CAST(SUM(count) OVER () AS FLOAT) * 1000) / 10 as p
-                            FROM counted_discussion_data
-                                    JOIN discussion_data as dd ON (discussion_data_point_id = dd.id)
-                           WHERE type = :type and value != 'und' and value != 'unknown'
-                     ORDER BY c DESC
-                     LIMIT :limit
-                 )
-                 UNION
-                 (
-                     SELECT 'total' as "value", SUM(count) as c, 100 as p
-                     FROM counted_discussion_data
-                                    JOIN discussion_data as dd ON (discussion_data_point_id = dd.id)
-                     WHERE type = :type and value != 'und' and value != 'unknown'
-                 )
-             )
-            SELECT "value", c as count, p
-            FROM result
-            WHERE result.p >= :mp
-            ORDER BY count DESC;
-     """
-   
-    params = {
-        'type': dd_type,
-        'limit': limit,
-        'mp': min_percentage
-    }
+    return get_discussion_data_lists_with_percentage(session, doi, limit, min_percentage, [dd_type])[dd_type]
 
+
+def get_discussion_data_lists_with_percentage(session: Session, doi, limit: int = 20, min_percentage: float = 1,
+                                              dd_types=("lang",)):
+    """
+    get discussion values with count and percentage of several types from postgresql, the top values and the total
+    per type are computed in one pass (window sums), the result is cached for DISCUSSION_CACHE_TTL seconds per doi so
+    the min percentage cut and repeated requests for viral publications do not scan the discussion data again
+    """
+    dd_types = list(dict.fromkeys(dd_types))
+    key = ('discussion_percentage', doi, tuple(dd_types), limit)
+    counted = discussion_cache.get_or_query(key, timedelta(seconds=DISCUSSION_CACHE_TTL),
+                                            lambda: query_discussion_percentages(session, doi, limit, dd_types))
+
+    result = {}
+    for dd_type in dd_types:
+        total, rows = counted.get(dd_type, (None, []))
+        result[dd_type] = [row for row in [{'value': 'total', 'count': total, 'p': 100}] + rows
+                           if row['p'] is not None and row['p'] >= min_percentage]
+    return result
+
+
+def query_discussion_percentages(session: Session, doi, limit, dd_types):
+    """ top values with percentage and the total of each type, {type: (total, rows)} """
     if doi:
-        query = """
-        WITH result AS
-                     (
-                         (
-                             SELECT "value",
-                                    SUM(count)                                                             as c,
-                                    ROUND(SUM(count) / CAST(SUM(SUM(count)) OVER () AS FLOAT) * 1000) / 10 as p
-                             FROM (SELECT "value", "count"
-                                   FROM discussion_data_point as ddp
-                                            JOIN discussion_data as dd ON (ddp.discussion_data_point_id = dd.id)
-                                   WHERE type = :type and value != 'und' and value != 'unknown'
-                                   AND publication_doi=:doi
-                            ) temp
-                             GROUP BY "value"
-                             ORDER BY c DESC
-                             LIMIT :limit
-                         )
-                         UNION
-                         (
-                             SELECT 'total' as "value", SUM(count) as c, 100 as p
-                             FROM discussion_data_point as ddp
-                                      JOIN discussion_data as dd ON (ddp.discussion_data_point_id = dd.id)
-                             WHERE type = :type and value != 'und' and value != 'unknown'
-                             AND publication_doi=:doi
-                         )
-                     )
-            SELECT "value", c as count, p
-            FROM result
-            WHERE result.p >= :mp
-            ORDER BY count DESC;
+        source = """
+            SELECT dd.type, dd.value, SUM(ddp.count) as count
+            FROM discussion_data_point as ddp
+                JOIN discussion_data as dd ON (ddp.discussion_data_point_id = dd.id)
+            WHERE publication_doi = :doi AND dd.type = ANY(:types) and value != 'und' and value != 'unknown'
+            GROUP BY dd.type, dd.value
+        """
+    else:
+        source = """
+            SELECT dd.type, dd.value, SUM(count) as count
+            FROM counted_discussion_data
+                JOIN discussion_data as dd ON (discussion_data_point_id = dd.id)
+            WHERE dd.type = ANY(:types) and value != 'und' and value != 'unknown'
+            GROUP BY dd.type, dd.value
         """
+    query = """
+        SELECT type, value, count, total,
+            ROUND(count / CAST(NULLIF(total, 0) AS FLOAT) * 1000) / 10 as p
+        FROM (
+            SELECT type, value, count, SUM(count) OVER (PARTITION BY type) as total,
+                ROW_NUMBER() OVER (PARTITION BY type ORDER BY count DESC) as rank
+            FROM (""" + source + """) c
+        ) r
+    """
+    params = {'types': dd_types}
+    binds = [bindparam('types')]
+    if limit is not None:
+        query += " WHERE rank <= :limit "
+        params['limit'] = limit
+        binds.append(bindparam('limit'))
+    query += " ORDER BY type, count DESC "
+    if doi:
         params['doi'] = doi
+        binds.append(bindparam('doi'))
+
+    counted = {}
+    for dd_type, value, count, total, p in session.execute(text(query).bindparams(*binds), params):
+        counted.setdefault(dd_type, (total, []))[1].append({'value': value, 'count': count, 'p': p})
+    return counted
 
-    s = text(query)
-    # print(query)
-    # print(params)
 
-    if 'doi' in params:
-        s = s.bindparams(bindparam('type'), bindparam('limit'), bindparam('mp'), bindparam('doi'))
+def get_discussion_data_lists(session: Session, doi, limit, id, mode="publication", dd_types=("word",)):
+    """
+    get the top discussion values with count of several types with one query from postgresql, authors and fields of
+    study are read from their discussion counts (index top-k per type) if available, otherwise the values are ranked
+    per type with a window partitioned by type
+    """
+    params = {'types': list(dict.fromkeys(dd_types))}
+    if mode in ("author", "fieldOfStudy") and discussion_counts.available:
+        # unnest is polymorphic, the type of the list has to be explicit for prepared statements (asyncpg)
+        query = """
+            SELECT r.count, r.value, t.type
+            FROM unnest(CAST(:types AS text[])) t(type)
+                CROSS JOIN LATERAL (
+                    SELECT d.count, d.value FROM discussion_entity_count d
+                    WHERE d.entity = :entity AND d.id = :id AND d.type = t.type AND d.count > 0
+                    ORDER BY d.count DESC
+                    LIMIT :limit
+                ) r
+        """
+        params.update({'entity': mode, 'id': id, 'limit': limit or None})
+        s = text(query).bindparams(bindparam('types'), bindparam('entity'), bindparam('id'), bindparam('limit'))
     else:
-        s = s.bindparams(bindparam('type'), bindparam('limit'), bindparam('mp'))
+        if mode == "fieldOfStudy":
+            source = """discussion_data_point as ddp
+                         JOIN discussion_data as dd ON (ddp.discussion_data_point_id = dd.id)
+                         JOIN publication_field_of_study as pfos on ddp.publication_doi = pfos.publication_doi
+                    WHERE pfos.field_of_study_id=:id AND """
+            params['id'] = id
+        elif mode == "author":
+            source = """discussion_data_point as ddp
+                         JOIN discussion_data as dd ON (ddp.discussion_data_point_id = dd.id)
+                         JOIN publication_author as pfos on ddp.publication_doi = pfos.publication_doi
+                    WHERE pfos.author_id=:id AND """
+            params['id'] = id
+        elif doi:
+            source = """discussion_data_point as ddp
+                         JOIN discussion_data as dd ON (ddp.discussion_data_point_id = dd.id)
+                    WHERE publication_doi=:doi AND """
+            params['doi'] = doi
+        else:
+            source = None
+
+        if source:
+            counted = """
+                SELECT SUM(ddp.count) as count, dd.value, dd.type
+                FROM """ + source + """ dd.type = ANY(:types) and value != 'und' and value != 'unknown'
+                GROUP BY dd.id
+            """
+        else:
+            counted = """
+                SELECT count, dd.value, dd.type
+                FROM counted_discussion_data
+                    JOIN discussion_data as dd ON (discussion_data_point_id = dd.id)
+                WHERE dd.type = ANY(:types) and value != 'und' and value != 'unknown'
+            """
+        query = """
+            SELECT count, value, type FROM (
+                SELECT count, value, type, ROW_NUMBER() OVER (PARTITION BY type ORDER BY count DESC) as rank
+                FROM (""" + counted + """) c
+            ) r
+        """
+        if limit:
+            query += " WHERE rank <= :limit "
+            params['limit'] = limit
+        query += " ORDER BY type, count DESC "
+        s = text(query).bindparams(*[bindparam(p) for p in params])
+
+    result = {dd_type: [] for dd_type in dd_types}
+    for count, value, dd_type in session.execute(s, params):
+        result[dd_type].append({'count': count, 'value': value})
+    return result
 
-    return session.execute(s, params).fetchall()
 
+def get_windowed_discussion_data_lists(session: Session, doi, limit, id, mode="publication", dd_types=("word",),
+                                       duration="currently", min_percentage=None):
+    """
+    get the top discussion values with count of several types for a duration, the counts are summed from the
+    discussion buckets since the start of the duration (see app.daos.discussion_counts)
 
-def get_discussion_data_list(session: Session, doi, limit, id, mode="publication", dd_type="word"):
-    """ get discussion types with count from postgresql """
-    params = {'type': dd_type}
-    extra = ""
+    - **min_percentage**: if given the values get their percentage of the type (p), values below it are dropped and
+        a 'total' value is added like in get_discussion_data_list_with_percentage
+    """
+    params = {'types': list(dict.fromkeys(dd_types)),
+              'since': datetime.now(timezone.utc) + trending_time_definition[duration]['duration']}
+    join = ''
+    where = ''
     if mode == "fieldOfStudy":
-        query = """SELECT SUM(ddp.count) as count, dd.value
-                    FROM discussion_data_point as ddp
-                         JOIN discussion_data as dd ON (ddp.discussion_data_point_id = dd.id)
-                         JOIN publication_field_of_study as pfos on ddp.publication_doi = pfos.publication_doi
-                    WHERE type = :type and value != 'und' and value != 'unknown' AND pfos.field_of_study_id=:id """
+        join = ' JOIN publication_field_of_study as pfos on b.publication_doi = pfos.publication_doi '
+        where = ' AND pfos.field_of_study_id = :id '
         params['id'] = id
-        extra +=  " GROUP BY dd.id "
     elif mode == "author":
-        query = """SELECT SUM(ddp.count) as count, dd.value
-                    FROM discussion_data_point as ddp
-                         JOIN discussion_data as dd ON (ddp.discussion_data_point_id = dd.id)
-                         JOIN publication_author as pfos on ddp.publication_doi = pfos.publication_doi
-                    WHERE type = :type and value != 'und' and value != 'unknown' AND pfos.author_id=:id """
+        join = ' JOIN publication_author as pa on b.publication_doi = pa.publication_doi '
+        where = ' AND pa.author_id = :id '
         params['id'] = id
-        extra +=  " GROUP BY dd.id "
-    elif doi: # default publication
-        query = """SELECT SUM(ddp.count) as count, dd.value
-                    FROM discussion_data_point as ddp
-                         JOIN discussion_data as dd ON (ddp.discussion_data_point_id = dd.id)
-                    WHERE type = :type and value != 'und' and value != 'unknown' AND publication_doi=:doi """
+    elif doi:
+        where = ' AND b.publication_doi = :doi '
         params['doi'] = doi
-        extra +=  " GROUP BY dd.id "
-    else:  # default publication
-        query = """SELECT count, dd.value
-                    FROM counted_discussion_data
-                    JOIN discussion_data as dd ON (discussion_data_point_id = dd.id)
-                    WHERE type = :type and value != 'und' and value != 'unknown' """
-
-    extra += """ ORDER BY count DESC """
 
+    query = """
+        SELECT count, value, type, p, total FROM (
+            SELECT SUM(b.count) as count, dd.value, dd.type,
+                ROUND(SUM(b.count) / CAST(SUM(SUM(b.count)) OVER (PARTITION BY dd.type) AS FLOAT) * 1000) / 10 as p,
+                SUM(SUM(b.count)) OVER (PARTITION BY dd.type) as total,
+                ROW_NUMBER() OVER (PARTITION BY dd.type ORDER BY SUM(b.count) DESC) as rank
+            FROM discussion_count_bucket b
+                JOIN discussion_data as dd ON (b.discussion_data_id = dd.id)
+                """ + join + """
+            WHERE b.bucket_start >= :since AND dd.type = ANY(:types) and value != 'und' and value != 'unknown'
+                """ + where + """
+            GROUP BY dd.id
+        ) r
+    """
     if limit:
+        query += " WHERE rank <= :limit "
         params['limit'] = limit
-        extra += " LIMIT :limit "
-
-    query += extra
-    s = text(query)
-    # print(query)
-    # print(params)
-
-    if 'doi' in params and 'limit' in params:
-        # print('type, doi, limit')
-        s = s.bindparams(bindparam('type'), bindparam('doi'), bindparam('limit'))
-    elif 'doi' in params:
-        # print('doi, type')
-        s = s.bindparams(bindparam('type'), bindparam('doi'))
-    elif 'limit' in params:
-        # print('type, limit')
-        s = s.bindparams(bindparam('type'), bindparam('limit'))
-    else:
-        # print('type')
-        s = s.bindparams(bindparam('type'))
+    query += " ORDER BY type, count DESC "
+    s = text(query).bindparams(*[bindparam(p) for p in params])
+
+    result = {dd_type: [] for dd_type in dd_types}
+    totals = {}
+    for count, value, dd_type, p, total in session.execute(s, params):
+        totals[dd_type] = total
+        if min_percentage is None:
+            result[dd_type].append({'count': count, 'value': value})
+        elif p >= min_percentage:
+            result[dd_type].append({'value': value, 'count': count, 'p': p})
+    if min_percentage is not None:
+        for dd_type, rows in result.items():
+            rows.insert(0, {'value': 'total', 'count': totals.get(dd_type), 'p': 100})
+    return result
 
-    return session.execute(s, params).fetchall()
 
+def get_numbers_influx(query_api, dois, duration="currently", fields=None, filter_strategy=None, single_pass=True):
+    """
+    get numbers from influx, switch between getting (total) and calculating (for dois)
 
-def get_numbers_influx(query_api, dois, duration="currently", fields=None):
-    """ get numbers from influx, switch between getting (total) and calculating (for dois) """
+    - **single_pass**: read all fields with one pipeline (see get_numbers_single_pass_influx) instead of one
+        pipeline per field
+    """
     if fields is None:
         fields = ["score"]
 
@@ -429,8 +545,12 @@ def get_numbers_influx(query_api, dois, duration="currently", fields=None):
         '_bucket': trending_time_definition[duration]['name'],
     }
 
+    if single_pass:
+        return get_numbers_single_pass_influx(query_api, query, params, dois, duration, fields, filter_strategy)
+
     if dois:
-        filter_obj = doi_filter_list(dois, params)
+        filter_obj = doi_filter_list(dois, params, filter_strategy)
+        query = filter_obj['header'] + query
 
         # print('get numbers')
         for field in fields:
@@ -452,20 +572,99 @@ def get_numbers_influx(query_api, dois, duration="currently", fields=None):
     return result
 
 
+def get_numbers_single_pass_influx(query_api, query, params, dois, duration="currently", fields=None,
+                                   filter_strategy=None):
+    """
+    get numbers for all fields in one pass, the bucket is filtered once by the set of needed fields and each
+    aggregator runs on that stream grouped by _field, returns the same {field: value} dict as get_numbers_influx
+    """
+    fields = [field for field in dict.fromkeys(fields) if field in number_aggregation_field]
+    if not fields:
+        return {}
+
+    if not dois:
+        # the task already aggregated the totals, the last value of each field
+        query += """
+            from(bucket: "numbers")
+                |> range(start: _start, stop: _stop)
+                |> filter(fn: (r) => r["_measurement"] == """ + '"' + duration + '"' + """)
+                |> filter(fn: (r) => """ + field_set_filter(fields) + """)
+                |> last()
+                |> keep(columns: ["_value", "_time", "_field"])
+                |> yield(name: "numbers")
+            """
+        tables = query_api.query(query, params=params)
+        result = {}
+        for table in tables:
+            for record in table.records:
+                result[record['_field']] = record['_value']
+        return result
+
+    # requested fields per aggregator and selected influx field, count and pub_count are computed from score
+    branches = {}
+    for field in fields:
+        if field == "pub_count":
+            continue
+        aggregator = number_aggregation_field[field]
+        field_selector = field
+        if field == "count":
+            if duration == "currently":
+                field_selector = "score"
+            else:
+                aggregator = "sum"
+        branches.setdefault(aggregator, {}).setdefault(field_selector, []).append(field)
+
+    selectors = [selector for by_selector in branches.values() for selector in by_selector]
+    if "pub_count" in fields:
+        selectors.append("score")
+
+    filter_obj = doi_filter_list(dois, params, filter_strategy)
+    query = filter_obj['header'] + query + """
+            data = from(bucket: _bucket)
+                |> range(start: _start, stop: _stop)
+                |> filter(fn: (r) => r["_measurement"] == "trending")
+                |> filter(fn: (r) => """ + field_set_filter(selectors) + """)""" + filter_obj['string'] + """
+            """
+    if "pub_count" in fields:
+        query += """
+            data
+                |> filter(fn: (r) => r["_field"] == "score")
+                |> group()
+                |> distinct(column: "doi")
+                |> count()
+                |> yield(name: "pub_count")
+            """
+    for aggregator, by_selector in branches.items():
+        query += """
+            data
+                |> filter(fn: (r) => """ + field_set_filter(by_selector) + """)
+                |> group(columns: ["_field"])
+                |> """ + aggregator + """()
+                |> keep(columns: ["_value", "_field"])
+                |> yield(name: """ + '"' + aggregator + '"' + """)
+            """
+    # print(query)
+    tables = query_api.query(query, params=filter_obj['params'])
+
+    result = {}
+    for table in tables:
+        for record in table.records:
+            if record['result'] == 'pub_count':
+                result['pub_count'] = record['_value']
+                continue
+            for field in branches.get(record['result'], {}).get(record['_field'], []):
+                result[field] = record['_value']
+    return result
+
+
+def field_set_filter(fields):
+    """ flux predicate matching any of the given (known) fields """
+    return ' or '.join('r["_field"] == "' + field + '"' for field in dict.fromkeys(fields))
+
+
 def get_task_number_influx(duration="currently", field="score"):
     """ get number from task (own bucket for total numbers, returns string query) """
-    aggregation_field = {
-        'bot_rating': 'mean',
-        'contains_abstract_raw': 'mean',
-        'exclamations': 'mean',
-        'followers': 'sum',
-        'length': 'mean',
-        'questions': 'mean',
-        'score': 'sum',
-        'sentiment_raw': 'mean',
-        "pub_count": "count",
-        "count": "count"
-    }
+    aggregation_field = number_aggregation_field
 
     if field not in aggregation_field:
         # print('not in field')
@@ -487,18 +686,7 @@ def get_task_number_influx(duration="currently", field="score"):
 
 def get_number_influx(filter_obj, duration="currently", field="score"):
     """ get influx number for specific dois calculating, returns string query"""
-    aggregation_field = {
-        'bot_rating': 'mean',
-        'contains_abstract_raw': 'mean',
-        'exclamations': 'mean',
-        'followers': 'sum',
-        'length': 'mean',
-        'questions': 'mean',
-        'score': 'sum',
-        'sentiment_raw': 'mean',
-        "pub_count": "count",
-        "count": "count"
-    }
+    aggregation_field = number_aggregation_field
 
     if field not in aggregation_field:
         # print('not in field')
@@ -544,7 +732,20 @@ def get_number_influx(filter_obj, duration="currently", field="score"):
 
 
 def get_profile_information_for_doi(session: Session, doi, id, mode="publication", duration="currently"):
-    """ get profile information for a doi, fieldOfStudy or Author"""
+    """ get profile information for a doi, fieldOfStudy or Author, authors and fields of study are read from the
+        snapshot if available """
+    if mode in ("author", "fieldOfStudy") and trending_snapshot.available:
+        s = text("""
+            SELECT """ + ', '.join(profile_columns) + """
+            FROM trending_entity_profile
+            WHERE entity = :entity AND id = :id AND duration = :duration
+        """).bindparams(bindparam('entity'), bindparam('id'), bindparam('duration'))
+        row = session.execute(s, {'entity': mode, 'id': id, 'duration': duration}).fetchone()
+        if row is None:
+            # no trending publication, like the averages of an empty set
+            return dict.fromkeys(profile_columns)
+        return row._asdict()
+
     query = """
             SELECT AVG(mean_score)          mean_score,
                    AVG(abstract_difference) abstract_difference,
@@ -643,13 +844,18 @@ def get_top_n_dois(query_api, duration="currently", field="count", n=5):
         # print(query)
         # print(params)
 
-        tables = query_api.query(query, params=params)
-        results = []
-        for table in tables:
-            for record in table.records:
-                results.append(record['doi'])
-        # print(results)
-        return results
+        def query_top_n():
+            tables = query_api.query(query, params=params)
+            results = []
+            for table in tables:
+                for record in table.records:
+                    results.append(record['doi'])
+            # print(results)
+            return results
+
+        # the range ends at the last window boundary, so the result is the same until the next one
+        key = ('top_n', params['_bucket'], field, n)
+        return flux_cache.get_or_query(key, params['_window_time'], query_top_n)
 
 
 def get_top_n_trending_dois(session: Session, duration="currently", n=5):
@@ -714,7 +920,7 @@ def get_window_chart_data(query_api, session: Session, duration="currently", fie
         query = """
             import "experimental"
             import "date"
-            
+            """ + filter_obj['header'] + """
             _start = experimental.subDuration(d: _duration_time, from: date.truncate(t: now(), unit: _window_time))
             _stop =  date.truncate(t: now(), unit: _window_time)
     
@@ -728,7 +934,9 @@ def get_window_chart_data(query_api, session: Session, duration="currently", fie
              |> keep(columns: ["_value", "_time", "_field", "doi"])
              |> yield()
         """
-        tables = query_api.query(query, params=filter_obj['params'])
+        key = ('window_chart', params['_bucket'], field, aggregator, tuple(sorted(set(doi_list))))
+        tables = flux_cache.get_or_query(key, params['_window_time'],
+                                         lambda: query_api.query(query, params=filter_obj['params']))
         titles = get_titles_for_dois(session, doi_list)
 
         results = []
@@ -777,7 +985,7 @@ def get_trending_chart_data(query_api, session: Session, duration="currently", f
 
     filter_obj = doi_filter_list(doi_list, params)
 
-    query = """
+    query = filter_obj['header'] + """
        a = from(bucket: _bucket)
          |> range(start: _start)
          |> filter(fn: (r) => r["_measurement"] == "trending") 
@@ -809,19 +1017,55 @@ def get_trending_chart_data(query_api, session: Session, duration="currently", f
     return results
 
 
-def doi_filter_list(doi_list, params):
-    """ influx helper adding a doi filter list (faster than array check in influx) """
-    if doi_list:
+def doi_filter_list(doi_list, params, strategy=None):
+    """
+    influx helper adding a doi filter, returns the filter string, the params and a header that has to be placed
+    after the imports of the query
+
+    - **strategy**: 'or' chains one bound parameter per doi, the storage engine can use it as predicate but parsing
+        and evaluating it grows with every doi. 'set' defines a dict of all dois once and filters with a hash lookup,
+        its cost does not grow with the list. 'contains' checks an array parameter (linear per row, for comparison).
+        By default lists up to DOI_FILTER_OR_MAX dois use 'or' and longer ones 'set'.
+    """
+    if not doi_list:
+        return {"string": '', "params": params, "header": ''}
+
+    doi_list = list(dict.fromkeys(doi_list))
+    if strategy is None:
+        strategy = 'or' if len(doi_list) <= DOI_FILTER_OR_MAX else 'set'
+
+    if strategy == 'set':
+        # records can not be passed as params, the dois are flux string literals
+        pairs = ', '.join('{key: "' + flux_string(doi) + '", value: true}' for doi in doi_list)
+        header = """
+            import "dict"
+
+            _doi_set = dict.fromList(pairs: [""" + pairs + """])
+            """
         filter_string = """
+                |> filter(fn: (r) => dict.get(dict: _doi_set, key: r["doi"], default: false))"""
+        return {"string": filter_string, "params": params, "header": header}
+
+    if strategy == 'contains':
+        params['_doi_list'] = doi_list
+        filter_string = """
+                |> filter(fn: (r) => contains(value: r["doi"], set: _doi_list))"""
+        return {"string": filter_string, "params": params, "header": ''}
+
+    filter_string = """
                 |> filter(fn: (r) => """
-        i = 0
-        for doi in doi_list:
-            filter_string += 'r["doi"] == _doi_nr_' + str(i) + ' or '
-            params['_doi_nr_' + str(i)] = doi
-            i += 1
-        filter_string = filter_string[:-4] + ')'
-        return {"string": filter_string, "params": params}
-    return {"string": '', "params": params}
+    i = 0
+    for doi in doi_list:
+        filter_string += 'r["doi"] == _doi_nr_' + str(i) + ' or '
+        params['_doi_nr_' + str(i)] = doi
+        i += 1
+    filter_string = filter_string[:-4] + ')'
+    return {"string": filter_string, "params": params, "header": ''}
+
+
+def flux_string(value):
+    """ escape a value for a flux string literal """
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('${', '\\${')
 
 
 def system_running_check(query_api):
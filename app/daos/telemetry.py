@@ -0,0 +1,130 @@
+"""Telemetry
+ buffer monitoring points in memory and write them to the influxdb in batches from a background thread, so
+ requests never wait for the monitoring round trip
+"""
+import os
+import queue
+import threading
+import time
+
+from app.daos.database import write_api, org
+
+# read in telemetry config
+TELEMETRY_BUCKET = os.environ.get('TELEMETRY_BUCKET', 'api_monitor')
+TELEMETRY_QUEUE_SIZE = int(os.environ.get('TELEMETRY_QUEUE_SIZE', 10000))
+TELEMETRY_BATCH_SIZE = int(os.environ.get('TELEMETRY_BATCH_SIZE', 500))
+TELEMETRY_FLUSH_INTERVAL = float(os.environ.get('TELEMETRY_FLUSH_INTERVAL', 5))
+
+
+class TelemetryWriter(object):
+    """
+    bounded queue of influx points flushed by a daemon thread whenever either batch_size points are waiting or
+    flush_interval seconds passed since the last write, producers never block (they run on the event loop), points
+    arriving while the queue is full are dropped and counted
+    """
+
+    def __init__(self, write_api, bucket, org, max_queue_size=10000, batch_size=500, flush_interval=5.0):
+        self.write_api = write_api
+        self.bucket = bucket
+        self.org = org
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.lock = threading.Lock()
+
+        self.submitted = 0
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+        self.batches = 0
+
+    def start(self):
+        """ start the background flusher, calling it twice is a no-op """
+        if self.thread and self.thread.is_alive():
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, name='telemetry-flusher', daemon=True)
+        self.thread.start()
+
+    def submit(self, point):
+        """ queue a point without waiting for influx, returns False if the point was dropped """
+        try:
+            self.queue.put_nowait(point)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+            return False
+
+        with self.lock:
+            self.submitted += 1
+        return True
+
+    def stop(self, timeout=10.0):
+        """ stop the flusher and write everything still queued """
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join(timeout)
+            self.thread = None
+        # drain whatever arrived after the thread left its loop
+        self._flush(self._drain(self.queue.qsize()))
+
+    def stats(self):
+        """ counters of the telemetry pipeline """
+        with self.lock:
+            return {
+                'queued': self.queue.qsize(),
+                'submitted': self.submitted,
+                'dropped': self.dropped,
+                'written': self.written,
+                'failed': self.failed,
+                'batches': self.batches,
+            }
+
+    def _drain(self, limit):
+        """ take up to limit points from the queue without blocking """
+        batch = []
+        while len(batch) < limit:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        """ flusher loop, a batch is written when it is full or the flush interval is over """
+        while not self.stop_event.is_set():
+            batch = []
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size and not self.stop_event.is_set():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=min(remaining, 0.5)))
+                except queue.Empty:
+                    continue
+                batch.extend(self._drain(self.batch_size - len(batch)))
+            self._flush(batch)
+
+    def _flush(self, batch):
+        """ write a batch to influx, failures are counted and the points discarded """
+        if not batch:
+            return
+        try:
+            self.write_api.write(self.bucket, self.org, batch)
+        except Exception as e:
+            print('telemetry write failed: %s' % e)
+            with self.lock:
+                self.failed += len(batch)
+            return
+
+        with self.lock:
+            self.written += len(batch)
+            self.batches += 1
+
+
+telemetry = TelemetryWriter(write_api, TELEMETRY_BUCKET, org, max_queue_size=TELEMETRY_QUEUE_SIZE,
+                            batch_size=TELEMETRY_BATCH_SIZE, flush_interval=TELEMETRY_FLUSH_INTERVAL)
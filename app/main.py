@@ -1,6 +1,8 @@
 import time
 from datetime import datetime
 from fastapi import FastAPI, Request
+from starlette.responses import PlainTextResponse
+from starlette.routing import Match
 from fastapi.middleware.cors import CORSMiddleware
 import os
 import sentry_sdk
@@ -10,11 +12,25 @@ from app.routers.publication import router as PublicationRouter
 from app.routers.stats import router as StatsRouter
 from app.routers.field_of_study import router as FieldOfStudyRouter
 from app.routers.author import router as AuthorRouter
-from starlette.responses import JSONResponse
-from app.daos.database import SessionLocal, engine, query_api, write_api, org
+from app.routers.live import router as LiveRouter
+from app.daos.encoder import OrjsonResponse
+from app.daos.database import (
+    engine, async_engine, async_query_api, run_with_async_influx, open_async_influx, close_async_influx
+)
+from app.daos.telemetry import telemetry
+from app.daos.metrics import metrics, stats_gauges
+from app.daos.cache import response_cache
+from app.daos.flux_cache import flux_cache
+from app.daos.instrumentation import start_request, server_timing, QUERY_TIMING_HEADER
+from app.daos.snapshot import trending_snapshot
+from app.daos.discussion_counts import discussion_counts
+from app.daos.freshness import data_freshness
+from app.daos.replica import trending_replica
+from app.daos.live import live_hub
 
 from app.daos.stats import (
     system_running_check,
+    discussion_cache,
 )
 
 SENTRY_DSN = os.environ.get('SENTRY_DSN')
@@ -40,6 +56,9 @@ Get Field of Study data.
 ## Stats
 Get statistical numbers, data and more for Publications.
 
+## Live
+Push trending updates (server sent events or websocket) instead of polling.
+
 ## default
 Utilities.
 """
@@ -90,11 +109,19 @@ app.add_middleware(
 @app.middleware("http")
 async def add_process_time_header(request: Request, call_next):
     """
-    store process time in the influxdb for statistics
+    store process time and the time spent in queries in the influxdb for statistics, the point is only queued here
+    and written in batches by the telemetry flusher
     """
     start_time = time.time()
+    # the route template keeps the tags of the query timings bounded, the path contains dois and ids
+    route = route_template(request)
+    timings = start_request(route)
     response = await call_next(request)
     process_time = time.time() - start_time
+    metrics.observe('http_request_duration_seconds', process_time, route=route, method=request.method,
+                    status=response.status_code)
+    if QUERY_TIMING_HEADER and timings:
+        response.headers['Server-Timing'] = server_timing(timings)
     point = {
         "measurement": "response_time",
         "tags": {
@@ -102,25 +129,196 @@ async def add_process_time_header(request: Request, call_next):
         },
         "fields": {
             'response_time': int(process_time * 1000),
-            'url': str(request.url)
+            'url': str(request.url),
+            'sql_time': sum((t[2] for t in timings if t[0] == 'sql'), 0.0),
+            'flux_time': sum((t[2] for t in timings if t[0] == 'flux'), 0.0),
+            'queries': len(timings),
         },
         "time": datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')}
 
-    print(point)
-    write_api.write('api_monitor', org, [point])
+    telemetry.submit(point)
     return response
 
 
+def route_template(request: Request):
+    """
+    path of the matching route, keeps the metric labels bounded for unknown paths
+    """
+    for route in app.router.routes:
+        match, _ = route.matches(request.scope)
+        if match == Match.FULL:
+            return route.path
+    return 'unmatched'
+
+
+@app.on_event("startup")
+def start_metrics():
+    """
+    register the pool, cache and telemetry gauges and start writing the metrics of this worker
+    """
+    metrics.register('db_pool_connections', lambda: {
+        **stats_gauges(pool_stats(engine.pool), engine='sync'),
+        **stats_gauges(pool_stats(async_engine.sync_engine.pool), engine='async'),
+    })
+    metrics.register('response_cache', lambda: stats_gauges(response_cache.stats()))
+    metrics.register('flux_cache', lambda: stats_gauges(flux_cache.stats()))
+    metrics.register('discussion_cache', lambda: stats_gauges(discussion_cache.stats()))
+    metrics.register('telemetry', lambda: stats_gauges(telemetry.stats()))
+    metrics.register('live_trending', lambda: stats_gauges(live_hub.stats()))
+    metrics.register('data_freshness', lambda: stats_gauges(data_freshness.stats()))
+    metrics.register('trending_replica', lambda: stats_gauges(trending_replica.stats()))
+    metrics.start()
+
+
+@app.on_event("shutdown")
+def stop_metrics():
+    """
+    write the final metrics of this worker
+    """
+    metrics.stop()
+
+
+def pool_stats(pool):
+    """
+    connection counts of a sqlalchemy queue pool
+    """
+    return {'size': pool.size(), 'checked_in': pool.checkedin(), 'checked_out': pool.checkedout(),
+            'overflow': pool.overflow()}
+
+
+@app.get("/metrics", include_in_schema=False)
+def get_metrics():
+    """
+    metrics of all workers in the prometheus text format
+    """
+    return PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4')
+
+
+@app.on_event("startup")
+def start_telemetry():
+    """
+    start the background telemetry flusher
+    """
+    telemetry.start()
+
+
+@app.on_event("shutdown")
+def stop_telemetry():
+    """
+    write all queued telemetry points before the worker exits
+    """
+    telemetry.stop()
+
+
+@app.on_event("startup")
+async def start_async_influx():
+    """
+    create the async influx client on the event loop of the worker
+    """
+    await open_async_influx()
+
+
+@app.on_event("shutdown")
+async def stop_async_influx():
+    """
+    close the async influx client
+    """
+    await close_async_influx()
+
+
+@app.on_event("startup")
+def start_trending_snapshot():
+    """
+    read trending rankings from the snapshot views if they exist and keep them refreshed
+    """
+    trending_snapshot.start()
+
+
+@app.on_event("shutdown")
+def stop_trending_snapshot():
+    """
+    stop the snapshot refresh thread
+    """
+    trending_snapshot.stop()
+
+
+@app.on_event("startup")
+def start_discussion_counts():
+    """
+    read the discussion counts of authors and fields of study if they exist and keep them up to date
+    """
+    discussion_counts.start()
+
+
+@app.on_event("shutdown")
+def stop_discussion_counts():
+    """
+    stop the discussion count collect thread
+    """
+    discussion_counts.stop()
+
+
+@app.on_event("startup")
+def start_data_freshness():
+    """
+    read the data versions and keep them up to date
+    """
+    data_freshness.start()
+
+
+@app.on_event("shutdown")
+def stop_data_freshness():
+    """
+    stop the data version check thread
+    """
+    data_freshness.stop()
+
+
+@app.on_event("startup")
+def start_trending_replica():
+    """
+    load the in memory trending replica (if enabled), it is reloaded on every data version change
+    """
+    trending_replica.start()
+
+
+@app.on_event("startup")
+async def start_live_hub():
+    """
+    start the kafka consumer pushing trending updates to the live subscribers
+    """
+    await live_hub.start()
+
+
+@app.on_event("shutdown")
+async def stop_live_hub():
+    """
+    stop the live trending consumer
+    """
+    await live_hub.stop()
+
+
 app.include_router(PublicationRouter, tags=["Publication"], prefix="/api/trend/publication")
 app.include_router(FieldOfStudyRouter, tags=["FieldOfStudy"], prefix="/api/trend/fieldOfStudy")
 app.include_router(AuthorRouter, tags=["Author"], prefix="/api/trend/author")
 app.include_router(StatsRouter, tags=["Stats"], prefix="/api/trend/stats")
+app.include_router(LiveRouter, tags=["Live"], prefix="/api/trend/live")
 
 
 @app.get("/api/trend/available", response_description="available", summary="Check if api is available.")
-def is_api_available():
+async def is_api_available():
     """
     Checks if the api is running as expected.
     It returns 'ok' normally, if there is to little data in the last few minutes it will return 'not running'
     """
-    return JSONResponse(content=system_running_check(query_api))
+    return OrjsonResponse(content=await run_with_async_influx(system_running_check, async_query_api))
+
+
+@app.get("/api/trend/version", response_description="version", summary="Data version per duration.")
+def get_data_version():
+    """
+    Returns the data version and the time of the last change of every duration. The version increases whenever the
+    trending data of the duration changed, clients can poll it and reload only if it changed.
+    """
+    return OrjsonResponse(content={duration: {'version': version, 'updated_at': updated_at}
+                                   for duration, (version, updated_at) in data_freshness.versions.items()})
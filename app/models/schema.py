@@ -202,3 +202,5 @@ class TimeValue(BaseModel):
 class AmbaResponse(BaseModel):
     time: Optional[int]
     results: List[dict]
+    next_cursor: Optional[str]
+    total_count: Optional[int]
@@ -1,37 +1,39 @@
 import time
+from typing import Optional
 from app.models.schema import StatValue, Publication, TimeValue, AmbaResponse
-from fastapi import APIRouter, Depends, HTTPException
-from fastapi.encoders import jsonable_encoder
-from sqlalchemy.orm import Session  # type: ignore
+from fastapi import APIRouter, Depends, HTTPException, Request
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.daos.database import SessionLocal, engine
+from app.daos.cache import response_cache
+from app.daos.encoder import OrjsonResponse
+from app.daos.export import export_response, export_formats
+from app.daos.pagination import InvalidCursor
+from app.daos.search import autocomplete
+from app.daos.database import AsyncSessionLocal, engine
 from app.daos.field_of_study import (
     get_fields_of_study,
     retrieve_field_of_study,
     get_trending_fields_of_study,
 )
 import event_stream.models.model as models
-from starlette.responses import JSONResponse
 
 models.Base.metadata.create_all(bind=engine)
 router = APIRouter()
 
 
-def get_session():
+async def get_session():
     """
-    get/create a session
+    get/create an async session
     """
-    session = SessionLocal()
-    try:
+    async with AsyncSessionLocal() as session:
         yield session
-    finally:
-        session.close()
 
 
 @router.get("/trending", summary="Get trending Fields of Study.", response_model=AmbaResponse)
-def get_trending_fields_of_study_router(
+async def get_trending_fields_of_study_router(
         offset: int = 0, limit: int = 10, sort: str = 'score', order: str = 'desc', search: str = '',
-        duration: str = "currently", session: Session = Depends(get_session)):
+        duration: str = "currently", cursor: Optional[str] = None, with_count: bool = False,
+        request: Request = None, session: AsyncSession = Depends(get_session)):
     """
         Return trending fields of study and their trending data for a given duration.
 
@@ -41,19 +43,37 @@ def get_trending_fields_of_study_router(
                     'abstract_difference', 'tweet_author_diversity', 'lan_diversity', 'location_diversity', 'mean_age',
                     'mean_length', 'avg_questions', 'avg_exclamations', 'projected_change'
         - **order**: 'asc' or 'desc'
-        - **search**: search keyword (title only)
+        - **search**: search keyword (title only), sort 'relevance' orders by similarity to it
         - **duration**: the duration of data that should be queried, 'currently' (default), 'today', 'week', 'month',
             'year'
+        - **cursor**: (optional) use keyset pagination, pass an empty cursor for the first page and the returned
+            next_cursor for the following pages, offset is ignored
+        - **with_count**: (optional, keyset pagination only) also return the total count
         """
     start = time.time()
-    item = get_trending_fields_of_study(session=session, offset=offset, limit=limit, sort=sort, order=order,
-                                        duration=duration, search=search)
-    json_compatible_item_data = jsonable_encoder(item)
-    return JSONResponse(content={"time": round((time.time() - start) * 1000), "results": json_compatible_item_data})
+    cache_key = response_cache.key('fieldOfStudy/trending', offset=offset, limit=limit, sort=sort, order=order,
+                                   search=search, duration=duration, cursor=cursor, with_count=with_count)
+    cached = response_cache.cached_response(cache_key, duration, request, start)
+    if cached is not None:
+        return cached
+
+    try:
+        item = await session.run_sync(lambda s: get_trending_fields_of_study(
+            session=s, offset=offset, limit=limit, sort=sort, order=order, duration=duration, search=search,
+            cursor=cursor, with_count=with_count))
+    except InvalidCursor:
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
+    if cursor is not None:
+        return response_cache.respond(cache_key, duration, {"time": round((time.time() - start) * 1000),
+                                                             "results": item['results'],
+                                                             "next_cursor": item['next_cursor'],
+                                                             "total_count": item['total_count']})
+    return response_cache.respond(cache_key, duration, {"time": round((time.time() - start) * 1000),
+                                                         "results": item})
 
 
 @router.get("/get", summary="Get Field of Study.", response_model=AmbaResponse)
-def get_field_of_study_data(id: int, session: Session = Depends(get_session), with_pubs: bool = False):
+async def get_field_of_study_data(id: int, session: AsyncSession = Depends(get_session), with_pubs: bool = False):
     """
         Get field of study data for a given id. it will also return the publication data of all publications in a given
         field of study.
@@ -61,6 +81,32 @@ def get_field_of_study_data(id: int, session: Session = Depends(get_session), wi
         - **id**: id of the field of study to get
         """
     start = time.time()
-    item = retrieve_field_of_study(session, id, with_pubs)
-    json_compatible_item_data = jsonable_encoder(item)
-    return JSONResponse(content={"time": round((time.time() - start) * 1000), "results": json_compatible_item_data})
+    item = await session.run_sync(retrieve_field_of_study, id, with_pubs)
+    return OrjsonResponse(content={"time": round((time.time() - start) * 1000), "results": item})
+
+
+@router.get("/publications/export", summary="Export publications of a field of study.")
+async def export_field_of_study_publications(id: int, format: str = 'ndjson'):
+    """
+    Stream all publications of a field of study as ndjson (one json object per line) or csv.
+
+    - **id**: id of the field of study
+    - **format**: 'ndjson' (default) or 'csv'
+    """
+    if format not in export_formats:
+        raise HTTPException(status_code=400, detail="Unknown format.")
+    return export_response('field_of_study_publications', {'id': id}, format, 'field_of_study_publications_' + str(id))
+
+
+@router.get("/autocomplete", summary="Autocomplete fields of study.", response_model=AmbaResponse)
+async def get_field_of_study_autocomplete(q: str, limit: int = 10, session: AsyncSession = Depends(get_session)):
+    """
+    Return the top field of study names containing the given text, names starting with it first.
+    Returns an empty result for less than 3 characters or if the lookup takes too long.
+
+    - **q**: text to complete
+    - **limit**: (optional, 10, max 50) limit the result
+    """
+    start = time.time()
+    item = await session.run_sync(autocomplete, 'fieldOfStudy', q, limit)
+    return OrjsonResponse(content={"time": round((time.time() - start) * 1000), "results": item})
@@ -0,0 +1,72 @@
+import asyncio
+
+from fastapi import APIRouter, HTTPException, WebSocket
+from starlette.responses import StreamingResponse
+from starlette.websockets import WebSocketDisconnect
+
+from app.daos.encoder import dumps
+from app.daos.live import live_hub
+
+router = APIRouter()
+
+# seconds without a message after which a keep alive comment is sent to sse clients
+KEEP_ALIVE = 15
+
+
+@router.get("/trending", summary="Stream trending updates (server sent events).")
+async def stream_trending(duration: str = "currently", entity: str = 'publication'):
+    """
+        Server sent events of the trending table of an entity. The first event ('snapshot') contains the current top
+        rows, every following event ('diff') contains the changed rows, the removed keys and the new order of the keys
+        (doi for publications, id for authors and fields of study).
+
+        - **duration**: the duration of data that should be streamed, 'currently' (default), 'today', 'week', 'month',
+            'year'
+        - **entity**: 'publication' (default), 'author' or 'fieldOfStudy'
+    """
+    try:
+        queue = await live_hub.subscribe(duration, entity)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Unknown duration or entity.")
+
+    async def events():
+        try:
+            while True:
+                try:
+                    message = await asyncio.wait_for(queue.get(), KEEP_ALIVE)
+                except asyncio.TimeoutError:
+                    yield b': keep-alive\n\n'
+                    continue
+                yield b'event: ' + message['type'].encode() + b'\ndata: ' + dumps(message) + b'\n\n'
+        finally:
+            live_hub.unsubscribe(duration, entity, queue)
+
+    # an explicit content encoding keeps the gzip middleware from buffering the events
+    return StreamingResponse(events(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'Content-Encoding': 'identity',
+                                      'X-Accel-Buffering': 'no'})
+
+
+@router.websocket("/ws")
+async def websocket_trending(websocket: WebSocket, duration: str = "currently", entity: str = 'publication'):
+    """
+        Websocket of the trending table of an entity, sends the same messages as the server sent events.
+
+        - **duration**: the duration of data that should be streamed, 'currently' (default), 'today', 'week', 'month',
+            'year'
+        - **entity**: 'publication' (default), 'author' or 'fieldOfStudy'
+    """
+    try:
+        queue = await live_hub.subscribe(duration, entity)
+    except ValueError:
+        await websocket.close(code=1008)
+        return
+    await websocket.accept()
+    try:
+        while True:
+            message = await queue.get()
+            await websocket.send_text(dumps(message).decode())
+    except WebSocketDisconnect:
+        pass
+    finally:
+        live_hub.unsubscribe(duration, entity, queue)
@@ -1,15 +1,21 @@
 import logging
 import time
+from typing import List, Optional
 from urllib.parse import unquote
 
 from app.models.schema import StatValue, Publication, TimeValue, AmbaResponse
-from fastapi import APIRouter, Depends, HTTPException
-from fastapi.encoders import jsonable_encoder
-from sqlalchemy.orm import Session  # type: ignore
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.daos.database import SessionLocal, engine, query_api
+from app.daos.cache import response_cache
+from app.daos.encoder import OrjsonResponse
+from app.daos.export import export_response, export_formats
+from app.daos.pagination import InvalidCursor
+from app.daos.search import autocomplete
+from app.daos.database import AsyncSessionLocal, engine
 from app.daos.publication import (
     retrieve_publication,
+    retrieve_publications,
     get_publications,
     get_trending_publications,
     get_trending_publications_for_field_of_study,
@@ -17,27 +23,27 @@ from app.daos.publication import (
     get_trending_publications_for_author
 )
 import event_stream.models.model as models
-from starlette.responses import JSONResponse
 
 models.Base.metadata.create_all(bind=engine)
 router = APIRouter()
 
+# maximum number of dois per batch request
+PUBLICATION_BATCH_LIMIT = 50
 
-def get_session():
+
+async def get_session():
     """
-    get/create a session
+    get/create an async session
     """
-    session = SessionLocal()
-    try:
+    async with AsyncSessionLocal() as session:
         yield session
-    finally:
-        session.close()
 
 
 @router.get("/trending", summary="Get trending publications.", response_model=AmbaResponse)
-def get_trending_publications_router(
+async def get_trending_publications_router(
         offset: int = 0, limit: int = 10, sort: str = 'score', order: str = 'desc', search: str = '',
-        duration: str = "currently", session: Session = Depends(get_session)
+        duration: str = "currently", cursor: Optional[str] = None, with_count: bool = False,
+        request: Request = None, session: AsyncSession = Depends(get_session)
 ):
     """
     Return publication trending data for a given duration.
@@ -48,21 +54,55 @@ def get_trending_publications_router(
                 'abstract_difference', 'tweet_author_diversity', 'lan_diversity', 'location_diversity', 'mean_age',
                 'mean_length', 'avg_questions', 'avg_exclamations', 'projected_change'
     - **order**: 'asc' or 'desc'
-    - **search**: search keyword (title only)
+    - **search**: search keyword (title only), sort 'relevance' orders by similarity to it
     - **duration**: the duration of data that should be queried, 'currently' (default), 'today', 'week', 'month',
         'year'
+    - **cursor**: (optional) use keyset pagination, pass an empty cursor for the first page and the returned
+        next_cursor for the following pages, offset is ignored
+    - **with_count**: (optional, keyset pagination only) also return the total count
     """
     start = time.time()
-    item = get_trending_publications(session=session, offset=offset, limit=limit, sort=sort, order=order,
-                                     duration=duration, search=search)
-    json_compatible_item_data = jsonable_encoder(item)
-    return JSONResponse(content={"time": round((time.time() - start) * 1000), "results": json_compatible_item_data})
+    cache_key = response_cache.key('publication/trending', offset=offset, limit=limit, sort=sort, order=order,
+                                   search=search, duration=duration, cursor=cursor, with_count=with_count)
+    cached = response_cache.cached_response(cache_key, duration, request, start)
+    if cached is not None:
+        return cached
+
+    try:
+        item = await session.run_sync(lambda s: get_trending_publications(
+            session=s, offset=offset, limit=limit, sort=sort, order=order, duration=duration, search=search,
+            cursor=cursor, with_count=with_count))
+    except InvalidCursor:
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
+    if cursor is not None:
+        return response_cache.respond(cache_key, duration, {"time": round((time.time() - start) * 1000),
+                                                             "results": item['results'],
+                                                             "next_cursor": item['next_cursor'],
+                                                             "total_count": item['total_count']})
+    return response_cache.respond(cache_key, duration, {"time": round((time.time() - start) * 1000),
+                                                         "results": item})
+
+
+@router.get("/trending/export", summary="Export trending publications.")
+async def export_trending_publications(duration: str = "currently", format: str = 'ndjson'):
+    """
+    Stream all trending publications of a duration, ordered by their ranking, as ndjson (one json object per line)
+    or csv.
+
+    - **duration**: the duration of data that should be queried, 'currently' (default), 'today', 'week', 'month',
+        'year'
+    - **format**: 'ndjson' (default) or 'csv'
+    """
+    if format not in export_formats:
+        raise HTTPException(status_code=400, detail="Unknown format.")
+    return export_response('trending_publications', {'duration': duration}, format, 'trending_publications_' + duration)
 
 
 @router.get("/trending/covid", summary="Get trending covid publications.", response_model=AmbaResponse)
-def get_trending__covid_publications_router(
+async def get_trending__covid_publications_router(
         offset: int = 0, limit: int = 10, sort: str = 'score', order: str = 'desc', search: str = '',
-        duration: str = "currently", session: Session = Depends(get_session)
+        duration: str = "currently", cursor: Optional[str] = None, with_count: bool = False,
+        session: AsyncSession = Depends(get_session)
 ):
     """
     Return covid related publication trending data for a given duration.
@@ -76,22 +116,33 @@ def get_trending__covid_publications_router(
     - **search**: search keyword (title only)
     - **duration**: the duration of data that should be queried, 'currently' (default), 'today', 'week', 'month',
         'year'
+    - **cursor**: (optional) use keyset pagination, pass an empty cursor for the first page and the returned
+        next_cursor for the following pages, offset is ignored
+    - **with_count**: (optional, keyset pagination only) also return the total count
     """
     start = time.time()
-    item = get_trending_covid_publications(session=session, offset=offset, limit=limit, sort=sort, order=order,
-                                           duration=duration, search=search)
-    json_compatible_item_data = jsonable_encoder(item)
-    return JSONResponse(content={"time": round((time.time() - start) * 1000), "results": json_compatible_item_data})
+    try:
+        item = await session.run_sync(lambda s: get_trending_covid_publications(
+            session=s, offset=offset, limit=limit, sort=sort, order=order, duration=duration, search=search,
+            cursor=cursor, with_count=with_count))
+    except InvalidCursor:
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
+    if cursor is not None:
+        return OrjsonResponse(content={"time": round((time.time() - start) * 1000),
+                                       "results": item['results'],
+                                       "next_cursor": item['next_cursor'], "total_count": item['total_count']})
+    return OrjsonResponse(content={"time": round((time.time() - start) * 1000), "results": item})
 
 
 @router.get("/trending/fieldOfScience", summary="Get trending publications for a given field of study.",
             response_model=AmbaResponse)
-def get_trending_publications_for_field_of_study_router(id: int,
-                                                        offset: int = 0, limit: int = 10, sort: str = 'score',
-                                                        order: str = 'desc', search: str = '',
-                                                        duration: str = "currently",
-                                                        session: Session = Depends(get_session)
-                                                        ):
+async def get_trending_publications_for_field_of_study_router(id: int,
+                                                              offset: int = 0, limit: int = 10, sort: str = 'score',
+                                                              order: str = 'desc', search: str = '',
+                                                              duration: str = "currently", cursor: Optional[str] = None,
+                                                              with_count: bool = False,
+                                                              session: AsyncSession = Depends(get_session)
+                                                              ):
     """
     Return publications and their trending data for a given duration and field of study.
 
@@ -105,20 +156,32 @@ def get_trending_publications_for_field_of_study_router(id: int,
     - **search**: search keyword (title only)
     - **duration**: the duration of data that should be queried, 'currently' (default), 'today', 'week', 'month',
         'year'
+    - **cursor**: (optional) use keyset pagination, pass an empty cursor for the first page and the returned
+        next_cursor for the following pages, offset is ignored
+    - **with_count**: (optional, keyset pagination only) also return the total count
     """
     start = time.time()
-    item = get_trending_publications_for_field_of_study(session=session, offset=offset, limit=limit, sort=sort,
-                                                        order=order, duration=duration, search=search, fos_id=id)
-    json_compatible_item_data = jsonable_encoder(item)
-    return JSONResponse(content={"time": round((time.time() - start) * 1000), "results": json_compatible_item_data})
+    try:
+        item = await session.run_sync(lambda s: get_trending_publications_for_field_of_study(
+            session=s, offset=offset, limit=limit, sort=sort, order=order, duration=duration, search=search, fos_id=id,
+            cursor=cursor, with_count=with_count))
+    except InvalidCursor:
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
+    if cursor is not None:
+        return OrjsonResponse(content={"time": round((time.time() - start) * 1000),
+                                       "results": item['results'],
+                                       "next_cursor": item['next_cursor'], "total_count": item['total_count']})
+    return OrjsonResponse(content={"time": round((time.time() - start) * 1000), "results": item})
 
 
 @router.get("/trending/author", summary="Get trending publications for a given author.", response_model=AmbaResponse)
-def get_trending_publications_for_author_router(id: int,
-                                                offset: int = 0, limit: int = 10, sort: str = 'score',
-                                                order: str = 'desc', search: str = '',
-                                                duration: str = "currently", session: Session = Depends(get_session)
-                                                ):
+async def get_trending_publications_for_author_router(id: int,
+                                                      offset: int = 0, limit: int = 10, sort: str = 'score',
+                                                      order: str = 'desc', search: str = '',
+                                                      duration: str = "currently", cursor: Optional[str] = None,
+                                                      with_count: bool = False,
+                                                      session: AsyncSession = Depends(get_session)
+                                                      ):
     """
     Return publications and their trending data for a given duration and author.
 
@@ -132,16 +195,26 @@ def get_trending_publications_for_author_router(id: int,
     - **search**: search keyword (title only)
     - **duration**: the duration of data that should be queried, 'currently' (default), 'today', 'week', 'month',
         'year'
+    - **cursor**: (optional) use keyset pagination, pass an empty cursor for the first page and the returned
+        next_cursor for the following pages, offset is ignored
+    - **with_count**: (optional, keyset pagination only) also return the total count
     """
     start = time.time()
-    item = get_trending_publications_for_author(session=session, offset=offset, limit=limit, sort=sort, order=order,
-                                                duration=duration, search=search, author_id=id)
-    json_compatible_item_data = jsonable_encoder(item)
-    return JSONResponse(content={"time": round((time.time() - start) * 1000), "results": json_compatible_item_data})
+    try:
+        item = await session.run_sync(lambda s: get_trending_publications_for_author(
+            session=s, offset=offset, limit=limit, sort=sort, order=order, duration=duration, search=search,
+            author_id=id, cursor=cursor, with_count=with_count))
+    except InvalidCursor:
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
+    if cursor is not None:
+        return OrjsonResponse(content={"time": round((time.time() - start) * 1000),
+                                       "results": item['results'],
+                                       "next_cursor": item['next_cursor'], "total_count": item['total_count']})
+    return OrjsonResponse(content={"time": round((time.time() - start) * 1000), "results": item})
 
 
 @router.get("/get", summary="Get publication.", response_model=AmbaResponse)
-def get_publication_data(doi: str, duration: str = "currently", session: Session = Depends(get_session)):
+async def get_publication_data(doi: str, duration: str = "currently", session: AsyncSession = Depends(get_session)):
     """
     get publication data for a given doi
 
@@ -153,7 +226,38 @@ def get_publication_data(doi: str, duration: str = "currently", session: Session
     logging.warning('retrieve publication ' + unquote(doi))
 
     start = time.time()
-    publication = retrieve_publication(session, doi, duration)
+    publication = await session.run_sync(retrieve_publication, doi, duration)
     logging.warning(publication)
-    json_compatible_item_data = jsonable_encoder(publication)
-    return JSONResponse(content={"time": round((time.time() - start) * 1000), "results": json_compatible_item_data})
+    return OrjsonResponse(content={"time": round((time.time() - start) * 1000), "results": publication})
+
+
+@router.get("/getBatch", summary="Get multiple publications.", response_model=AmbaResponse)
+async def get_publications_data(doi: List[str] = Query(...), duration: str = "currently",
+                                session: AsyncSession = Depends(get_session)):
+    """
+    get publication data for multiple dois at once, one entry per doi in the given order (empty if not found)
+
+    - **doi**: dois of the publications to get, repeat the parameter for each doi (max 50)
+    - **duration**: the duration of data that should be queried, 'currently' (default), 'today', 'week', 'month',
+        'year'
+    """
+    if len(set(doi)) > PUBLICATION_BATCH_LIMIT:
+        raise HTTPException(status_code=400, detail="At most %d dois are allowed." % PUBLICATION_BATCH_LIMIT)
+
+    start = time.time()
+    publications = await session.run_sync(retrieve_publications, doi, duration)
+    return OrjsonResponse(content={"time": round((time.time() - start) * 1000), "results": publications})
+
+
+@router.get("/autocomplete", summary="Autocomplete publications.", response_model=AmbaResponse)
+async def get_publication_autocomplete(q: str, limit: int = 10, session: AsyncSession = Depends(get_session)):
+    """
+    Return the top publication titles containing the given text, titles starting with it first.
+    Returns an empty result for less than 3 characters or if the lookup takes too long.
+
+    - **q**: text to complete
+    - **limit**: (optional, 10, max 50) limit the result
+    """
+    start = time.time()
+    item = await session.run_sync(autocomplete, 'publication', q, limit)
+    return OrjsonResponse(content={"time": round((time.time() - start) * 1000), "results": item})
@@ -1,12 +1,14 @@
 import time
 from typing import List, Optional
 
-from fastapi import APIRouter, Depends, HTTPException, Query
-from fastapi.encoders import jsonable_encoder
-from sqlalchemy.orm import Session  # type: ignore
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.models.schema import StatValue, Publication, TimeValue, DiscussionNewestSubj, AmbaResponse
 
-from app.daos.database import SessionLocal, engine, query_api
+from app.daos.cache import response_cache
+from app.daos.encoder import OrjsonResponse
+from app.daos.database import AsyncSessionLocal, engine, async_query_api, run_with_async_influx
+from app.daos.discussion_counts import discussion_counts
 from app.daos.field_of_study import (
     retrieve_field_of_study
 )
@@ -14,8 +16,10 @@ from app.daos.author import (
     retrieve_author
 )
 from app.daos.stats import (
-    get_discussion_data_list,
-    get_discussion_data_list_with_percentage,
+    get_discussion_data_lists,
+    get_windowed_discussion_data_lists,
+    trending_time_definition,
+    get_discussion_data_lists_with_percentage,
     get_trending_chart_data,
     get_window_chart_data,
     get_numbers_influx,
@@ -28,27 +32,24 @@ from app.daos.stats import (
     get_tweet_author_count
 )
 import event_stream.models.model as models
-from starlette.responses import JSONResponse, PlainTextResponse
+from starlette.responses import PlainTextResponse
 
 models.Base.metadata.create_all(bind=engine)
 router = APIRouter()
 
 
-def get_session():
+async def get_session():
     """
-    get/create a session
+    get/create an async session
     """
-    session = SessionLocal()
-    try:
+    async with AsyncSessionLocal() as session:
         yield session
-    finally:
-        session.close()
 
 
 @router.get("/numbers", summary="Get statistical numbers.", response_model=AmbaResponse)
-def get_numbers(fields: Optional[List[str]] = Query(None), dois: Optional[List[str]] = Query(None),
-                duration: str = "currently", mode: str = "publication", id: int = None,
-                session: Session = Depends(get_session)):
+async def get_numbers(fields: Optional[List[str]] = Query(None), dois: Optional[List[str]] = Query(None),
+                      duration: str = "currently", mode: str = "publication", id: int = None,
+                      session: AsyncSession = Depends(get_session)):
     """
     Query statistical numbers for publications.
 
@@ -62,25 +63,27 @@ def get_numbers(fields: Optional[List[str]] = Query(None), dois: Optional[List[s
     start = time.time()
 
     if mode == "fieldOfStudy" and id:
-        dois = get_dois_for_field_of_study(id, session, duration)
+        dois = await session.run_sync(lambda s: get_dois_for_field_of_study(id, s, duration))
 
     if mode == "author" and id:
-        dois = get_dois_for_author(id, session, duration)
+        dois = await session.run_sync(lambda s: get_dois_for_author(id, s, duration))
 
     if not fields:
         fields = ['count']
 
-    json_compatible_item_data = get_numbers_influx(query_api=query_api, dois=dois, duration=duration, fields=fields)
+    json_compatible_item_data = await run_with_async_influx(get_numbers_influx, query_api=async_query_api, dois=dois,
+                                                            duration=duration, fields=fields)
 
-    return JSONResponse(content={"time": round((time.time() - start) * 1000), "results": json_compatible_item_data})
+    return OrjsonResponse(content={"time": round((time.time() - start) * 1000), "results": json_compatible_item_data})
 
 
 @router.get("/top", summary="Get top numbers.", response_model=AmbaResponse)
-def get_top_values(fields: Optional[List[str]] = Query(None), doi: Optional[str] = None, limit: int = 10,
-                   mode: str = "publication", id: int = None, session: Session = Depends(get_session)):
+async def get_top_values(fields: Optional[List[str]] = Query(None), doi: Optional[str] = None, limit: int = 10,
+                         mode: str = "publication", id: int = None, duration: Optional[str] = None,
+                         session: AsyncSession = Depends(get_session)):
     """
-        Query accumulated top data numbers for publications. This query does not have a duration and will always return
-        data collected over all time.
+        Query accumulated top data numbers for publications. Without a duration it will return data collected over all
+        time.
 
         - **fields**: list of strings with one of the following values, 'entity', 'hashtag', 'lang', 'location', 'name',
             'source', 'tweet_type', 'word' (default)
@@ -88,53 +91,72 @@ def get_top_values(fields: Optional[List[str]] = Query(None), doi: Optional[str]
         - **limit**: (optional, 10) limits the result
         - **mode**: what mode should be used, can be: 'publication' (default), 'fieldOfStudy' or 'author'
         - **id**: needed for 'fieldOfStudy' or 'author' mode, the id of the entity
+        - **duration**: (optional) only count the discussion of 'currently', 'today', 'week', 'month' or 'year'
         """
     start = time.time()
 
     if not fields:
         fields = ['word']
 
-    json_compatible_item_data = {}
-
-    for field in fields:
-        item = get_discussion_data_list(session=session, doi=doi, limit=limit, dd_type=field, id=id, mode=mode)
-        json_compatible_item_data[field] = jsonable_encoder(item)
+    if duration is not None:
+        check_discussion_duration(duration)
+        json_compatible_item_data = await session.run_sync(lambda s: get_windowed_discussion_data_lists(
+            session=s, doi=doi, limit=limit, id=id, mode=mode, dd_types=fields, duration=duration))
+    else:
+        json_compatible_item_data = await session.run_sync(
+            lambda s: get_discussion_data_lists(session=s, doi=doi, limit=limit, id=id, mode=mode, dd_types=fields))
 
-    return JSONResponse(content={"time": round((time.time() - start) * 1000), "results": json_compatible_item_data})
+    return OrjsonResponse(content={"time": round((time.time() - start) * 1000), "results": json_compatible_item_data})
 
 
 @router.get("/top/percentages", summary="Get top numbers with percentage.", response_model=AmbaResponse)
-def get_top_percentage_values(fields: Optional[List[str]] = Query(None), doi: Optional[str] = None, limit: int = 10,
-                              min_percentage: float = 1, session: Session = Depends(get_session)):
+async def get_top_percentage_values(fields: Optional[List[str]] = Query(None), doi: Optional[str] = None,
+                                    limit: int = 10, min_percentage: float = 1, duration: Optional[str] = None,
+                                    session: AsyncSession = Depends(get_session)):
     """
         Query accumulated top data numbers for publications with a percentage as well as a min percentage to filter out
-        rare items.  This query does not have a duration and will always return data collected over all time.
+        rare items.  Without a duration it will return data collected over all time.
 
         - **fields**: list of strings with one of the following values, 'entity', 'hashtag', 'lang', 'location', 'name',
             'source', 'tweet_type', 'word' (default)
         - **doi**: (optional) only use the given doi
         - **limit**: (optional, 10) limits the result
         - **min_percentage**: (optional, 1) limits the results to only items that have a higher or equal percentage
+        - **duration**: (optional) only count the discussion of 'currently', 'today', 'week', 'month' or 'year'
         """
     start = time.time()
 
     if not fields:
         fields = ['lang']
 
-    json_compatible_item_data = {}
+    if duration is not None:
+        check_discussion_duration(duration)
+        item = await session.run_sync(lambda s: get_windowed_discussion_data_lists(
+            session=s, doi=doi, limit=limit, id=None, dd_types=fields, duration=duration,
+            min_percentage=min_percentage))
+        return OrjsonResponse(content={"time": round((time.time() - start) * 1000), "results": item})
 
-    for field in fields:
-        item = get_discussion_data_list_with_percentage(session=session, doi=doi, limit=limit,
-                                                        min_percentage=min_percentage, dd_type=field)
-        json_compatible_item_data[field] = jsonable_encoder(item)
+    json_compatible_item_data = await session.run_sync(lambda s: get_discussion_data_lists_with_percentage(
+        session=s, doi=doi, limit=limit, min_percentage=min_percentage, dd_types=fields))
 
-    return JSONResponse(content={"time": round((time.time() - start) * 1000), "results": json_compatible_item_data})
+    return OrjsonResponse(content={"time": round((time.time() - start) * 1000), "results": json_compatible_item_data})
+
+
+def check_discussion_duration(duration):
+    """
+    windowed discussion counts need a known duration and the discussion buckets
+    """
+    if duration not in trending_time_definition:
+        raise HTTPException(status_code=400, detail="Unknown duration.")
+    if not discussion_counts.available:
+        raise HTTPException(status_code=503, detail="Discussion buckets not available.")
 
 
 # get profile information for a publication by doi
 @router.get("/profile", summary="Get top profile information.", response_model=AmbaResponse)
-def get_profile_information(doi: Optional[str] = Query(None), duration: Optional[str] = "currently",
-                            mode: str = "publication", id: int = None, session: Session = Depends(get_session)):
+async def get_profile_information(doi: Optional[str] = Query(None), duration: Optional[str] = "currently",
+                                  mode: str = "publication", id: int = None, request: Request = None,
+                                  session: AsyncSession = Depends(get_session)):
     """
         Return profile information meaning it will not only return the value of the doi, author or field of study but
         the avg, min and max to compare against.
@@ -150,30 +172,38 @@ def get_profile_information(doi: Optional[str] = Query(None), duration: Optional
     if (mode == "publication" and not doi) or (mode == "fieldOfStudy" and not id) or (mode == "author" and not id):
         raise HTTPException(status_code=404, detail="Missing data.")
 
+    cache_key = response_cache.key('stats/profile', doi=doi if mode == "publication" else None, duration=duration,
+                                   mode=mode, id=id if mode != "publication" else None)
+    cached = response_cache.cached_response(cache_key, duration, request, start)
+    if cached is not None:
+        return cached
+
     doi_info = {
-        'publication': get_profile_information_for_doi(session, doi, id, mode, duration)
+        'publication': await session.run_sync(get_profile_information_for_doi, doi, id, mode, duration)
     }
 
     if mode == "publication" and doi and doi_info:
         doi_info['publication']['doi'] = doi
     if mode == "fieldOfStudy" and id and doi_info:
-        doi_info['publication']['doi'] = retrieve_field_of_study(session, id)['fields_of_study']
+        doi_info['publication']['doi'] = (await session.run_sync(retrieve_field_of_study, id))['fields_of_study']
     if mode == "author" and id and doi_info:
-        doi_info['publication']['doi'] = retrieve_author(session, id)['author']
-    avg_info = get_profile_information_avg(session, duration)
+        doi_info['publication']['doi'] = (await session.run_sync(retrieve_author, id))['author']
+    avg_info = await session.run_sync(get_profile_information_avg, duration)
 
     if doi_info and avg_info:
-        json_compatible_item_data = jsonable_encoder({**doi_info, **avg_info})
+        json_compatible_item_data = {**doi_info, **avg_info}
     else:
         json_compatible_item_data = {}
-    return JSONResponse(content={"time": round((time.time() - start) * 1000), "results": json_compatible_item_data})
+    return response_cache.respond(cache_key, duration, {"time": round((time.time() - start) * 1000),
+                                                         "results": json_compatible_item_data})
 
 
 # get chart data
 @router.get("/progress/value", summary="Get progress for publications.", response_model=AmbaResponse)
-def get_window_progress(field: Optional[str] = Query(None), n: Optional[int] = 5, duration: Optional[str] = "currently",
-                        dois: Optional[List[str]] = Query(None), mode: str = "publication", id: int = None,
-                        session: Session = Depends(get_session)):
+async def get_window_progress(field: Optional[str] = Query(None), n: Optional[int] = 5,
+                              duration: Optional[str] = "currently", dois: Optional[List[str]] = Query(None),
+                              mode: str = "publication", id: int = None,
+                              session: AsyncSession = Depends(get_session)):
     """
         Return the progress over time for a given field. It will either use the top n publications or a given doi list.
         Data will be aggregated in windows to optimize performance.
@@ -193,20 +223,22 @@ def get_window_progress(field: Optional[str] = Query(None), n: Optional[int] = 5
         field = 'score'
 
     if mode == "fieldOfStudy" and id:
-        dois = get_dois_for_field_of_study(id, session, duration)
+        dois = await session.run_sync(lambda s: get_dois_for_field_of_study(id, s, duration))
 
     if mode == "author" and id:
-        dois = get_dois_for_author(id, session, duration)
+        dois = await session.run_sync(lambda s: get_dois_for_author(id, s, duration))
 
-    json_compatible_item_data = get_window_chart_data(query_api, session, duration, field, n, dois)
-    return JSONResponse(content={"time": round((time.time() - start) * 1000), "results": json_compatible_item_data})
+    json_compatible_item_data = await session.run_sync(
+        lambda s: get_window_chart_data(async_query_api, s, duration, field, n, dois))
+    return OrjsonResponse(content={"time": round((time.time() - start) * 1000), "results": json_compatible_item_data})
 
 
 # get trending chart data
 @router.get("/progress/trending", summary="Get progress from the trending bucket.", response_model=AmbaResponse)
-def get_trending_progress(field: Optional[str] = Query(None), n: Optional[int] = 5,
-                          duration: Optional[str] = "currently", dois: Optional[List[str]] = Query(None),
-                          mode: str = "publication", id: int = None, session: Session = Depends(get_session)):
+async def get_trending_progress(field: Optional[str] = Query(None), n: Optional[int] = 5,
+                                duration: Optional[str] = "currently", dois: Optional[List[str]] = Query(None),
+                                mode: str = "publication", id: int = None,
+                                session: AsyncSession = Depends(get_session)):
     """
         Return the trending progress over time for a given field. It will either use the top n publications or a given
         doi list.
@@ -227,19 +259,20 @@ def get_trending_progress(field: Optional[str] = Query(None), n: Optional[int] =
         field = 'score'
 
     if mode == "fieldOfStudy" and id:
-        dois = get_dois_for_field_of_study(id, session, duration)
+        dois = await session.run_sync(lambda s: get_dois_for_field_of_study(id, s, duration))
 
     if mode == "author" and id:
-        dois = get_dois_for_author(id, session, duration)
+        dois = await session.run_sync(lambda s: get_dois_for_author(id, s, duration))
 
-    json_compatible_item_data = get_trending_chart_data(query_api, session, duration, field, n, dois)
-    return JSONResponse(content={"time": round((time.time() - start) * 1000), "results": json_compatible_item_data})
+    json_compatible_item_data = await session.run_sync(
+        lambda s: get_trending_chart_data(async_query_api, s, duration, field, n, dois))
+    return OrjsonResponse(content={"time": round((time.time() - start) * 1000), "results": json_compatible_item_data})
 
 
 # get newest tweets
 @router.get("/tweets", summary="Get newest discussion data.", response_model=AmbaResponse)
-def get_tweets_discussion_data(doi: Optional[str] = Query(None), mode: str = "publication", id: int = None,
-                               session: Session = Depends(get_session)):
+async def get_tweets_discussion_data(doi: Optional[str] = Query(None), mode: str = "publication", id: int = None,
+                                     session: AsyncSession = Depends(get_session)):
     """
         Get the newest discussion data.
 
@@ -248,14 +281,14 @@ def get_tweets_discussion_data(doi: Optional[str] = Query(None), mode: str = "pu
         - **id**: needed for 'fieldOfStudy' or 'author' mode, the id of the entity
     """
     start = time.time()
-    json_compatible_item_data = [get_tweets(doi=doi, session=session, id=id, mode=mode)]
-    return {"time": round((time.time() - start) * 1000), "results": json_compatible_item_data}
+    json_compatible_item_data = [await session.run_sync(lambda s: get_tweets(doi=doi, session=s, id=id, mode=mode))]
+    return OrjsonResponse(content={"time": round((time.time() - start) * 1000), "results": json_compatible_item_data})
 
 
 # get tweet author count
 @router.get("/countTweets", summary="Get total tweet count.", response_model=AmbaResponse)
-def get_count_total_tweets(doi: Optional[str] = Query(None), mode: str = "publication", id: int = None,
-                           session: Session = Depends(get_session)):
+async def get_count_total_tweets(doi: Optional[str] = Query(None), mode: str = "publication", id: int = None,
+                                 session: AsyncSession = Depends(get_session)):
     """
         Get total tweet count.
 
@@ -264,13 +297,14 @@ def get_count_total_tweets(doi: Optional[str] = Query(None), mode: str = "public
         - **id**: needed for 'fieldOfStudy' or 'author' mode, the id of the entity
     """
     start = time.time()
-    json_compatible_item_data = get_total_tweet_count(doi=doi, session=session, id=id, mode=mode)
-    return {"time": round((time.time() - start) * 1000), "results": json_compatible_item_data}
+    json_compatible_item_data = await session.run_sync(
+        lambda s: get_total_tweet_count(doi=doi, session=s, id=id, mode=mode))
+    return OrjsonResponse(content={"time": round((time.time() - start) * 1000), "results": json_compatible_item_data})
 
 
 @router.get("/countTweetAuthors", summary="Get total tweet author count.", response_model=AmbaResponse)
-def get_count_tweet_author(doi: Optional[str] = Query(None), mode: str = "publication", id: int = None,
-                           session: Session = Depends(get_session)):
+async def get_count_tweet_author(doi: Optional[str] = Query(None), mode: str = "publication", id: int = None,
+                                 session: AsyncSession = Depends(get_session)):
     """
         Get total tweet author count.
 
@@ -279,5 +313,6 @@ def get_count_tweet_author(doi: Optional[str] = Query(None), mode: str = "public
         - **id**: needed for 'fieldOfStudy' or 'author' mode, the id of the entity
     """
     start = time.time()
-    json_compatible_item_data = get_tweet_author_count(doi=doi, session=session, id=id, mode=mode)
-    return {"time": round((time.time() - start) * 1000), "results": json_compatible_item_data}
+    json_compatible_item_data = await session.run_sync(
+        lambda s: get_tweet_author_count(doi=doi, session=s, id=id, mode=mode))
+    return OrjsonResponse(content={"time": round((time.time() - start) * 1000), "results": json_compatible_item_data})
@@ -4,3 +4,8 @@ echo "prestart"
 
 ./scripts/wait-for-it.sh "$KAFKA_BOOTRSTRAP_SERVER" -t 5 -- echo "Kafka started"
 ./scripts/wait-for-it.sh "$POSTGRES_HOST:$POSTGRES_PORT" -t 5 -- echo "Postgres started"
+
+python -m app.daos.indexes || echo "creating indexes failed"
+python -m app.daos.snapshot || echo "creating snapshots failed"
+python -m app.daos.discussion_counts || echo "creating discussion counts failed"
+python -m app.daos.freshness || echo "creating data_version failed"
@@ -0,0 +1,58 @@
+"""Benchmark DOI Filter
+ query time of /stats/numbers for a growing number of dois with each doi filter strategy of
+ app.daos.stats.doi_filter_list, uses the configured postgresql (for the dois) and influxdb
+
+    python -m scripts.benchmark_doi_filter --duration today --counts 10 100 1000 5000 --repeat 3
+"""
+import argparse
+import statistics
+import time
+
+from sqlalchemy import text, bindparam
+
+from app.daos.database import SessionLocal, query_api
+from app.daos.stats import get_numbers_influx
+
+strategies = ['or', 'contains', 'set']
+
+
+def get_dois(duration, n):
+    """ the n top trending dois of a duration """
+    with SessionLocal() as session:
+        s = text('SELECT publication_doi FROM trending WHERE duration = :duration ORDER BY score DESC LIMIT :n')
+        s = s.bindparams(bindparam('duration'), bindparam('n'))
+        return [row[0] for row in session.execute(s, {'duration': duration, 'n': n})]
+
+
+def run(duration, counts, fields, repeat):
+    """ print the median query time in ms per doi count and strategy """
+    dois = get_dois(duration, max(counts))
+    print('%d dois available for %s' % (len(dois), duration))
+    print('%8s' % 'dois' + ''.join('%12s' % strategy for strategy in strategies))
+    for count in counts:
+        if count > len(dois):
+            break
+        row = '%8d' % count
+        for strategy in strategies:
+            times = []
+            for _ in range(repeat):
+                start = time.time()
+                try:
+                    get_numbers_influx(query_api, dois[:count], duration, fields, strategy)
+                except Exception as e:
+                    print('%s with %d dois failed: %s' % (strategy, count, e))
+                    times = []
+                    break
+                times.append((time.time() - start) * 1000)
+            row += '%12s' % (('%.0f' % statistics.median(times)) if times else '-')
+        print(row)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='query time of the influx doi filter strategies')
+    parser.add_argument('--duration', default='today')
+    parser.add_argument('--counts', type=int, nargs='+', default=[10, 50, 100, 500, 1000, 2000, 5000])
+    parser.add_argument('--fields', nargs='+', default=['score', 'count', 'pub_count'])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    run(args.duration, args.counts, args.fields, args.repeat)
@@ -0,0 +1,105 @@
+import pytest
+
+from app.daos.cache import ResponseCache, etag_matches, with_time
+from app.daos.freshness import data_freshness
+
+
+@pytest.fixture
+def versions(monkeypatch):
+    """ data versions of the durations, as tracked by the freshness checker """
+    monkeypatch.setattr(data_freshness, 'available', True)
+    monkeypatch.setattr(data_freshness, 'versions', {'today': (1, None)})
+    return data_freshness.versions
+
+
+def test_key_is_normalized():
+    key = ResponseCache.key('/publication/trending', duration='today', order='DESC', search='Covid')
+    assert key == ResponseCache.key('/publication/trending', search='covid', order='asc', duration='today')
+    assert key == '/publication/trending?duration=today&order=asc&search=covid'
+    assert ResponseCache.key('/trending', search='abc') == ResponseCache.key('/trending', search=None)
+
+
+def test_hit_and_miss(versions):
+    cache = ResponseCache()
+    assert cache.get('a') is None
+    cache.set('a', b'{"results":[]}', 'today')
+    assert cache.get('a') == b'{"results":[]}'
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+
+def test_unknown_duration_is_not_cached(versions):
+    cache = ResponseCache()
+    cache.set('a', b'{}', 'forever')
+    assert cache.get('a') is None
+
+
+def test_new_data_version_invalidates(versions):
+    cache = ResponseCache()
+    cache.set('a', b'{}', 'today')
+    versions['today'] = (2, None)
+    assert cache.get('a') is None
+    assert cache.stats()['invalidations'] == 1
+    assert cache.stats()['entries'] == 0
+
+
+def test_expired_entry_is_dropped(versions):
+    cache = ResponseCache()
+    cache.set('a', b'{}', 'today')
+    cache.entries['a'] = (0,) + cache.entries['a'][1:]
+    assert cache.get('a') is None
+    assert cache.stats()['expirations'] == 1
+
+
+def test_evicted_by_size(versions):
+    cache = ResponseCache(max_bytes=10)
+    cache.set('a', b'{"a":1}', 'today')
+    cache.set('b', b'{"b":1}', 'today')
+    assert cache.get('a') is None
+    assert cache.get('b') == b'{"b":1}'
+    assert cache.stats()['entries'] == 1
+    assert cache.stats()['bytes'] == 7
+    assert cache.stats()['evictions'] == 1
+
+
+def test_etag_is_weak_and_changes_with_the_version(versions):
+    etag = ResponseCache.etag('key', 'today')
+    assert etag.startswith('W/"') and etag.endswith('"')
+    assert ResponseCache.etag('key', 'today') == etag
+    assert ResponseCache.etag('other', 'today') != etag
+    versions['today'] = (2, None)
+    assert ResponseCache.etag('key', 'today') != etag
+
+
+def test_headers():
+    headers = ResponseCache(max_ttl=60).headers('key', 'today')
+    assert set(headers) == {'ETag', 'Cache-Control'}
+    assert 0 <= int(headers['Cache-Control'].split('max-age=')[1]) <= 60
+    assert ResponseCache().headers('key', 'forever') == {}
+
+
+@pytest.mark.parametrize('if_none_match, expected', [
+    (None, False),
+    ('', False),
+    ('W/"abc"', True),
+    ('"abc"', True),
+    ('"other", W/"abc"', True),
+    ('*', True),
+    ('"other"', False),
+])
+def test_etag_matches(if_none_match, expected):
+    assert etag_matches(if_none_match, 'W/"abc"') == expected
+
+
+def test_with_time():
+    assert with_time(b'{"results":[]}', 12) == b'{"time":12,"results":[]}'
+    assert with_time(b'{}', 3) == b'{"time":3}'
+    assert with_time(b'{"results":[]}', None) == b'{"results":[]}'
+
+
+def test_respond_stores_the_body_without_time(versions):
+    cache = ResponseCache()
+    response = cache.respond('a', 'today', {'time': 5, 'results': []})
+    assert response.body == b'{"time":5,"results":[]}'
+    assert response.headers['X-Cache'] == 'MISS'
+    assert cache.get('a') == b'{"results":[]}'
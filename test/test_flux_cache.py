@@ -0,0 +1,89 @@
+import asyncio
+from datetime import timedelta
+
+import pytest
+from sqlalchemy.util import await_only, greenlet_spawn
+
+from app.daos.flux_cache import FluxCache
+
+window_size = timedelta(minutes=6)
+
+
+def test_window_is_aligned():
+    assert FluxCache.window(window_size, now=1000) == (720, 1080)
+    assert FluxCache.window(window_size, now=1080) == (1080, 1440)
+
+
+def test_result_is_cached_per_window():
+    cache = FluxCache()
+    calls = []
+
+    def query():
+        calls.append(1)
+        return len(calls)
+
+    assert cache.get_or_query(('q',), window_size, query) == 1
+    assert cache.get_or_query(('q',), window_size, query) == 1
+    assert cache.get_or_query(('other',), window_size, query) == 2
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 2
+
+
+def test_expired_entry_is_queried_again():
+    cache = FluxCache()
+    key = ('q',) + (cache.window(window_size)[0],)
+    cache.entries[key] = (0, 'outdated')
+    assert cache.get_or_query(('q',), window_size, lambda: 'current') == 'current'
+
+
+def test_disabled_cache_always_queries():
+    cache = FluxCache(enabled=False)
+    calls = []
+    for _ in range(2):
+        cache.get_or_query(('q',), window_size, lambda: calls.append(1))
+    assert len(calls) == 2
+    assert cache.stats()['entries'] == 0
+
+
+def test_least_recently_used_entry_is_dropped():
+    cache = FluxCache(max_entries=2)
+    for name in ('a', 'b', 'c'):
+        cache.get_or_query((name,), window_size, lambda: name)
+    assert [key[0] for key in cache.entries] == ['b', 'c']
+
+
+def test_concurrent_queries_are_coalesced():
+    cache = FluxCache()
+    calls = []
+
+    def query():
+        calls.append(1)
+        # hand the event loop to the other greenlet while the query runs
+        await_only(asyncio.sleep(0.01))
+        return 'result'
+
+    async def run():
+        return await asyncio.gather(*(greenlet_spawn(cache.get_or_query, ('q',), window_size, query)
+                                      for _ in range(3)))
+
+    assert asyncio.run(run()) == ['result'] * 3
+    assert len(calls) == 1
+    assert cache.stats()['coalesced'] == 2
+    assert cache.stats()['inflight'] == 0
+
+
+def test_coalesced_queries_get_the_exception():
+    cache = FluxCache()
+
+    def query():
+        await_only(asyncio.sleep(0.01))
+        raise RuntimeError('influx unavailable')
+
+    async def run():
+        return await asyncio.gather(*(greenlet_spawn(cache.get_or_query, ('q',), window_size, query)
+                                      for _ in range(2)), return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert cache.stats()['entries'] == 0
+    assert cache.stats()['inflight'] == 0
@@ -0,0 +1,21 @@
+from app.daos.live import diff_rows
+
+
+def test_diff_rows():
+    old = [{'doi': 'a', 'score': 3}, {'doi': 'b', 'score': 2}, {'doi': 'c', 'score': 1}]
+    new = [{'doi': 'b', 'score': 4}, {'doi': 'a', 'score': 3}, {'doi': 'd', 'score': 1}]
+    assert diff_rows(old, new, 'doi') == {
+        'changed': [{'doi': 'b', 'score': 4}, {'doi': 'd', 'score': 1}],
+        'removed': ['c'],
+        'order': ['b', 'a', 'd'],
+    }
+
+
+def test_diff_rows_unchanged():
+    rows = [{'id': 1, 'score': 2}, {'id': 2, 'score': 1}]
+    assert diff_rows(rows, [dict(row) for row in rows], 'id') == {'changed': [], 'removed': [], 'order': [1, 2]}
+
+
+def test_diff_rows_from_empty():
+    new = [{'id': 1, 'score': 2}]
+    assert diff_rows([], new, 'id') == {'changed': new, 'removed': [], 'order': [1]}
@@ -0,0 +1,107 @@
+import json
+import os
+
+import pytest
+
+from app.daos.metrics import Metrics, EXITED_FILE, merge_state, read_state
+
+buckets = (0.1, 1.0)
+
+
+def write_state(directory, name, state):
+    with open(os.path.join(str(directory), name), 'w') as f:
+        json.dump(state, f)
+
+
+def worker_state(pid, seconds, requests):
+    return {
+        'pid': pid,
+        'histograms': {'query_duration_seconds': {Metrics.labels(kind='sql'): [0, 1, 0, seconds, 1]}},
+        'counters': {'requests': {Metrics.labels(route='/'): requests}},
+        'gauges': {'pool': {Metrics.labels(stat='size'): 5}},
+    }
+
+
+@pytest.fixture
+def exited_pid():
+    """ pid of a process that is not running """
+    pid = 2 ** 22 - 1
+    while True:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return pid
+        except PermissionError:
+            pass
+        pid -= 1
+
+
+def test_observe_and_inc(tmp_path):
+    m = Metrics(str(tmp_path), buckets)
+    m.observe('latency', 0.05, route='/')
+    m.observe('latency', 0.5, route='/')
+    m.observe('latency', 5.0, route='/')
+    m.inc('requests', route='/')
+    m.inc('requests', 2, route='/')
+    key = Metrics.labels(route='/')
+    assert m.histograms['latency'][key] == [1, 1, 5.55, 3]
+    assert m.counters['requests'][key] == 3
+
+
+def test_merge_state():
+    histograms, counters = {}, {}
+    merge_state(histograms, counters, worker_state(1, 0.5, 2))
+    merge_state(histograms, counters, worker_state(2, 0.25, 3))
+    key = Metrics.labels(kind='sql')
+    assert histograms['query_duration_seconds'][key] == [0, 2, 0, 0.75, 2]
+    assert counters['requests'][Metrics.labels(route='/')] == 5
+
+
+def test_compact_folds_exited_workers(tmp_path, exited_pid):
+    m = Metrics(str(tmp_path), buckets)
+    write_state(tmp_path, '%d.json' % exited_pid, worker_state(exited_pid, 0.5, 2))
+    write_state(tmp_path, EXITED_FILE, {'histograms': {}, 'counters': {'requests': {Metrics.labels(route='/'): 1}}})
+    m.compact()
+    assert sorted(os.listdir(str(tmp_path))) == [EXITED_FILE]
+    state = read_state(os.path.join(str(tmp_path), EXITED_FILE))
+    assert state['counters']['requests'][Metrics.labels(route='/')] == 3
+    assert state['histograms']['query_duration_seconds'][Metrics.labels(kind='sql')] == [0, 1, 0, 0.5, 1]
+
+
+def test_compact_keeps_running_workers(tmp_path):
+    m = Metrics(str(tmp_path), buckets)
+    m.flush()
+    m.compact()
+    assert sorted(os.listdir(str(tmp_path))) == ['%d.json' % os.getpid()]
+
+
+def test_compact_previous_worker_with_the_same_pid(tmp_path):
+    m = Metrics(str(tmp_path), buckets)
+    write_state(tmp_path, '%d.json' % m.pid, worker_state(m.pid, 0.5, 2))
+    m.compact(previous=m.pid)
+    assert sorted(os.listdir(str(tmp_path))) == [EXITED_FILE]
+
+
+def test_merged_sums_all_workers(tmp_path, exited_pid):
+    m = Metrics(str(tmp_path), buckets)
+    m.inc('requests', route='/')
+    m.register('pool', lambda: {Metrics.labels(stat='size'): 2})
+    write_state(tmp_path, '%d.json' % exited_pid, worker_state(exited_pid, 0.5, 2))
+    histograms, counters, gauges = m.merged()
+    assert counters['requests'][Metrics.labels(route='/')] == 3
+    assert histograms['query_duration_seconds'][Metrics.labels(kind='sql')] == [0, 1, 0, 0.5, 1]
+    # gauges of exited workers are dropped
+    assert gauges == {'pool': {Metrics.labels(stat='size'): 2}}
+
+
+def test_render(tmp_path):
+    m = Metrics(str(tmp_path), buckets)
+    m.observe('http_request_duration_seconds', 0.5, route='/', status=200)
+    m.inc('requests', route='/')
+    lines = m.render().splitlines()
+    assert '# TYPE http_request_duration_seconds histogram' in lines
+    assert 'http_request_duration_seconds_bucket{le="0.1",route="/",status="200"} 0' in lines
+    assert 'http_request_duration_seconds_bucket{le="1.0",route="/",status="200"} 1' in lines
+    assert 'http_request_duration_seconds_bucket{le="+Inf",route="/",status="200"} 1' in lines
+    assert 'http_request_duration_seconds_count{route="/",status="200"} 1' in lines
+    assert 'requests{route="/"} 1' in lines
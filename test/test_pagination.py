@@ -0,0 +1,62 @@
+import base64
+from decimal import Decimal
+
+import pytest
+
+from app.daos.pagination import encode_cursor, decode_cursor, InvalidCursor
+
+
+def raw_cursor(raw):
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+@pytest.mark.parametrize('value, key', [
+    (12.5, '10.1234/abc'),
+    (3, '10.1234/a=b'),
+    (None, '10.1234/abc'),
+    (-0.25, 42),
+])
+def test_roundtrip(value, key):
+    cursor = encode_cursor(value, key)
+    assert '=' not in cursor
+    assert decode_cursor(cursor, type(key)) == (value, key)
+
+
+def test_decimal_value_is_encoded_as_float():
+    assert decode_cursor(encode_cursor(Decimal('1.5'), 'doi')) == (1.5, 'doi')
+
+
+def test_empty_cursor_starts_at_first_page():
+    assert decode_cursor('') is None
+    assert decode_cursor(None) is None
+
+
+def test_key_is_converted():
+    assert decode_cursor(encode_cursor(1.0, '17'), int) == (1.0, 17)
+    assert decode_cursor(encode_cursor(1.0, 17), str) == (1.0, '17')
+
+
+@pytest.mark.parametrize('cursor', [
+    'not a cursor',
+    raw_cursor('{"value": 1}'),
+    raw_cursor('[1, 2, 3]'),
+    raw_cursor('["1", "doi"]'),
+    raw_cursor('[true, "doi"]'),
+    raw_cursor('[NaN, "doi"]'),
+    raw_cursor('[Infinity, "doi"]'),
+    raw_cursor('[1, null]'),
+    raw_cursor('[1, false]'),
+    raw_cursor('[1, ["doi"]]'),
+])
+def test_invalid_cursor(cursor):
+    with pytest.raises(InvalidCursor):
+        decode_cursor(cursor)
+
+
+def test_invalid_key_type():
+    with pytest.raises(InvalidCursor):
+        decode_cursor(encode_cursor(1.0, '10.1234/abc'), int)
+
+
+def test_invalid_cursor_is_a_value_error():
+    assert issubclass(InvalidCursor, ValueError)
@@ -0,0 +1,57 @@
+import pytest
+
+from app.daos.replica import TrendingTable
+
+keys = ['doi', 'title', 'score', 'count']
+rows = [
+    ('a', 'Covid vaccines', 5.0, 10),
+    ('b', 'Climate', 9.0, None),
+    ('c', 'covid and climate', 1.0, 30),
+    ('d', None, 7.0, 20),
+]
+members = {'author': {1: ['a', 'c', 'x'], 2: ['b']}}
+
+
+@pytest.fixture
+def table():
+    return TrendingTable(1, keys, rows, ['trending_ranking', 'score', 'count'], members)
+
+
+def query(table, filter_name='all', member_id=None, sort='trending_ranking', order='asc', limit=10, offset=0,
+          search=''):
+    return table.query(filter_name, member_id, sort, order, limit, offset, search)
+
+
+def test_ranking(table):
+    result = query(table)
+    assert [row['doi'] for row in result] == ['b', 'd', 'a', 'c']
+    assert [row['trending_ranking'] for row in result] == [1, 2, 3, 4]
+    assert all(row['total_count'] == 4 for row in result)
+    assert set(result[0]) == {'trending_ranking', 'total_count'} | set(keys)
+
+
+def test_sort_with_nulls_last(table):
+    assert [row['doi'] for row in query(table, sort='count', order='asc')] == ['a', 'd', 'c', 'b']
+    # nulls come first in descending order, as in postgresql
+    assert [row['doi'] for row in query(table, sort='count', order='desc')] == ['b', 'c', 'd', 'a']
+
+
+def test_offset_and_limit(table):
+    result = query(table, sort='score', order='desc', limit=2, offset=1)
+    assert [row['doi'] for row in result] == ['d', 'a']
+    assert [row['trending_ranking'] for row in result] == [2, 3]
+    assert result[0]['total_count'] == 4
+
+
+def test_filter_ranks_within_the_members(table):
+    result = query(table, 'author', 1)
+    assert [row['doi'] for row in result] == ['a', 'c']
+    assert [row['trending_ranking'] for row in result] == [1, 2]
+    assert result[0]['total_count'] == 2
+    assert query(table, 'author', 3) == []
+
+
+def test_search(table):
+    assert [row['doi'] for row in query(table, search='COVID')] == ['a', 'c']
+    assert [row['doi'] for row in query(table, 'author', 2, search='climate')] == ['b']
+    assert query(table, 'author', 1, search='climate')[0]['trending_ranking'] == 1